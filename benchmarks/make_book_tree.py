@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+# Generator for synthetic book directories (nested parts, image and blank pages, empty directories, metadata files)
+# Run from anywhere: python benchmarks/make_book_tree.py --output_dir /tmp/book --pages 500 --depth 2
+
+import argparse, os
+import io
+import random
+
+from PIL import Image, ImageDraw
+
+# Supported page file formats (extention, Pillow format name)
+image_formats = {
+    "jpg": ("jpg", "JPEG"),
+    "png": ("png", "PNG"),
+    "gif": ("gif", "GIF")
+    }
+
+# Function to make a page image (off-white paper with noise and lines of dark "text" blocks)
+def make_page_image(width, height, seed, grey=False):
+    rand = random.Random(seed)
+    page_im = Image.effect_noise((width, height), 12).point(lambda p: min(255, p + 90))
+    if not grey:
+        page_im = Image.merge("RGB", [page_im, page_im, page_im.point(lambda p: p * 0.95)])
+    draw = ImageDraw.Draw(page_im)
+    text_color = 60 if grey else (60, 60, 60)
+    line_height = max(2, height // 66)
+    margin = width // 10
+    for y in range(margin, height - margin, line_height):
+        x = margin
+        while x < width - margin:
+            word_width = rand.randint(max(1, width // 85), max(1, width // 17))
+            draw.rectangle([x, y, min(x + word_width, width - margin), y + line_height // 2], fill=text_color)
+            x += word_width + max(1, width // 100)
+    return page_im
+
+# Function to split a number of pages between a number of directories (as evenly as possible, first ones get more)
+def split_pages(num_pages, num_dirs):
+    return [num_pages // num_dirs + (1 if n < num_pages % num_dirs else 0) for n in range(num_dirs)]
+
+# Function to make a synthetic book directory, returns what was made
+# depth is the number of directory levels above the pages (0 puts every page in the main directory)
+# blank_ratio is the chance a page is a .blank file, empty_ratio is the chance of an empty directory (chain) next to each part
+def make_book_tree(output_dir, pages=100, depth=2, branching=3, width=850, height=1100, image_format="jpg",
+        grey=False, blank_ratio=0.05, empty_ratio=0.1, variants=4, seed=0, dpi=100, title="Synthetic Book", author="bookdir2pdf"):
+    if image_format not in image_formats:
+        raise ValueError("Image format must be one of: {}".format(", ".join(image_formats.keys())))
+    rand = random.Random(seed)
+    page_ext, pil_format = image_formats[image_format]
+
+    # Encode a few different pages once, then write them over and over (much faster than making every page)
+    variant_data = list()
+    for n in range(max(1, variants)):
+        page_im = make_page_image(width, height, seed + n, grey=grey)
+        page_bytes = io.BytesIO()
+        page_im.save(page_bytes, format=pil_format)
+        variant_data.append(page_bytes.getvalue())
+
+    stats = {
+        "pages": 0,
+        "image_pages": 0,
+        "blank_pages": 0,
+        "dirs": 0,
+        "empty_dirs": 0,
+        "name_files": 0,
+        "bytes": 0
+        }
+
+    # Function to make an empty directory (sometimes nested, sometimes with a .name file, like test_dir)
+    def make_empty_dir(parent_dir, order):
+        empty_dir = os.path.join(parent_dir, "{:02d}. Empty Directory".format(order))
+        os.makedirs(empty_dir)
+        stats["dirs"] += 1
+        stats["empty_dirs"] += 1
+        if rand.random() < 0.5:
+            with open(os.path.join(empty_dir, ".name"), "w", encoding="utf-8") as f:
+                f.write("Empty Directory <{}>".format(order))
+            stats["name_files"] += 1
+        for level in range(rand.randint(0, 2)):
+            empty_dir = os.path.join(empty_dir, "01. Nested Empty Directory Level {}".format(level + 1))
+            os.makedirs(empty_dir)
+            stats["dirs"] += 1
+            stats["empty_dirs"] += 1
+        if rand.random() < 0.5:
+            # Contains only ignored files
+            with open(os.path.join(empty_dir, ".ignore"), "w") as f:
+                pass
+
+    # Function to fill one directory with parts or pages
+    def make_dir(dir_path, level, num_pages):
+        order = 0
+        if level >= depth:
+            page_num_len = len(str(num_pages))
+            for n in range(num_pages):
+                page_name = str(n + 1).rjust(page_num_len, "0")
+                if rand.random() < blank_ratio:
+                    with open(os.path.join(dir_path, page_name + os.path.extsep + "blank"), "w") as f:
+                        pass
+                    stats["blank_pages"] += 1
+                else:
+                    page_data = variant_data[rand.randrange(len(variant_data))]
+                    with open(os.path.join(dir_path, page_name + os.path.extsep + page_ext), "wb") as f:
+                        f.write(page_data)
+                    stats["image_pages"] += 1
+                    stats["bytes"] += len(page_data)
+                stats["pages"] += 1
+            return
+
+        part_kind = ["Part", "Chapter"][level] if level < 2 else "Section"
+        for n, part_pages in enumerate(split_pages(num_pages, branching)):
+            if rand.random() < empty_ratio:
+                order += 1
+                make_empty_dir(dir_path, order)
+            order += 1
+            part_dir = os.path.join(dir_path, "{:02d}. {} {}".format(order, part_kind, n + 1))
+            os.makedirs(part_dir)
+            stats["dirs"] += 1
+            make_dir(part_dir, level + 1, part_pages)
+
+    os.makedirs(output_dir, exist_ok=True)
+    if len(os.listdir(output_dir)) > 0:
+        raise FileExistsError("Output directory is not empty: {}".format(output_dir))
+
+    # Main directory metadata files
+    for ext, value in [("title", title), ("author", author), ("dpi", str(dpi))]:
+        with open(os.path.join(output_dir, os.path.extsep + ext), "w", encoding="utf-8") as f:
+            f.write(value)
+
+    make_dir(output_dir, 0, pages)
+    return stats
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Make a synthetic nested image directory to benchmark bookdir2pdf with.")
+    ap.add_argument("-o", "--output_dir", type=str, required=True,
+        help="directory to make the book in ( must be empty or not exist )")
+    ap.add_argument("-n", "--pages", type=int, default=100,
+        help="number of pages ( defaults to 100 )")
+    ap.add_argument("-d", "--depth", type=int, default=2,
+        help="number of directory levels above the pages ( defaults to 2 )")
+    ap.add_argument("-b", "--branching", type=int, default=3,
+        help="number of subdirectories in each directory ( defaults to 3 )")
+    ap.add_argument("-s", "--size", type=str, default="850x1100",
+        help="page image size in pixels ( defaults to 850x1100 )")
+    ap.add_argument("-f", "--format", type=str, default="jpg", choices=list(image_formats.keys()),
+        help="page image file format ( defaults to jpg )")
+    ap.add_argument("-g", "--grey", action="store_true",
+        help="make greyscale pages instead of color")
+    ap.add_argument("--blank_ratio", type=float, default=0.05,
+        help="chance of a page being a .blank file ( defaults to 0.05 )")
+    ap.add_argument("--empty_ratio", type=float, default=0.1,
+        help="chance of an empty directory before each part ( defaults to 0.1 )")
+    ap.add_argument("--dpi", type=int, default=100,
+        help="DPI written to the .dpi file ( defaults to 100 )")
+    ap.add_argument("--seed", type=int, default=0,
+        help="random seed, the same settings and seed always make the same book ( defaults to 0 )")
+    args = vars(ap.parse_args())
+
+    try:
+        width, height = [int(x) for x in args["size"].lower().split("x")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("(--size | -s) must look like WIDTHxHEIGHT.")
+    if args["depth"] < 0 or args["branching"] < 1 or args["pages"] < 0:
+        raise argparse.ArgumentTypeError("(--depth | -d) and (--pages | -n) must be positive, (--branching | -b) at least 1.")
+
+    print("Making synthetic book: {}".format(args["output_dir"]))
+    stats = make_book_tree(args["output_dir"], pages=args["pages"], depth=args["depth"], branching=args["branching"],
+        width=width, height=height, image_format=args["format"], grey=args["grey"], blank_ratio=args["blank_ratio"],
+        empty_ratio=args["empty_ratio"], seed=args["seed"], dpi=args["dpi"])
+    print("\tPages: {} ( {} images, {} blank )".format(stats["pages"], stats["image_pages"], stats["blank_pages"]))
+    print("\tDirectories: {} ( {} empty )".format(stats["dirs"], stats["empty_dirs"]))
+    print("\tImage data: {} bytes".format(stats["bytes"]))
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+# Benchmark of the purified page encodings (Flate and CCITT Group 4) on synthetic scanned pages
+# Run from anywhere: python benchmarks/page_encodings.py --dpi 600 --pages 3
+
+import argparse, os, sys
+import time
+
+# Import the functions from bookdir2pdf.py (one directory up) and the page maker (this directory)
+BENCH_PATH = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_PATH))
+sys.path.insert(0, BENCH_PATH)
+from bookdir2pdf import pil_to_pdf_image, pil_to_g4_pdf_image
+from purify_engines import make_scanned_page, purify_image_pillow
+
+from PIL import features
+
+encodings = {
+    "flate": pil_to_pdf_image,
+    "g4": pil_to_g4_pdf_image
+    }
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Compare the size and encoding speed of purified pages with Flate and CCITT Group 4.")
+    ap.add_argument("-d", "--dpi", type=int, default=600,
+        help="resolution of the synthetic letter size pages ( defaults to 600 )")
+    ap.add_argument("-n", "--pages", type=int, default=3,
+        help="number of pages to encode ( defaults to 3 )")
+    ap.add_argument("-r", "--repeat", type=int, default=3,
+        help="number of times each page is encoded, the fastest time is used ( defaults to 3 )")
+    args = vars(ap.parse_args())
+
+    if not features.check("libtiff"):
+        print("[ERROR]: Pillow was built without libtiff, can not encode CCITT Group 4.")
+        sys.exit(1)
+
+    print("Making and purifying {} synthetic {} DPI pages...".format(args["pages"], args["dpi"]))
+    pages = [purify_image_pillow(make_scanned_page(args["dpi"], n), 2, 170) for n in range(args["pages"])]
+    print("\tPage size: {}x{} pixels".format(*pages[0].size))
+
+    sizes = {x: 0 for x in encodings}
+    times = {x: 0.0 for x in encodings}
+    for page_im in pages:
+        for name, encode in encodings.items():
+            best_time = None
+            for n in range(max(1, args["repeat"])):
+                start = time.perf_counter()
+                pdf_image = encode(page_im)
+                run_time = time.perf_counter() - start
+                if best_time == None or run_time < best_time:
+                    best_time = run_time
+            times[name] += best_time
+            sizes[name] += len(pdf_image["data"])
+
+    print()
+    for name in encodings:
+        print("{}: {:.1f} KB per page, {:.3f} seconds per page".format(name.ljust(5),
+            sizes[name] / len(pages) / 1024, times[name] / len(pages)))
+    print("G4 size: {:.1f}% of Flate".format(sizes["g4"] * 100 / sizes["flate"]))
+    print("G4 speed: {:.2f}x Flate".format(times["flate"] / times["g4"]))
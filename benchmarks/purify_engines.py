@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+# Benchmark of the Pillow and NumPy purify engines on synthetic scanned pages
+# Run from anywhere: python benchmarks/purify_engines.py --dpi 600 --pages 3
+
+import argparse, os, sys
+import time
+import random
+
+# Import the functions from bookdir2pdf.py (one directory up)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from bookdir2pdf import purify_image_numpy
+
+from PIL import Image, ImageDraw, ImageEnhance, ImageFilter
+
+# Function to make a fake scanned page (off-white paper with noise, lines of dark "text" blocks)
+def make_scanned_page(dpi, seed):
+    rand = random.Random(seed)
+    width = int(dpi * 8.5)
+    height = int(dpi * 11)
+    page_im = Image.effect_noise((width, height), 12).point(lambda p: min(255, p + 90))
+    page_im = Image.merge("RGB", [page_im, page_im, page_im.point(lambda p: p * 0.95)])
+    draw = ImageDraw.Draw(page_im)
+    line_height = dpi // 6
+    margin = dpi
+    for y in range(margin, height - margin, line_height):
+        x = margin
+        while x < width - margin:
+            word_width = rand.randint(dpi // 10, dpi // 2)
+            draw.rectangle([x, y, min(x + word_width, width - margin), y + line_height // 2], fill=(rand.randint(10, 90),) * 3)
+            x += word_width + dpi // 12
+    return page_im.filter(ImageFilter.GaussianBlur(dpi / 300))
+
+# The purify steps from bookdir2pdf.py (engine=pillow)
+def purify_image_pillow(im, sharpen_factor, thresh_setting):
+    gray = im.convert('L')
+    sharpen = ImageEnhance.Sharpness(gray).enhance(sharpen_factor)
+    thresh = sharpen.point(lambda p: p > thresh_setting and 255)
+    return thresh.convert('1')
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Compare the speed of the purify engines on synthetic scanned pages.")
+    ap.add_argument("-d", "--dpi", type=int, default=600,
+        help="resolution of the synthetic letter size pages ( defaults to 600 )")
+    ap.add_argument("-n", "--pages", type=int, default=3,
+        help="number of pages to purify with each engine ( defaults to 3 )")
+    ap.add_argument("-s", "--sharpen", type=float, default=2,
+        help="purify sharpening factor ( defaults to 2 )")
+    ap.add_argument("-t", "--threshold", type=float, default=170,
+        help="purify threshold ( defaults to 170 )")
+    args = vars(ap.parse_args())
+
+    print("Making {} synthetic {} DPI pages...".format(args["pages"], args["dpi"]))
+    pages = [make_scanned_page(args["dpi"], n) for n in range(args["pages"])]
+    print("\tPage size: {}x{} pixels".format(*pages[0].size))
+
+    times = {"pillow": 0.0, "numpy": 0.0}
+    for n, page_im in enumerate(pages):
+        start = time.perf_counter()
+        pillow_im = purify_image_pillow(page_im, args["sharpen"], args["threshold"])
+        times["pillow"] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        numpy_im = purify_image_numpy(page_im, args["sharpen"], args["threshold"])
+        times["numpy"] += time.perf_counter() - start
+
+        if pillow_im.tobytes() != numpy_im.tobytes():
+            print("[ERROR]: Page {} is not bit-identical between engines!".format(n + 1))
+            sys.exit(1)
+    print("\tOutput is bit-identical.")
+
+    print()
+    for engine in ["pillow", "numpy"]:
+        print("{}: {:.3f} seconds per page".format(engine.ljust(6), times[engine] / len(pages)))
+    print("Speedup: {:.2f}x".format(times["pillow"] / times["numpy"]))
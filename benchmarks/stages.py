@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+
+# Benchmark of each bookdir2pdf stage (scan, probe, bookmarks, table of contents, page reading, blank pages, purify, PDF assembly)
+# Results are written as JSON, so runs of different versions can be compared
+# Run from anywhere: python benchmarks/stages.py --pages 200 --output results.json
+
+import argparse, os, sys
+import io
+import json
+import multiprocessing
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+
+# Import bookdir2pdf.py (one directory up) and the book generator (this directory)
+BENCH_PATH = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_PATH))
+sys.path.insert(0, BENCH_PATH)
+import bookdir2pdf
+from make_book_tree import make_book_tree, image_formats
+
+all_stages = ["scan", "probe", "bookmarks", "toc", "read", "blank", "purify", "assembly", "build"]
+
+# Function to not print the progress of bookdir2pdf
+def quiet(*args):
+    pass
+
+# Function to get the git commit of bookdir2pdf.py (None if it is not in a git repository)
+def get_git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(BENCH_PATH),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Function to time a stage a few times, returns the timings (items is the number of pages/bookmarks it handled)
+def time_stage(stage_func, items, repeat):
+    runs = list()
+    for n in range(repeat):
+        start = time.perf_counter()
+        stage_func()
+        runs.append(time.perf_counter() - start)
+    runs_sorted = sorted(runs)
+    seconds_min = runs_sorted[0]
+    return {
+        "runs": runs,
+        "seconds_min": seconds_min,
+        "seconds_median": runs_sorted[len(runs_sorted) // 2],
+        "items": items,
+        "items_per_second": items / seconds_min if seconds_min > 0 else None
+        }
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+
+    ap = argparse.ArgumentParser(description="Time each stage of bookdir2pdf on a synthetic (or existing) book and write the results as JSON.")
+    ap.add_argument("-i", "--input_dir", type=str, default=None,
+        help="book directory to benchmark ( defaults to a synthetic book made with the options below )")
+    ap.add_argument("-o", "--output", type=str, default=None,
+        help="JSON file to write the results to ( defaults to printing them )")
+    ap.add_argument("-r", "--repeat", type=int, default=3,
+        help="number of times each stage is run, the fastest run is reported ( defaults to 3 )")
+    ap.add_argument("-S", "--stages", type=str, nargs="+", default=all_stages, choices=all_stages,
+        help="stages to run ( defaults to all )")
+    ap.add_argument("-e", "--engine", type=str, default="pillow", choices=["pillow", "numpy"],
+        help="purify engine ( defaults to pillow )")
+    ap.add_argument("-c", "--compression", type=str, default="flate", choices=["flate", "g4"],
+        help="purified page compression ( defaults to flate )")
+    ap.add_argument("-j", "--jobs", type=int, default=1,
+        help="worker processes used by the purify and build stages ( defaults to 1 )")
+    ap.add_argument("-n", "--pages", type=int, default=100,
+        help="synthetic book: number of pages ( defaults to 100 )")
+    ap.add_argument("-d", "--depth", type=int, default=2,
+        help="synthetic book: number of directory levels above the pages ( defaults to 2 )")
+    ap.add_argument("-b", "--branching", type=int, default=3,
+        help="synthetic book: number of subdirectories in each directory ( defaults to 3 )")
+    ap.add_argument("-s", "--size", type=str, default="850x1100",
+        help="synthetic book: page image size in pixels ( defaults to 850x1100 )")
+    ap.add_argument("-f", "--format", type=str, default="jpg", choices=list(image_formats.keys()),
+        help="synthetic book: page image file format ( defaults to jpg )")
+    ap.add_argument("-g", "--grey", action="store_true",
+        help="synthetic book: make greyscale pages instead of color")
+    ap.add_argument("--blank_ratio", type=float, default=0.05,
+        help="synthetic book: chance of a page being a .blank file ( defaults to 0.05 )")
+    ap.add_argument("--empty_ratio", type=float, default=0.1,
+        help="synthetic book: chance of an empty directory before each part ( defaults to 0.1 )")
+    ap.add_argument("--seed", type=int, default=0,
+        help="synthetic book: random seed ( defaults to 0 )")
+    args = vars(ap.parse_args())
+
+    if args["repeat"] < 1:
+        raise argparse.ArgumentTypeError("(--repeat | -r) must be at least 1.")
+    if args["jobs"] < 1:
+        raise argparse.ArgumentTypeError("(--jobs | -j) must be at least 1.")
+
+    # Progress goes to stderr, so the JSON can be piped
+    def log(*x):
+        print(*x, file=sys.stderr)
+
+    work_dir = tempfile.mkdtemp(prefix="bookdir2pdf_bench_")
+    purify_pool = None
+    try:
+        results = {
+            "bookdir2pdf_commit": get_git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": multiprocessing.cpu_count(),
+            "settings": {
+                "repeat": args["repeat"],
+                "engine": args["engine"],
+                "compression": args["compression"],
+                "jobs": args["jobs"]
+                },
+            "book": dict(),
+            "stages": dict()
+            }
+        try:
+            import PIL
+            results["pillow"] = PIL.__version__
+        except AttributeError:
+            results["pillow"] = None
+
+        # Get the book to benchmark
+        if args["input_dir"] != None:
+            input_dir = os.path.realpath(args["input_dir"])
+            results["book"]["input_dir"] = input_dir
+        else:
+            try:
+                width, height = [int(x) for x in args["size"].lower().split("x")]
+            except ValueError:
+                raise argparse.ArgumentTypeError("(--size | -s) must look like WIDTHxHEIGHT.")
+            input_dir = os.path.join(work_dir, "book")
+            log("Making synthetic book: {} pages, depth {}, {} {}x{}...".format(args["pages"], args["depth"], args["format"], width, height))
+            book_stats = make_book_tree(input_dir, pages=args["pages"], depth=args["depth"], branching=args["branching"],
+                width=width, height=height, image_format=args["format"], grey=args["grey"], blank_ratio=args["blank_ratio"],
+                empty_ratio=args["empty_ratio"], seed=args["seed"])
+            results["book"]["generator"] = {
+                "pages": args["pages"],
+                "depth": args["depth"],
+                "branching": args["branching"],
+                "size": [width, height],
+                "format": args["format"],
+                "grey": args["grey"],
+                "blank_ratio": args["blank_ratio"],
+                "empty_ratio": args["empty_ratio"],
+                "seed": args["seed"]
+                }
+            results["book"].update(book_stats)
+
+        output_file = os.path.join(work_dir, "book.pdf")
+        config = bookdir2pdf.BookConfig(input_dir, output_file=output_file, purify_engine=args["engine"], purify_jobs=args["jobs"])
+        purify_config = bookdir2pdf.BookConfig(input_dir, output_file=output_file, purify=True, purify_engine=args["engine"],
+            purify_compression=args["compression"], purify_jobs=args["jobs"])
+        book = bookdir2pdf.scan(config, log=quiet)
+        image_pages = [e.path for e in book.page_list if e.kind == "page"]
+        num_blank_pages = book.num_pages - book.num_image_pages
+        results["book"]["scanned_pages"] = book.num_pages
+        results["book"]["scanned_image_pages"] = book.num_image_pages
+        results["book"]["bookmarks"] = len(book.bookmarks)
+        log("Book: {} pages ( {} images ), {} bookmarks".format(book.num_pages, book.num_image_pages, len(book.bookmarks)))
+
+        if args["jobs"] > 1 and any([x in args["stages"] for x in ["purify", "build"]]):
+            purify_pool = multiprocessing.Pool(processes=args["jobs"], initializer=bookdir2pdf.purify_worker_init)
+
+        # The stages (each one only does its own work, as far as the library allows)
+        def stage_scan():
+            bookdir2pdf.scan_tree(input_dir)
+
+        def stage_probe():
+            bookdir2pdf.probe_pages(book, log=quiet)
+
+        def stage_bookmarks():
+            bookdir2pdf.make_bookmarks(book, log=quiet)
+
+        def stage_toc():
+            bookdir2pdf.make_table_of_contents(book)
+
+        def stage_read():
+            for p in image_pages:
+                bookdir2pdf.read_page_image(p, book.dpi)
+
+        def stage_blank():
+            pdf = bookdir2pdf.PdfStreamWriter(io.BytesIO())
+            for n in range(num_blank_pages):
+                pdf.add_blank_page(book.width * 72 / book.dpi, book.height * 72 / book.dpi)
+            pdf.close()
+
+        def stage_purify():
+            purify_tasks = [(p, 2, 170, book.dpi, None, args["engine"], args["compression"], None) for p in image_pages]
+            if purify_pool != None:
+                purify_pool.map(bookdir2pdf.purify_page, purify_tasks)
+            else:
+                list(map(bookdir2pdf.purify_page, purify_tasks))
+
+        def stage_assembly():
+            bookdir2pdf.build_pdf(book, log=quiet)
+
+        purify_book = bookdir2pdf.scan(purify_config, log=quiet)
+        def stage_build():
+            bookdir2pdf.build_pdf(purify_book, purify_pool=purify_pool, log=quiet)
+
+        stage_funcs = {
+            "scan": (stage_scan, book.num_pages),
+            "probe": (stage_probe, book.num_image_pages),
+            "bookmarks": (stage_bookmarks, len(book.bookmarks)),
+            "toc": (stage_toc, len(book.bookmarks)),
+            "read": (stage_read, book.num_image_pages),
+            "blank": (stage_blank, num_blank_pages),
+            "purify": (stage_purify, book.num_image_pages),
+            "assembly": (stage_assembly, book.num_pages),
+            "build": (stage_build, book.num_pages)
+            }
+        for stage in [x for x in all_stages if x in args["stages"]]:
+            stage_func, items = stage_funcs[stage]
+            log("Timing stage: {}...".format(stage))
+            results["stages"][stage] = time_stage(stage_func, items, args["repeat"])
+            log("\t{:.4f} seconds ( {} items )".format(results["stages"][stage]["seconds_min"], items))
+        if os.path.exists(output_file):
+            results["book"]["pdf_size"] = os.path.getsize(output_file)
+    finally:
+        if purify_pool != None:
+            purify_pool.terminate()
+            purify_pool.join()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    results_json = json.dumps(results, indent=2)
+    if args["output"] != None:
+        with open(args["output"], "w") as f:
+            f.write(results_json + "\n")
+        log("Results saved: {}".format(args["output"]))
+    else:
+        print(results_json)
@@ -3,7 +3,19 @@
 import argparse, os, sys
 from pathlib import Path
 import re
-import atexit
+import multiprocessing
+import signal
+import io
+import struct
+import zlib
+import hashlib
+import json
+import collections
+import time
+import threading
+import zipfile
+import tarfile
+import errno
 
 # Test if this is a PyInstaller executable or a .py file
 if getattr(sys, 'frozen', False):
@@ -22,132 +34,995 @@ PROG_FILE_NAME = os.path.splitext(os.path.basename(PROG_FILE))[0]
 # Get path that the command was called from
 COMMAND_PATH = Path().absolute()
 
-# Setup exit handler (used for cleanup)
-job_complete = None
-exit_funcs = list()
-def exit_handler():
-    global job_complete
-    if len(exit_funcs) > 0:
-        print()
-        print("-------- CLEANUP --------")
-        for f in exit_funcs:
-            f()
-    if job_complete != None: # defined at the very end only
-        job_complete()
-atexit.register(exit_handler)
-
-# Parse arguments before running main program
-def dir_path(string):
-    if os.path.isdir(string):
-        return string
+# Function to purify a single page into an embeddable PDF image, kept in memory (runs inside worker processes)
+# Returns the image and whether it came from the purify cache, data is the page file contents if they were already read
+def purify_page(purify_task, data=None):
+    from PIL import Image, ImageEnhance
+
+    p, sharpen_factor, thresh_setting, pdf_dpi, cache_dir, engine, compression, max_dpi = purify_task
+    if data == None:
+        data = read_file(p)
+
+    # Try to get the purified page from the cache
+    if cache_dir != None:
+        cache_key = get_purify_cache_key(data, sharpen_factor, thresh_setting, pdf_dpi, compression, max_dpi)
+        cache_file = os.path.join(cache_dir, cache_key[:2], cache_key + purify_cache_ext)
+        pdf_image = read_purify_cache(cache_file)
+        if pdf_image != None:
+            pdf_image["cache_file"] = cache_file
+            return pdf_image, True
+
+    with Image.open(io.BytesIO(data)) as page_im:
+        rotate = get_exif_rotation(page_im)
+
+        # Shrink pages above the maximum DPI first (JPEG pages are decoded straight to a small greyscale image)
+        page_im, pdf_dpi = downsample_image(page_im, pdf_dpi, max_dpi, mode="L")
+
+        if engine == "numpy":
+            # Same steps in one pass (bit-identical output)
+            final_page_im = purify_image_numpy(page_im, sharpen_factor, thresh_setting)
+        else:
+            # Make greyscale
+            gray = page_im.convert('L')
+
+            # Sharpen
+            enhancer = ImageEnhance.Sharpness(gray)
+            sharpen = enhancer.enhance(sharpen_factor)
+
+            # Apply threshold
+            thresh = sharpen.point(lambda p: p > thresh_setting and 255)
+
+            # Make 1 bit
+            final_page_im = thresh.convert('1')
+
+    # Compress image
+    if compression == "g4":
+        pdf_image = pil_to_g4_pdf_image(final_page_im)
     else:
-        raise NotADirectoryError(string)
-
-#TODO: Add usage examples
-ap = argparse.ArgumentParser(description="Merge nested image directory into PDF with nested bookmarks.")
-ap.add_argument("-i", "--input_dir", type=dir_path, required=True,
-    help="path to nested image directory to merge")
-ap.add_argument("-o", "--output_file", type=str, default=None,
-    help="output file path ( defaults to [input_dir].pdf )")
-ap.add_argument("-s", "--order_number_separator", type=str, default=None,
-    help="the character used to separate the directory ordering numbers from the bookmark names ( like '.' or ')' )")
-ap.add_argument("-n", "--no_pdf", action="store_true",
-    help="just scan directory and print table of contents")
-ap.add_argument("-p", "--purify", action="store", default=None, nargs="*", type=str, 
-    help="purify scanned B&W page ( greyscale, sharpen, threshold ), named sub-arguments: (sharpen|s) (threshold|t)")
-ap.add_argument("-d", "--dpi", type=int, default=None,
-    help="dots-per-inch of the input images")
-ap.add_argument("-t", "--title", type=str, default=None,
-    help="the PDF title ( defaults to the directory basename )")
-ap.add_argument("-a", "--author", type=str, default=None,
-    help="the PDF author")
-ap.add_argument("-f", "--table_of_contents_format", action="store", default=None, nargs="*", type=str, 
-    help="formatting options for the table of contents, named sub-arguments: (break_limit|b) (number_prefix|p) (number_postfix|a) (indent|i)")
-args = vars(ap.parse_args())
-
-print()
-
-# Resolve input dir into absolute path (relative to working directory!)
-input_dir = args["input_dir"]
-input_dir = os.path.realpath(input_dir)
-if not os.path.isabs(input_dir):
-    input_dir_split = input_dir.split(os.path.sep)
-    if input_dir_split[0] == os.path.curdir:
-        input_dir = os.path.sep.join(input_dir_split[1:])
-    input_dir = os.path.join(COMMAND_PATH, input_dir)
-
-input_dir_name = input_dir.strip(os.path.sep).split(os.path.sep)[-1]
-
-# Get main directory
-main_dir = os.path.sep.join(input_dir.rstrip(os.path.sep).split(os.path.sep)[:-1])
-
-# Test if/which purify flavor is being used
-if args["purify"] != None:
-    purify = True
-    purify_args = args["purify"]
-else:
-    purify = False
-    purify_args = ()
-
-# Do not purify if --no_pdf is set
-if args["no_pdf"]:
-    purify = False
-
-# Parse purify sub-arguments (values)
-if purify:
-    # Defaults
-    sharpen_factor = 2
-    thresh_setting = 170
-    
-    for p_arg in purify_args:
-        p_arg_split = p_arg.split("=")
-        
-        # Only allow [string]=[string]
-        if len(p_arg_split) != 2:
-            raise argparse.ArgumentTypeError("Invalid argument format. Use arg_name=arg_value.")
+        pdf_image = pil_to_pdf_image(final_page_im)
+    pdf_image["rotate"] = rotate
+    pdf_image["dpi"] = pdf_dpi
 
-        # Get name and value separately
-        p_arg_name, p_arg_value = [x.lower().strip() for x in p_arg_split]
+    if cache_dir != None and write_purify_cache(cache_file, pdf_image):
+        pdf_image["cache_file"] = cache_file
+    return pdf_image, False
 
-        # Parse purify named sub-arguments
-        if p_arg_name in ["sharpen", "s"]:
-            # Test if it's a float and set
-            worked = True
-            try:
-                sharpen_factor = float(p_arg_value)
-            except(ValueError):
-                worked = False
-            
-            # Test if it's greater than 0
-            if sharpen_factor <= 0:
-                worked = False
-            
-            if not worked:
-                raise argparse.ArgumentTypeError("(--purify | -p) sharpness must be a float greater than 0.")
-        elif p_arg_name in ["threshold", "t"]:
-            # Test if it's a float and set
-            worked = True
+# Function to sharpen and threshold a greyscale image in one vectorized pass with NumPy
+# Gives the same 1 bit image as ImageEnhance.Sharpness, point(), and convert('1') in Pillow:
+#   - Sharpness blends from the SMOOTH filter (3x3 kernel, 5 in the center, divided by 13, rounded, edge pixels kept)
+#     to the original, in 32 bit floats truncated to 8 bits
+#   - For every possible smoothed value (0-255) there is a lowest original value that still ends up white,
+#     so the blend and threshold become one table lookup on the 3x3 sum and one comparison
+# Works on strips of rows with buffers allocated once per page, so a 600 DPI page never needs full size temporary images
+def purify_image_numpy(im, sharpen_factor, thresh_setting, strip_height=128):
+    import numpy as np
+    from PIL import Image
+
+    # Greyscale is already a single pass in Pillow
+    if im.mode != "L":
+        im = im.convert("L")
+    grey = np.asarray(im)
+    height, width = grey.shape
+    packed = np.empty((height, (width + 7) // 8), dtype=np.uint8)
+
+    # Nothing is above a threshold of 255
+    if thresh_setting >= 255:
+        packed.fill(0)
+        return Image.frombytes("1", (width, height), packed.tobytes())
+    thresh_min = int(thresh_setting) + 1 # Smallest 8 bit value that is above the threshold
+
+    # Lowest original value that is white for each smoothed value (blended like Image.blend)
+    smooth_values = np.arange(256, dtype=np.float32)
+    blend = smooth_values[:, None] + np.float32(sharpen_factor) * (smooth_values[None, :] - smooth_values[:, None])
+    min_white = (256 - np.count_nonzero(blend >= thresh_min, axis=1)).astype(np.int16)
+
+    # Same, but for each weighted 3x3 sum (the smoothed value is the sum / 13, rounded)
+    kernel_sums = np.arange(13 * 255 + 1)
+    min_white_by_sum = min_white[(kernel_sums * 2 + 13) // 26]
+
+    # Buffers for a strip and the rows just above and below it
+    max_rows = min(strip_height, height) + 2
+    inner_width = max(width - 2, 0)
+    row_sums = np.empty((max_rows, inner_width), dtype=np.int16)
+    sums = np.empty((max_rows, inner_width), dtype=np.int16)
+    centers = np.empty((max_rows, inner_width), dtype=np.int16)
+    white = np.empty((max_rows, width), dtype=bool)
+
+    # Pillow can't filter images smaller than 3x3
+    smooth = width >= 3 and height >= 3
+
+    for y0 in range(0, height, strip_height):
+        y1 = min(y0 + strip_height, height)
+        g0 = max(y0 - 1, 0)
+        g1 = min(y1 + 1, height)
+        rows = g1 - g0
+        g = grey[g0:g1]
+        w = white[:rows]
+
+        # Edge pixels are not smoothed
+        np.greater_equal(g, thresh_min, out=w)
+
+        if smooth:
+            # Weighted 3x3 sum (box sum plus 4 more times the center)
+            r = row_sums[:rows]
+            np.add(g[:, :-2], g[:, 1:-1], out=r, dtype=np.int16)
+            r += g[:, 2:]
+            s = sums[:rows - 2]
+            np.add(r[:-2], r[1:-1], out=s)
+            s += r[2:]
+            c = centers[:rows - 2]
+            np.left_shift(g[1:-1, 1:-1], 2, out=c, dtype=np.int16)
+            s += c
+
+            # Threshold against the lowest white value for the sum
+            np.take(min_white_by_sum, s, out=c)
+            np.greater_equal(g[1:-1, 1:-1], c, out=w[1:-1, 1:-1])
+
+        # Only keep the strip rows (not the neighbor rows)
+        packed[y0:y1] = np.packbits(w[y0 - g0:y1 - g0], axis=1)
+
+    return Image.frombytes("1", (width, height), packed.tobytes())
+
+# Let the main process handle CTRL-C, workers just get terminated
+def purify_worker_init():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+# Function to run in each batch worker process, the main process stops it (with SIGTERM) on CTRL-C
+# Stopping it like an exit lets the unfinished book delete its temporary files
+def batch_worker_init():
+    purify_worker_init()
+    signal.signal(signal.SIGTERM, batch_worker_stop)
+
+def batch_worker_stop(signum, frame):
+    sys.exit(1)
+
+# Function to estimate the most memory purifying a page will use (decoded image plus the greyscale working copies)
+# Uses the page's probe (from probe_page) if given, instead of opening it again
+def estimate_purify_memory(page_file, probe=None, archive=None):
+    from PIL import Image
+
+    if probe != None and probe["error"] == None:
+        return probe["width"] * probe["height"] * (Image.getmodebands(probe["mode"]) + 4)
+    try:
+        with open_file(page_file, archive) as f, Image.open(f) as im:
+            return im.size[0] * im.size[1] * (len(im.getbands()) + 4)
+    except Exception:
+        return stat_file(page_file, archive).st_size
+
+# Function like Pool.imap, but only keeps as many tasks in flight as fit in max_size (using the given task sizes)
+# At least one task is always in flight, so a task bigger than max_size still runs (alone)
+# tasks can be a generator, it is only advanced when a task is started
+def bounded_imap(pool, func, tasks, task_sizes, max_size):
+    pending = collections.deque()
+    in_flight_size = 0
+    task_iter = zip(tasks, task_sizes)
+    next_task = next(task_iter, None)
+    while next_task != None or len(pending) > 0:
+        while next_task != None and (len(pending) <= 0 or in_flight_size + next_task[1] <= max_size):
+            pending.append((pool.apply_async(func, (next_task[0],)), next_task[1]))
+            in_flight_size += next_task[1]
+            next_task = next(task_iter, None)
+        result, result_size = pending.popleft()
+        in_flight_size -= result_size
+        yield result.get()
+
+# Function to call func(*args), so a pool can run functions that take more than one argument
+def star_call(func_args):
+    func, args = func_args
+    return func(*args)
+
+# Function to read a whole file into memory (or a file inside archive, the BookArchive of a book made from one)
+def read_file(file_path, archive=None):
+    if archive != None:
+        return archive.read(file_path)
+    with open(file_path, "rb") as f:
+        return f.read()
+
+# Function to open a file for reading in binary mode (or a file inside archive)
+def open_file(file_path, archive=None):
+    if archive != None:
+        return archive.open(file_path)
+    return open(file_path, "rb")
+
+# Function to get the size and modification time of a file (files inside archive get the archive's modification time)
+def stat_file(file_path, archive=None):
+    if archive != None:
+        return archive.stat(file_path)
+    return os.stat(file_path)
+
+# Function to make a file show up at another path without copying its bytes, if the file system can do that
+# Tries a hardlink, then a reflink (a copy on write clone, Linux only), then a symlink (if allowed), and only then copies the bytes
+# dst is replaced atomically if it exists, returns how the file was placed ("hardlink", "reflink", "symlink", or "copy")
+def link_file(src, dst, symlink=True):
+    import shutil
+
+    src = os.path.abspath(src)
+    temp_dst = "{}.{}.tmp".format(dst, os.getpid())
+    try:
+        method = None
+        try:
+            os.link(src, temp_dst)
+            method = "hardlink"
+        except (OSError, AttributeError, NotImplementedError):
+            pass
+        if method == None and clone_file(src, temp_dst):
+            method = "reflink"
+        if method == None and symlink:
             try:
-                thresh_setting = float(p_arg_value)
-            except(ValueError):
-                worked = False
-            
-            # Test if it's positive
-            if thresh_setting < 0:
-                worked = False
-            
-            # Test if it's <= 255
-            if thresh_setting > 255:
-                worked = False
-            
-            if not worked:
-                raise argparse.ArgumentTypeError("(--purify | -p) threshold must be a positive float <= 255.")
+                os.symlink(src, temp_dst)
+                method = "symlink"
+            except (OSError, AttributeError, NotImplementedError):
+                pass
+        if method == None:
+            shutil.copyfile(src, temp_dst)
+            method = "copy"
+        os.replace(temp_dst, dst)
+        # Renaming onto a hardlink of the same file does nothing, so the temporary link may still be there
+        if os.path.lexists(temp_dst):
+            os.remove(temp_dst)
+    except BaseException:
+        if os.path.lexists(temp_dst):
+            os.remove(temp_dst)
+        raise
+    return method
+
+# Function to clone a file with a reflink (both files share their blocks until one changes), returns False if it can't be done
+# Only works on Linux, on file systems with copy on write (Btrfs, XFS, ...), and inside one file system
+def clone_file(src, dst):
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    FICLONE = 0x40049409 # _IOW(0x94, 9, int) from linux/fs.h
+    try:
+        with open(src, "rb") as src_f:
+            with open(dst, "wb") as dst_f:
+                fcntl.ioctl(dst_f.fileno(), FICLONE, src_f.fileno())
+    except OSError:
+        if os.path.exists(dst):
+            os.remove(dst)
+        return False
+    return True
+
+# Function to move a file, also to another file system (then it is cloned or copied next to dst first, so dst is never partial)
+# Returns how the file was moved ("rename", "reflink", or "copy")
+def move_file(src, dst):
+    try:
+        os.replace(src, dst)
+        return "rename"
+    except OSError as ex:
+        if ex.errno != errno.EXDEV:
+            raise
+    method = link_file(src, dst, symlink=False)
+    os.remove(src)
+    return method
+
+# Function like map, but runs func on up to depth upcoming items at once in threads (the results still come in order)
+# Used to read pages ahead, so slow storage (like a network drive) is waited on while earlier pages are processed
+# At most depth results wait to be used, a depth of 0 runs everything in this thread
+# With item_sizes, the result being used and the ones waiting also fit in max_size (an item that doesn't fit is only started once nothing else is left)
+def prefetch_map(func, items, depth, item_sizes=None, max_size=None):
+    import concurrent.futures
+    import itertools
+
+    if depth <= 0:
+        yield from map(func, items)
+        return
+    pending = collections.deque()
+    pending_size = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=depth) as executor:
+        try:
+            for item, item_size in zip(items, item_sizes if item_sizes != None else itertools.repeat(0)):
+                # Use the oldest results until the next item fits
+                while max_size != None and len(pending) > 0 and pending_size + item_size > max_size:
+                    future, future_size = pending.popleft()
+                    pending_size -= future_size
+                    yield future.result()
+                pending.append((executor.submit(func, item), item_size))
+                pending_size += item_size
+                if len(pending) > depth:
+                    future, future_size = pending.popleft()
+                    pending_size -= future_size
+                    yield future.result()
+            while len(pending) > 0:
+                yield pending.popleft()[0].result()
+        finally:
+            # Don't start reads nobody will use (the running ones finish before the threads stop)
+            for future, future_size in pending:
+                future.cancel()
+
+# Purify cache format version (change it whenever purified output changes) and file extention
+purify_cache_version = 1
+purify_cache_ext = ".page"
+
+# Function to get the purify cache key of a page (hash of source file contents and purify settings)
+def get_purify_cache_key(data, sharpen_factor, thresh_setting, pdf_dpi, compression="flate", max_dpi=None):
+    cache_hash = hashlib.sha256(data)
+    cache_hash.update("|{}|{}|{}|{}".format(purify_cache_version, float(sharpen_factor), float(thresh_setting), pdf_dpi).encode("utf-8"))
+    # Pages with the default settings keep the keys they had before there was a choice
+    if compression != "flate":
+        cache_hash.update("|{}".format(compression).encode("utf-8"))
+    if max_dpi != None and max_dpi < pdf_dpi:
+        cache_hash.update("|max_dpi={}".format(max_dpi).encode("utf-8"))
+    return cache_hash.hexdigest()
+
+# Function to read a purified page from the cache (returns None if it isn't cached)
+def read_purify_cache(cache_file):
+    try:
+        with open(cache_file, "rb") as f:
+            pdf_image = json.loads(f.readline().decode("utf-8"))
+            pdf_image["data"] = f.read()
+    except (OSError, ValueError):
+        return None
+    if len(pdf_image["data"]) != pdf_image.pop("length", -1):
+        return None
+
+    # Mark as recently used
+    try:
+        os.utime(cache_file)
+    except OSError:
+        pass
+    return pdf_image
+
+# Function to save a purified page to the cache (atomic, so parallel workers never see partial files)
+# Returns whether it was saved
+def write_purify_cache(cache_file, pdf_image):
+    pdf_image_info = {k: v for k, v in pdf_image.items() if k not in ["data", "cache_file"]}
+    pdf_image_info["length"] = len(pdf_image["data"])
+    temp_cache_file = "{}.{}.tmp".format(cache_file, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with open(temp_cache_file, "wb") as f:
+            f.write(json.dumps(pdf_image_info).encode("utf-8") + b"\n")
+            f.write(pdf_image["data"])
+        os.replace(temp_cache_file, cache_file)
+    except OSError:
+        # The cache is optional, just keep going
+        if os.path.exists(temp_cache_file):
+            os.remove(temp_cache_file)
+        return False
+    return True
+
+# Function to delete the least recently used purified pages until the cache fits in max_size bytes
+# Returns the number of deleted pages and bytes
+def trim_purify_cache(cache_dir, max_size):
+    cache_files = list()
+    for cache_subdir in os.scandir(cache_dir):
+        if cache_subdir.is_dir():
+            for x in os.scandir(cache_subdir.path):
+                if x.name.endswith(purify_cache_ext) and x.is_file():
+                    x_stat = x.stat()
+                    cache_files.append((x_stat.st_mtime, x_stat.st_size, x.path))
+    cache_files.sort()
+
+    cache_size = sum([x[1] for x in cache_files])
+    num_removed = 0
+    size_removed = 0
+    for x_mtime, x_size, x_path in cache_files:
+        if cache_size <= max_size:
+            break
+        try:
+            os.remove(x_path)
+        except OSError:
+            continue
+        cache_size -= x_size
+        num_removed += 1
+        size_removed += x_size
+    return num_removed, size_removed
+
+# Function to find what can linearize PDFs: "pikepdf" if it is installed, "qpdf" if the qpdf command line tool is, otherwise None
+def get_linearize_tool():
+    import shutil
+
+    try:
+        import pikepdf
+        return "pikepdf"
+    except ImportError:
+        pass
+    if shutil.which("qpdf") != None:
+        return "qpdf"
+    return None
+
+# Function to write a linearized copy of a finished PDF (fast web view), so viewers can show the first page before the rest arrives
+# qpdf (also inside pikepdf) puts the first page's objects and the hint tables first, the outline and metadata stay as they are
+# Image data is copied as it is, never decoded
+def linearize_pdf(pdf_file, linear_file):
+    tool = get_linearize_tool()
+    if tool == "pikepdf":
+        import pikepdf
+
+        with pikepdf.open(pdf_file) as pdf:
+            pdf.save(linear_file, linearize=True, compress_streams=False, stream_decode_level=pikepdf.StreamDecodeLevel.none)
+    elif tool == "qpdf":
+        import subprocess
+
+        # Exit code 3 means it worked, with warnings
+        result = subprocess.run(["qpdf", "--linearize", "--stream-data=preserve", pdf_file, linear_file],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if result.returncode not in [0, 3]:
+            raise RuntimeError("qpdf could not linearize the PDF: {}".format(result.stderr.decode("utf-8", "replace").strip()))
+    else:
+        raise RuntimeError("Linearizing needs pikepdf or the qpdf command line tool to be installed.")
+
+# Function to turn a string into a PDF text string (UTF-16BE hex, allows any character)
+def pdf_text_string(s):
+    return "<FEFF{}>".format(s.encode("utf-16-be").hex().upper())
+
+# Function to turn a number into a PDF number
+def pdf_number(n):
+    if isinstance(n, int):
+        return str(n)
+    return "{:.4f}".format(n).rstrip("0").rstrip(".")
+
+# Function to get the PDF page rotation from the EXIF orientation of an image
+def get_exif_rotation(im):
+    try:
+        orientation = im.getexif().get(0x0112)
+    except Exception:
+        return 0
+    return {3: 180, 6: 90, 8: 270}.get(orientation, 0)
+
+# Function to read a PNG file's compressed image data without decoding it
+# Returns None if it can't be embedded as-is (interlaced, alpha channel, transparency)
+def read_png_image(data):
+    if data[:8] != b"\x89PNG\r\n\x1a\n":
+        return None
+
+    ihdr = None
+    palette = b""
+    idat_list = list()
+    pos = 8
+    while pos + 8 <= len(data):
+        chunk_length, chunk_type = struct.unpack(">I4s", data[pos:pos + 8])
+        chunk = data[pos + 8:pos + 8 + chunk_length]
+        pos += chunk_length + 12
+        if chunk_type == b"IHDR":
+            ihdr = struct.unpack(">IIBBBBB", chunk)
+        elif chunk_type == b"PLTE":
+            palette = chunk
+        elif chunk_type == b"tRNS":
+            return None
+        elif chunk_type == b"IDAT":
+            idat_list.append(chunk)
+        elif chunk_type == b"IEND":
+            break
+    if ihdr == None:
+        return None
+
+    width, height, bit_depth, color_type, _, _, interlace = ihdr
+    if interlace != 0:
+        return None
+    if color_type == 0:
+        colorspace = "/DeviceGray"
+        colors = 1
+    elif color_type == 2:
+        colorspace = "/DeviceRGB"
+        colors = 3
+    elif color_type == 3 and len(palette) >= 3:
+        colorspace = "[/Indexed /DeviceRGB {} <{}>]".format(len(palette) // 3 - 1, palette.hex().upper())
+        colors = 1
+    else:
+        return None
+
+    return {
+        "width": width,
+        "height": height,
+        "colorspace": colorspace,
+        "bpc": bit_depth,
+        "filter": "/FlateDecode",
+        "decode_parms": "<< /Predictor 15 /Colors {} /BitsPerComponent {} /Columns {} >>".format(colors, bit_depth, width),
+        "decode": None,
+        "data": b"".join(idat_list)
+        }
+
+# Function to compress a decoded Pillow image into an embeddable PDF image
+def pil_to_pdf_image(im):
+    from PIL import Image
+
+    # Remove transparency (pages are put on a white background)
+    if im.mode in ["RGBA", "LA", "PA"] or (im.mode == "P" and "transparency" in im.info):
+        im = im.convert("RGBA")
+        background = Image.new("RGB", im.size, "white")
+        background.paste(im, mask=im.getchannel("A"))
+        im = background
+
+    if im.mode == "1":
+        colorspace = "/DeviceGray"
+        bpc = 1
+    elif im.mode == "L":
+        colorspace = "/DeviceGray"
+        bpc = 8
+    elif im.mode == "P":
+        palette = bytes(im.getpalette()[:768])
+        colorspace = "[/Indexed /DeviceRGB {} <{}>]".format(len(palette) // 3 - 1, palette.hex().upper())
+        bpc = 8
+    elif im.mode == "CMYK":
+        colorspace = "/DeviceCMYK"
+        bpc = 8
+    else:
+        im = im.convert("RGB")
+        colorspace = "/DeviceRGB"
+        bpc = 8
+
+    return {
+        "width": im.size[0],
+        "height": im.size[1],
+        "colorspace": colorspace,
+        "bpc": bpc,
+        "filter": "/FlateDecode",
+        "decode_parms": None,
+        "decode": None,
+        "data": zlib.compress(im.tobytes())
+        }
+
+# Function to encode a 1 bit image as a CCITT Group 4 embeddable PDF image (needs Pillow built with libtiff)
+# Much smaller than Flate for scanned text, the G4 data is taken straight out of a one strip TIFF
+def pil_to_g4_pdf_image(im):
+    from PIL import Image
+
+    if im.mode != "1":
+        im = im.convert("1")
+    width, height = im.size
+
+    tiff_file = io.BytesIO()
+    im.save(tiff_file, format="TIFF", compression="group4", tiffinfo={278: height}) # RowsPerStrip
+    tiff_file.seek(0)
+    with Image.open(tiff_file) as tiff_im:
+        strip_offsets = tiff_im.tag_v2[273]
+        strip_byte_counts = tiff_im.tag_v2[279]
+        photometric = tiff_im.tag_v2.get(262, 0)
+    if len(strip_offsets) != 1:
+        raise ValueError("Expected a single G4 strip, got {}.".format(len(strip_offsets)))
+    tiff_data = tiff_file.getvalue()
+
+    # G4 codes 0 bits as white, which is black in Pillow's 1 bit images (BlackIsZero)
+    return {
+        "width": width,
+        "height": height,
+        "colorspace": "/DeviceGray",
+        "bpc": 1,
+        "filter": "/CCITTFaxDecode",
+        "decode_parms": "<< /K -1 /Columns {} /Rows {} /BlackIs1 {} >>".format(width, height, "true" if photometric == 1 else "false"),
+        "decode": None,
+        "data": tiff_data[strip_offsets[0]:strip_offsets[0] + strip_byte_counts[0]]
+        }
+
+# Function to make the JPEG data of an opened image into an embeddable PDF image without decoding it
+# Returns None if it can't be embedded as-is (not a JPEG, or an unusual mode)
+def read_jpeg_image(im, data):
+    if im.format != "JPEG" or im.mode not in ["L", "RGB", "CMYK"]:
+        return None
+    if im.mode == "L":
+        colorspace = "/DeviceGray"
+    elif im.mode == "RGB":
+        colorspace = "/DeviceRGB"
+    else:
+        colorspace = "/DeviceCMYK"
+    pdf_image = {
+        "width": im.size[0],
+        "height": im.size[1],
+        "colorspace": colorspace,
+        "bpc": 8,
+        "filter": "/DCTDecode",
+        "decode_parms": None,
+        "decode": None,
+        "data": data
+        }
+    # Adobe CMYK JPEGs are stored inverted
+    if im.mode == "CMYK" and "adobe" in im.info:
+        pdf_image["decode"] = "[1 0 1 0 1 0 1 0]"
+    return pdf_image
+
+# Function to shrink an opened page image down to max_dpi, returns the image and its new DPI
+# JPEG pages are decoded at a reduced size (draft mode) first, so pixels that would be thrown away are never decoded
+# Images that are not above max_dpi are returned as they are, mode is the mode to decode into (like "L" to purify)
+def downsample_image(im, dpi, max_dpi, mode=None):
+    from PIL import Image
+
+    if max_dpi == None or dpi <= max_dpi:
+        return im, dpi
+    width = max(1, int(round(im.size[0] * max_dpi / dpi)))
+    height = max(1, int(round(im.size[1] * max_dpi / dpi)))
+    if im.format == "JPEG":
+        im.draft(mode if mode != None else im.mode, (width, height))
+
+    if mode != None:
+        im = im.convert(mode)
+    elif im.mode in ["RGBA", "LA", "PA"] or (im.mode == "P" and "transparency" in im.info):
+        im = im.convert("RGBA")
+    elif im.mode in ["1", "P"]:
+        # Resample in grey/color (1 bit and palette images can only be resized with nearest neighbor)
+        im = im.convert("L" if im.mode == "1" else "RGB")
+    return im.resize((width, height), Image.LANCZOS), max_dpi
+
+# Function to read a page image file into an embeddable PDF image (JPEG and most PNG data is passed through)
+# Pages above max_dpi (if given) are downsampled, JPEG pages stay JPEG, data is the file contents if they were already read
+def read_page_image(page_file, dpi, max_dpi=None, data=None):
+    from PIL import Image
+
+    if data == None:
+        data = read_file(page_file)
+
+    with Image.open(io.BytesIO(data)) as im:
+        rotate = get_exif_rotation(im)
+        if max_dpi != None and dpi > max_dpi:
+            small_im, dpi = downsample_image(im, dpi, max_dpi)
+            pdf_image = None
+            if im.format == "JPEG" and small_im.mode in ["L", "RGB", "CMYK"]:
+                # Compress it as a JPEG again
+                jpeg_file = io.BytesIO()
+                small_im.save(jpeg_file, format="JPEG", quality=90)
+                jpeg_file.seek(0)
+                with Image.open(jpeg_file) as jpeg_im:
+                    pdf_image = read_jpeg_image(jpeg_im, jpeg_file.getvalue())
+            if pdf_image == None:
+                pdf_image = pil_to_pdf_image(small_im)
         else:
-            raise argparse.ArgumentTypeError("'{}' is not a valid option for (--purify | -p).".format(p_arg_name))
+            pdf_image = read_jpeg_image(im, data)
+            if pdf_image == None and im.format == "PNG":
+                pdf_image = read_png_image(data)
+
+            if pdf_image == None:
+                # Decode and recompress everything else
+                pdf_image = pil_to_pdf_image(im)
+
+        pdf_image["rotate"] = rotate
+
+    pdf_image["dpi"] = dpi
+    return pdf_image
+
+# Minimal PDF writer that streams every page straight to the output file
+# Only the object offsets and bookmarks are kept in memory until close()
+# A fragment (pages_id given) only has page objects, numbered from first_id, to be added to another writer with add_fragment()
+# With dedup_images, an image that is exactly the same as an earlier one is not written again, the pages share it
+class PdfStreamWriter:
+    # Number of objects each kind of page uses (so the object numbers of a fragment can be worked out before it is written)
+    image_page_objects = 3
+    blank_page_objects = 1
+
+    def __init__(self, f, first_id=1, pages_id=None, dedup_images=False):
+        self.f = f
+        self.first_id = first_id
+        self.obj_offsets = list()
+        self.page_ids = list()
+        self.bookmarks = list()
+        self.finished = False
+        self.image_ids = dict() if dedup_images else None # Image object numbers, by hash of the image
+        self.dedup_pages = 0 # Pages that use an earlier image
+        self.dedup_bytes = 0 # Image data that did not have to be written again
+
+        if pages_id == None:
+            self.f.write(b"%PDF-1.5\n%\xe2\xe3\xcf\xd3\n")
+            self.pages_id = self.new_id()
+        else:
+            self.pages_id = pages_id
+
+    # Reserve an object number
+    def new_id(self):
+        self.obj_offsets.append(None)
+        return self.first_id + len(self.obj_offsets) - 1
+
+    # Write a dictionary object (or stream object if stream data is given)
+    def write_object(self, obj_id, obj_dict, stream=None):
+        self.obj_offsets[obj_id - self.first_id] = self.f.tell()
+        if stream == None:
+            self.f.write("{} 0 obj\n<< {} >>\nendobj\n".format(obj_id, obj_dict).encode("latin-1"))
+        else:
+            self.f.write("{} 0 obj\n<< {} /Length {} >>\nstream\n".format(obj_id, obj_dict, len(stream)).encode("latin-1"))
+            self.f.write(stream)
+            self.f.write(b"\nendstream\nendobj\n")
+
+    # Write a page showing a single image (from read_page_image), sized using the image DPI
+    def add_image_page(self, pdf_image):
+        image_dict = "/Type /XObject /Subtype /Image /Width {} /Height {} /ColorSpace {} /BitsPerComponent {} /Filter {}".format(
+            pdf_image["width"], pdf_image["height"], pdf_image["colorspace"], pdf_image["bpc"], pdf_image["filter"])
+        if pdf_image["decode_parms"] != None:
+            image_dict += " /DecodeParms {}".format(pdf_image["decode_parms"])
+        if pdf_image["decode"] != None:
+            image_dict += " /Decode {}".format(pdf_image["decode"])
+
+        # Pages with the same image (same data and image settings) share one image object
+        image_key = None
+        new_image = True
+        if self.image_ids != None:
+            image_hash = hashlib.sha256(image_dict.encode("latin-1"))
+            image_hash.update(pdf_image["data"])
+            image_key = image_hash.digest()
+            new_image = image_key not in self.image_ids
+        if new_image:
+            image_id = self.new_id()
+        else:
+            image_id = self.image_ids[image_key]
+            self.dedup_pages += 1
+            self.dedup_bytes += len(pdf_image["data"])
+        contents_id = self.new_id()
+        page_id = self.new_id()
+
+        if new_image:
+            self.write_object(image_id, image_dict, pdf_image["data"])
+            if image_key != None:
+                self.image_ids[image_key] = image_id
+
+        page_width = pdf_number(pdf_image["width"] * 72 / pdf_image["dpi"])
+        page_height = pdf_number(pdf_image["height"] * 72 / pdf_image["dpi"])
+        contents = "q {} 0 0 {} 0 0 cm /Im0 Do Q".format(page_width, page_height).encode("latin-1")
+        self.write_object(contents_id, "", contents)
+
+        page_dict = "/Type /Page /Parent {} 0 R /MediaBox [0 0 {} {}] /Resources << /XObject << /Im0 {} 0 R >> >> /Contents {} 0 R".format(
+            self.pages_id, page_width, page_height, image_id, contents_id)
+        if pdf_image.get("rotate", 0) != 0:
+            page_dict += " /Rotate {}".format(pdf_image["rotate"])
+        self.write_object(page_id, page_dict)
+
+        self.page_ids.append(page_id)
+
+    # Write a page with no contents at all (page size in points)
+    def add_blank_page(self, page_width, page_height):
+        page_id = self.new_id()
+        self.write_object(page_id, "/Type /Page /Parent {} 0 R /MediaBox [0 0 {} {}] /Resources << >>".format(
+            self.pages_id, pdf_number(page_width), pdf_number(page_height)))
+        self.page_ids.append(page_id)
+
+    # Copy the pages of a fragment file into the PDF (first_id must be the next object number of this writer)
+    # obj_offsets and page_ids are the fragment writer's
+    def add_fragment(self, fragment_file, first_id, obj_offsets, page_ids):
+        import shutil
+
+        if first_id != self.first_id + len(self.obj_offsets):
+            raise ValueError("PDF fragment starts at object {}, but the next object is {}".format(first_id, self.first_id + len(self.obj_offsets)))
+        fragment_offset = self.f.tell()
+        with open(fragment_file, "rb") as f:
+            shutil.copyfileobj(f, self.f, 1024 * 1024)
+        self.obj_offsets += [fragment_offset + x for x in obj_offsets]
+        self.page_ids += page_ids
+
+    # Add a bookmark to a page (by index), returns the bookmark to use as a parent
+    def add_bookmark(self, title, page_index, parent=None):
+        self.bookmarks.append({
+            "title": title,
+            "page": page_index,
+            "parent": parent,
+            "children": list()
+            })
+        bm = len(self.bookmarks) - 1
+        if parent != None:
+            self.bookmarks[parent]["children"].append(bm)
+        return bm
+
+    # Write the outline, page tree, metadata, and cross-reference table
+    def close(self, metadata=dict()):
+        catalog_dict = "/Type /Catalog /Pages {} 0 R".format(self.pages_id)
+
+        # Write bookmarks (all are open, so every bookmark is counted)
+        if len(self.bookmarks) > 0:
+            outlines_id = self.new_id()
+            for bm in self.bookmarks:
+                bm["id"] = self.new_id()
+                bm["count"] = 0
+            for bm in reversed(self.bookmarks):
+                if bm["parent"] != None:
+                    self.bookmarks[bm["parent"]]["count"] += 1 + bm["count"]
+            top_bookmarks = [x for x, bm in enumerate(self.bookmarks) if bm["parent"] == None]
+
+            def write_bookmark_list(bm_list, parent_id):
+                for n, x in enumerate(bm_list):
+                    bm = self.bookmarks[x]
+                    bm_dict = "/Title {} /Parent {} 0 R /Dest [{} 0 R /Fit]".format(
+                        pdf_text_string(bm["title"]), parent_id, self.page_ids[bm["page"]])
+                    if n > 0:
+                        bm_dict += " /Prev {} 0 R".format(self.bookmarks[bm_list[n - 1]]["id"])
+                    if n < len(bm_list) - 1:
+                        bm_dict += " /Next {} 0 R".format(self.bookmarks[bm_list[n + 1]]["id"])
+                    if len(bm["children"]) > 0:
+                        bm_dict += " /First {} 0 R /Last {} 0 R /Count {}".format(
+                            self.bookmarks[bm["children"][0]]["id"], self.bookmarks[bm["children"][-1]]["id"], bm["count"])
+                    self.write_object(bm["id"], bm_dict)
+            write_bookmark_list(top_bookmarks, outlines_id)
+            for bm in self.bookmarks:
+                if len(bm["children"]) > 0:
+                    write_bookmark_list(bm["children"], bm["id"])
 
-# Fuction to read the first line in a text file
-def read_string_from_file(string_file_name):
-    with open(string_file_name, 'r', encoding='utf-8') as f:
+            self.write_object(outlines_id, "/Type /Outlines /First {} 0 R /Last {} 0 R /Count {}".format(
+                self.bookmarks[top_bookmarks[0]]["id"], self.bookmarks[top_bookmarks[-1]]["id"], len(self.bookmarks)))
+            catalog_dict += " /Outlines {} 0 R".format(outlines_id)
+
+        # Write page tree
+        self.write_object(self.pages_id, "/Type /Pages /Kids [{}] /Count {}".format(
+            " ".join(["{} 0 R".format(x) for x in self.page_ids]), len(self.page_ids)))
+
+        # Write metadata
+        info_id = self.new_id()
+        self.write_object(info_id, " ".join(["{} {}".format(k, pdf_text_string(v)) for k, v in metadata.items()]))
+
+        catalog_id = self.new_id()
+        self.write_object(catalog_id, catalog_dict)
+
+        # Write cross-reference table and trailer
+        xref_offset = self.f.tell()
+        xref_lines = ["xref", "0 {}".format(len(self.obj_offsets) + 1), "0000000000 65535 f "]
+        xref_lines += ["{:010d} 00000 n ".format(x) for x in self.obj_offsets]
+        self.f.write(("\n".join(xref_lines) + "\n").encode("latin-1"))
+        self.f.write("trailer\n<< /Size {} /Root {} 0 R /Info {} 0 R >>\nstartxref\n{}\n%%EOF\n".format(
+            len(self.obj_offsets) + 1, catalog_id, info_id, xref_offset).encode("latin-1"))
+
+        self.finished = True
+
+# Inotify event flags (see inotify(7))
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+    IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+# Watches a directory tree with inotify (Linux only, loaded with ctypes)
+# Every directory needs its own watch, so update() has to be called with the directories after each scan
+class InotifyWatcher:
+    def __init__(self, root_dir, ignore_paths=list()):
+        import ctypes, ctypes.util
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is only available on Linux")
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        self.root_dir = root_dir
+        self.ignore_paths = ignore_paths
+        self.watch_dirs = dict() # Watch descriptor to directory path
+        self.changed_paths = set()
+
+    # Watch any directories not being watched yet, returns the newly watched directories
+    def update(self, dir_paths):
+        import ctypes
+        watched = set(self.watch_dirs.values())
+        new_dirs = list()
+        for d in dir_paths:
+            if d in watched:
+                continue
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(d), IN_WATCH_MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                if err in [2, 20]: # ENOENT, ENOTDIR (it was removed after scanning)
+                    continue
+                raise OSError(err, "Could not watch directory: {}".format(d))
+            self.watch_dirs[wd] = d
+            new_dirs.append(d)
+        return new_dirs
+
+    # Read all waiting events (or wait at most timeout seconds for one), returns if any were read
+    def read_events(self, timeout):
+        import select
+        if len(select.select([self.fd], [], [], timeout)[0]) <= 0:
+            return False
+        buf = os.read(self.fd, 65536)
+        pos = 0
+        while pos < len(buf):
+            wd, mask, cookie, name_len = struct.unpack_from("iIII", buf, pos)
+            name = buf[pos + 16:pos + 16 + name_len].rstrip(b"\0")
+            pos += 16 + name_len
+            if mask & IN_Q_OVERFLOW:
+                # Too many events, assume everything changed
+                self.changed_paths.add(self.root_dir)
+                continue
+            if wd not in self.watch_dirs:
+                continue
+            d = self.watch_dirs[wd]
+            if mask & IN_IGNORED:
+                # The directory is gone, the kernel removed the watch
+                del self.watch_dirs[wd]
+                continue
+            p = os.path.join(d, os.fsdecode(name)) if len(name) > 0 else d
+            if p not in self.ignore_paths:
+                self.changed_paths.add(p)
+        return True
+
+    # Block until something changed and no more changes happened for delay seconds, returns the changed paths
+    def wait_for_changes(self, delay):
+        while len(self.changed_paths) <= 0:
+            self.read_events(None)
+        while self.read_events(delay):
+            pass
+        changed_paths = self.changed_paths
+        self.changed_paths = set()
+        return changed_paths
+
+    def close(self):
+        os.close(self.fd)
+
+# Watches a directory tree by comparing listings and file modification times (works everywhere, even network drives)
+class PollingWatcher:
+    def __init__(self, root_dir, ignore_paths=list(), interval=1.0):
+        self.root_dir = root_dir
+        self.ignore_paths = ignore_paths
+        self.interval = interval
+        self.changed_paths = set()
+        self.snapshot = self.take_snapshot()
+
+    # Get the modification time and size of everything in the tree
+    def take_snapshot(self):
+        snapshot = dict()
+        def snapshot_dir(dir_path):
+            try:
+                with os.scandir(dir_path) as it:
+                    for x in it:
+                        if x.path in self.ignore_paths:
+                            continue
+                        try:
+                            x_stat = x.stat()
+                            snapshot[x.path] = (x_stat.st_mtime_ns, x_stat.st_size)
+                            if x.is_dir() and not x.is_symlink():
+                                snapshot_dir(x.path)
+                        except OSError:
+                            continue
+            except OSError:
+                pass
+        snapshot_dir(self.root_dir)
+        return snapshot
+
+    # Compare the tree with the last snapshot, returns if anything changed
+    def poll(self):
+        snapshot = self.take_snapshot()
+        changed = set(snapshot.items()) ^ set(self.snapshot.items())
+        self.snapshot = snapshot
+        self.changed_paths.update([p for p, x in changed])
+        return len(changed) > 0
+
+    # Nothing to do, every directory is polled
+    def update(self, dir_paths):
+        return list()
+
+    # Block until something changed and no more changes happened for delay seconds, returns the changed paths
+    def wait_for_changes(self, delay):
+        while len(self.changed_paths) <= 0:
+            time.sleep(self.interval)
+            self.poll()
+        quiet_time = 0
+        while quiet_time < delay:
+            time.sleep(self.interval)
+            if self.poll():
+                quiet_time = 0
+            else:
+                quiet_time += self.interval
+        changed_paths = self.changed_paths
+        self.changed_paths = set()
+        return changed_paths
+
+    def close(self):
+        pass
+
+# Set file extentions to ignore
+ignored_file_exts = [".ignore", ".db"]
+
+# Set valid image extentions
+page_exts = [".jpg", ".jpeg", ".png", ".gif"]
+
+# Set rename extentions
+rename_exts = [".name", ".title"]
+
+# Set author extentions
+author_exts = [".author"]
+
+# Set DPI extentions
+dpi_exts = [".dpi"]
+
+# Set blank page extentions
+blank_exts = [".blank"]
+page_exts += blank_exts
+
+metadata_file_exts = rename_exts + author_exts + dpi_exts
+valid_exts = ignored_file_exts + page_exts + metadata_file_exts + blank_exts
+
+# Fuction to read the first line in a text file (newlines are translated like a file opened as text)
+def read_string_from_file(string_file_name, archive=None):
+    with io.StringIO(read_file(string_file_name, archive).decode('utf-8'), newline=None) as f:
         result = f.read()
     return result.strip().split("\n")[0].strip()
 
@@ -173,322 +1048,772 @@ def path_to_ext(path_in):
     else:
         return path_in_ext
 
-# Set file extentions to ignore
-ignored_file_exts = [".ignore", ".db"]
+# Function to classify a file extention (page, blank, metadata, ignored, or unsupported)
+def ext_to_kind(ext):
+    if ext not in valid_exts:
+        return "unsupported"
+    elif ext in metadata_file_exts:
+        return "metadata"
+    elif ext in ignored_file_exts:
+        return "ignored"
+    elif ext in blank_exts:
+        return "blank"
+    else:
+        return "page"
 
-# Set valid image extentions
-page_exts = [".jpg", ".jpeg", ".png", ".gif"]
+# Set archive extentions (an archive can be merged like a book directory)
+archive_exts = [".zip", ".cbz", ".tar", ".cbt", ".tgz", ".tar.gz", ".tbz2", ".tar.bz2", ".txz", ".tar.xz"]
 
-# Set rename extentions
-rename_exts = [".name", ".title"]
+# Function to test if a path is named like an archive
+def is_archive_path(path):
+    return os.path.basename(path).lower().endswith(tuple(archive_exts))
 
-# Set author extentions
-author_exts = [".author"]
+# Function to get the name of an archive without its extention
+def archive_base_name(path):
+    name = os.path.basename(path)
+    for ext in archive_exts:
+        if name.lower().endswith(ext):
+            return name[:-len(ext)]
+    return name
 
-# Set DPI extentions
-dpi_exts = [".dpi"]
+# Size and modification time of a file inside an archive (the parts of os.stat() that are used)
+ArchiveStat = collections.namedtuple("ArchiveStat", ["st_size", "st_mtime_ns"])
 
-# Set blank page extentions
-blank_exts = [".blank"]
-page_exts += blank_exts
+# A file or directory inside an archive (works like os.DirEntry, so scan_tree() can list archives too)
+class ArchiveEntry:
+    def __init__(self, path, is_dir):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.entry_is_dir = is_dir
+
+    def is_dir(self):
+        return self.entry_is_dir
+
+    def is_file(self):
+        return not self.entry_is_dir
+
+    def is_symlink(self):
+        return False
+
+# A ZIP/CBZ or TAR/CBT archive, read like a directory tree without extracting it
+# Paths inside it are the archive path joined with the path in the archive (like /books/book.cbz/01. Part 1/1.jpg)
+# The root of the book is the archive, or the only directory in it (archives are usually made from the book directory)
+# The file list is read once, the archive file itself is opened when needed and stays open until close()
+class BookArchive:
+    def __init__(self, archive_path):
+        self.path = archive_path
+        self.mtime_ns = os.stat(archive_path).st_mtime_ns
+        self.lock = threading.Lock() # A TAR file can only read one file at a time
+        self.open_lock = threading.Lock()
+        self.dirs = {archive_path: collections.OrderedDict()} # Entries by name, by directory path
+        self.files = dict() # ZipInfo or TarInfo, by file path
+        self.is_zip = zipfile.is_zipfile(archive_path)
+        # A compressed TAR can only be read from the start, so its pages are best read one at a time in the order they are stored
+        # (reading a page stored before the last one decompresses the archive from the start again)
+        self.is_compressed_tar = False
+        if not self.is_zip:
+            with open(archive_path, "rb") as f:
+                magic = f.read(6)
+            self.is_compressed_tar = magic.startswith(b"\x1f\x8b") or magic.startswith(b"BZh") or magic.startswith(b"\xfd7zXZ\x00")
+        self.archive_file = None # The open ZipFile or TarFile
+        self.pid = None # Process that opened it (open files can't be shared with worker processes)
+
+        archive_file = self.get_archive_file()
+        if self.is_zip:
+            members = [(x.filename, x.is_dir(), x) for x in archive_file.infolist()]
+        else:
+            # Links and other special files are skipped (like broken links in a directory)
+            members = [(x.name, x.isdir(), x) for x in archive_file.getmembers() if x.isdir() or x.isfile()]
+
+        for name, is_dir, member in members:
+            parts = [x for x in name.replace("\\", "/").split("/") if x not in ["", "."]]
+            # Skip paths outside the archive and macOS resource forks
+            if len(parts) <= 0 or ".." in parts or parts[0] == "__MACOSX":
+                continue
+            # Add the directories above it (they don't always have their own entry)
+            dir_path = archive_path
+            for part in parts[:-1] if not is_dir else parts:
+                sub_dir_path = os.path.join(dir_path, part)
+                if sub_dir_path not in self.dirs:
+                    self.dirs[sub_dir_path] = collections.OrderedDict()
+                    self.dirs[dir_path][part] = ArchiveEntry(sub_dir_path, True)
+                dir_path = sub_dir_path
+            if not is_dir:
+                file_path = os.path.join(dir_path, parts[-1])
+                self.dirs[dir_path][parts[-1]] = ArchiveEntry(file_path, False)
+                self.files[file_path] = member
+
+        self.root = archive_path
+        root_entries = list(self.dirs[archive_path].values())
+        if len(root_entries) == 1 and root_entries[0].is_dir():
+            self.root = root_entries[0].path
+
+    # Get the open ZipFile or TarFile, opening it if it was closed (or opened by another process)
+    def get_archive_file(self):
+        with self.open_lock:
+            if self.archive_file == None or self.pid != os.getpid():
+                if self.is_zip:
+                    self.archive_file = zipfile.ZipFile(self.path)
+                else:
+                    try:
+                        self.archive_file = tarfile.open(self.path, "r:*")
+                    except tarfile.TarError as ex:
+                        raise ValueError("Can not read archive '{}': {}".format(self.path, ex))
+                self.pid = os.getpid()
+            return self.archive_file
+
+    # List a directory in the archive
+    def list_dir(self, dir_path):
+        if dir_path not in self.dirs:
+            raise FileNotFoundError("No such directory in archive: '{}'".format(dir_path))
+        return list(self.dirs[dir_path].values())
+
+    # Get a file's ZipInfo or TarInfo
+    def get_member(self, file_path):
+        if file_path not in self.files:
+            raise FileNotFoundError("No such file in archive: '{}'".format(file_path))
+        return self.files[file_path]
+
+    def stat(self, file_path):
+        member = self.get_member(file_path)
+        return ArchiveStat(member.file_size if self.is_zip else member.size, self.mtime_ns)
+
+    # Get where a file is stored in the archive (to read files in the order they are stored)
+    def get_offset(self, file_path):
+        member = self.get_member(file_path)
+        return member.header_offset if self.is_zip else member.offset
+
+    def read(self, file_path):
+        member = self.get_member(file_path)
+        if self.is_zip:
+            return self.get_archive_file().read(member)
+        with self.lock:
+            return self.get_archive_file().extractfile(member).read()
+
+    # Open a file (files in a ZIP are decompressed as they are read, so reading just the header is fast)
+    def open(self, file_path):
+        if self.is_zip:
+            return self.get_archive_file().open(self.get_member(file_path))
+        return io.BytesIO(self.read(file_path))
+
+    # Close the archive file (the file list is kept, so it can still be read after this, it is just opened again)
+    def close(self):
+        with self.open_lock:
+            if self.archive_file != None and self.pid == os.getpid():
+                self.archive_file.close()
+            self.archive_file = None
+
+# Function to list a directory like os.scandir() (or a directory inside archive)
+def list_dir(dir_path, archive=None):
+    if archive != None:
+        return archive.list_dir(dir_path)
+    with os.scandir(dir_path) as it:
+        return list(it)
+
+# A file or directory in the tree index (built once by scan_tree, never re-read from disk)
+class TreeEntry:
+    def __init__(self, path, rel_path, is_dir):
+        self.path = path
+        self.rel_path = rel_path
+        self.is_dir = is_dir
+        if is_dir:
+            self.ext = None
+            self.kind = "dir"
+        else:
+            self.ext = path_to_ext(path)
+            self.kind = ext_to_kind(self.ext)
+
+        # Directory only info
+        self.children = list()
+        self.num_dirs = 0 # Direct subdirectories
+        self.num_files = 0 # Direct page/blank files
+        self.num_pages = 0 # Page/blank files in the whole subtree
+        self.page_offset = 0 # Page/blank files before this entry (in scan order)
+        self.rename_name = None # Bookmark name from a rename file inside the directory
+
+        # Page only info (set by probe_pages)
+        self.probe = None # Image header info (images only)
+        self.width = None # Size in pixels (blank pages get the size of the nearest image before them)
+        self.height = None
+
+# Function to build the tree index of a directory with one os.scandir per directory
+# Returns the root entry and all other entries in sorted(Path(root_dir).glob('**/*')) order
+# Directory listings (and their rename files) are kept in scan_cache, if given, and reused on the next scan
+# archive is the BookArchive that root_dir is in (None for a normal directory)
+def scan_tree(root_dir, scan_cache=None, archive=None):
+    tree_root = TreeEntry(root_dir, "", True)
+    tree_list = list()
+    page_count = 0
+
+    def scan_dir(dir_entry):
+        nonlocal page_count
+        if scan_cache != None and dir_entry.path in scan_cache:
+            scandir_list, dir_entry.rename_name = scan_cache[dir_entry.path]
+        else:
+            scandir_list = sorted(list_dir(dir_entry.path, archive), key=lambda x: os.path.normcase(x.name))
+            for x in scandir_list:
+                if x.is_file() and path_to_ext(x.path) in rename_exts:
+                    dir_entry.rename_name = read_string_from_file(x.path, archive)
+            if scan_cache != None:
+                scan_cache[dir_entry.path] = (scandir_list, dir_entry.rename_name)
+
+        for x in scandir_list:
+            # Get type (skips broken links and other special files)
+            if x.is_dir():
+                x_is_dir = True
+            elif x.is_file():
+                x_is_dir = False
+            else:
+                continue
+
+            x_entry = TreeEntry(x.path, os.path.join(dir_entry.rel_path, x.name), x_is_dir)
+            x_entry.page_offset = page_count
+            tree_list.append(x_entry)
+            dir_entry.children.append(x_entry)
+
+            if x_is_dir:
+                dir_entry.num_dirs += 1
+                # Do not follow directory links (like glob('**/*'))
+                if not x.is_symlink():
+                    scan_dir(x_entry)
+                dir_entry.num_pages += x_entry.num_pages
+            elif x_entry.kind in ["page", "blank"]:
+                page_count += 1
+                dir_entry.num_files += 1
+                dir_entry.num_pages += 1
+
+    scan_dir(tree_root)
+    return tree_root, tree_list
+
+# Function to get a key that changes whenever a file changes (used to reuse work between builds)
+def get_page_key(path, archive=None):
+    path_stat = stat_file(path, archive)
+    return (path, path_stat.st_mtime_ns, path_stat.st_size)
+
+# Function to get the peak memory use of this process in bytes (None if it can not be measured)
+def get_peak_rss():
+    try:
+        # Linux (can be reset with reset_peak_rss)
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        # Windows
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        # Bytes on macOS, kilobytes everywhere else
+        return peak_rss
+    return peak_rss * 1024
+
+# Function to start measuring the peak memory use again (so each stage gets its own peak, only works on Linux)
+def reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+# Function to purify a page and measure it (runs inside worker processes when profiling)
+# Returns the purify_page result, the CPU seconds and peak memory of the worker, and the bytes read
+def profile_purify_page(purify_task, data=None):
+    reset_peak_rss()
+    cpu_start = time.process_time()
+    pdf_image, cache_hit = purify_page(purify_task, data)
+    bytes_read = len(data) if data != None else stat_file(purify_task[0]).st_size
+    return pdf_image, cache_hit, time.process_time() - cpu_start, get_peak_rss(), bytes_read
+
+# Wall time, CPU time, bytes read/written, pages, and peak memory of each stage of a build
+# Stages run more than once (like reading each page) are added up, sub-stages of the PDF stage have no peak memory of their own
+class BuildProfile:
+    def __init__(self):
+        self.stages = collections.OrderedDict()
+        self.start_time = time.perf_counter()
+
+    # Get a stage, making it if needed
+    def get_stage(self, name):
+        if name not in self.stages:
+            self.stages[name] = {
+                "wall_seconds": 0.0,
+                "cpu_seconds": 0.0,
+                "bytes_read": None, # None until the stage measures it
+                "bytes_written": None,
+                "pages": 0,
+                "peak_rss": None
+                }
+        return self.stages[name]
+
+    # Start timing a stage, returns what stop() needs (peak_rss resets the peak memory first)
+    def start(self, name, peak_rss=False):
+        self.get_stage(name)
+        if peak_rss:
+            reset_peak_rss()
+        return (name, time.perf_counter(), time.process_time(), peak_rss)
+
+    # Stop timing a stage and add the results to it
+    def stop(self, token, pages=0, bytes_read=None, bytes_written=None):
+        name, wall_start, cpu_start, peak_rss = token
+        self.add(name, wall_seconds=time.perf_counter() - wall_start, cpu_seconds=time.process_time() - cpu_start,
+            pages=pages, bytes_read=bytes_read, bytes_written=bytes_written, peak_rss=get_peak_rss() if peak_rss else None)
+
+    # Add results to a stage (peak memory keeps the highest value)
+    # Bytes left as None are not measured by the stage (like listing directories), so they show up as "-" instead of 0
+    def add(self, name, wall_seconds=0.0, cpu_seconds=0.0, pages=0, bytes_read=None, bytes_written=None, peak_rss=None):
+        stage = self.get_stage(name)
+        stage["wall_seconds"] += wall_seconds
+        stage["cpu_seconds"] += cpu_seconds
+        stage["pages"] += pages
+        if bytes_read != None:
+            stage["bytes_read"] = (stage["bytes_read"] or 0) + bytes_read
+        if bytes_written != None:
+            stage["bytes_written"] = (stage["bytes_written"] or 0) + bytes_written
+        if peak_rss != None and (stage["peak_rss"] == None or peak_rss > stage["peak_rss"]):
+            stage["peak_rss"] = peak_rss
+
+    # Get the profile as a dict (for JSON), with the throughput of each stage
+    # The total peak memory is the highest peak of any one process (this one or a worker)
+    def report(self):
+        stages = collections.OrderedDict()
+        for name, stage in self.stages.items():
+            stages[name] = dict(stage)
+            if stage["pages"] > 0 and stage["wall_seconds"] > 0:
+                stages[name]["pages_per_second"] = stage["pages"] / stage["wall_seconds"]
+            else:
+                stages[name]["pages_per_second"] = None
+        peak_rss_list = [x["peak_rss"] for x in self.stages.values() if x["peak_rss"] != None]
+        return {
+            "total_seconds": time.perf_counter() - self.start_time,
+            "peak_rss": max(peak_rss_list) if len(peak_rss_list) > 0 else None,
+            "stages": stages
+            }
+
+    # Get the profile as lines of a text table
+    def report_lines(self):
+        def mb(x):
+            return "-" if x == None else "{:.1f}".format(x / 1024 / 1024)
+        report = self.report()
+        lines = ["{:<12}{:>10}{:>10}{:>10}{:>10}{:>10}{:>10}".format("Stage", "Wall s", "CPU s", "Read MB", "Write MB", "Pages/s", "Peak MB")]
+        for name, stage in report["stages"].items():
+            lines.append("{:<12}{:>10.3f}{:>10.3f}{:>10}{:>10}{:>10}{:>10}".format(name, stage["wall_seconds"], stage["cpu_seconds"],
+                mb(stage["bytes_read"]), mb(stage["bytes_written"]),
+                "-" if stage["pages_per_second"] == None else "{:.1f}".format(stage["pages_per_second"]),
+                mb(stage["peak_rss"])))
+        lines.append("Total: {:.3f} seconds, peak memory {} MB".format(report["total_seconds"], mb(report["peak_rss"])))
+        return lines
+
+    # Save the profile as JSON
+    def save(self, profile_file):
+        with open(profile_file, "w") as f:
+            json.dump(self.report(), f, indent=2)
+            f.write("\n")
+
+# Work kept between builds of the same book (used by watch mode)
+class BuildCache:
+    def __init__(self, max_pages_size=None):
+        self.dirs = dict() # Directory listings and rename names, by directory path
+        self.probes = dict() # Image header info, by page key
+        self.pages = collections.OrderedDict() # Purified pages, by page key (least recently used first)
+        self.pages_size = 0 # Bytes of purified page data
+        self.max_pages_size = max_pages_size # Bytes of purified pages to keep (None for no limit)
+
+    # Get a purified page (None if it is not kept), it becomes the most recently used
+    def get_page(self, page_key):
+        if page_key not in self.pages:
+            return None
+        self.pages.move_to_end(page_key)
+        return self.pages[page_key]
+
+    # Keep a purified page, forgetting the least recently used pages once they don't fit in max_pages_size
+    def add_page(self, page_key, pdf_image):
+        if page_key in self.pages:
+            self.pages_size -= len(self.pages.pop(page_key)["data"])
+        self.pages[page_key] = pdf_image
+        self.pages_size += len(pdf_image["data"])
+        while self.max_pages_size != None and self.pages_size > self.max_pages_size:
+            old_key, old_image = self.pages.popitem(last=False)
+            self.pages_size -= len(old_image["data"])
+
+    # Forget the purified pages that are not in keep_keys (pages no longer in the book, or changed since)
+    def keep_pages(self, keep_keys):
+        for k in set(self.pages.keys()) - set(keep_keys):
+            self.pages_size -= len(self.pages.pop(k)["data"])
+
+    # Forget the listings of changed directories (and everything inside removed or renamed ones)
+    def forget_paths(self, changed_paths):
+        for p in changed_paths:
+            p_dir = os.path.dirname(p)
+            for d in list(self.dirs.keys()):
+                if d == p or d == p_dir or d.startswith(p + os.path.sep):
+                    del self.dirs[d]
+
+# Purified pages of an unfinished build, kept in a work directory so the next build can continue from them (--resume)
+# The manifest has the settings on its first line, then one line per finished page (source path, size, modification time, page file)
+# Lines are added as soon as each page is saved, so a build that dies loses at most the page it was writing
+class ResumeManifest:
+    def __init__(self, work_dir, settings, archive=None):
+        self.work_dir = work_dir
+        self.archive = archive # BookArchive the source pages are in (None for a normal directory)
+        self.manifest_file = os.path.join(work_dir, "manifest.jsonl")
+        self.settings = dict(settings, version=purify_cache_version)
+        self.pages = dict() # Manifest entries of finished pages, by source path
+        self.manifest = None
+
+    # Load the finished pages of an earlier build (none if the settings changed), then start adding to them
+    def open(self):
+        os.makedirs(self.work_dir, exist_ok=True)
+        try:
+            with open(self.manifest_file, "r", encoding="utf-8") as f:
+                manifest_lines = f.read().split("\n")
+            if json.loads(manifest_lines[0]) == self.settings:
+                for line in manifest_lines[1:]:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Cut off when the build died
+                        continue
+                    self.pages[entry["path"]] = entry
+        except (OSError, ValueError):
+            pass
+
+        # Start a new manifest with only the pages that are still there (deleting the rest)
+        keep_files = set([entry["file"] for entry in self.pages.values()])
+        for entry in os.scandir(self.work_dir):
+            if entry.name.endswith(purify_cache_ext) and entry.name not in keep_files:
+                os.remove(entry.path)
+        temp_manifest_file = "{}.{}.tmp".format(self.manifest_file, os.getpid())
+        with open(temp_manifest_file, "w", encoding="utf-8") as f:
+            f.write(json.dumps(self.settings) + "\n")
+            for entry in self.pages.values():
+                f.write(json.dumps(entry) + "\n")
+        os.replace(temp_manifest_file, self.manifest_file)
+        self.manifest = open(self.manifest_file, "a", encoding="utf-8")
+        return len(self.pages)
+
+    # Function to test if a page was finished and its source file did not change since
+    def has(self, page_file):
+        entry = self.pages.get(page_file)
+        if entry == None:
+            return False
+        try:
+            page_stat = stat_file(page_file, self.archive)
+        except OSError:
+            return False
+        return page_stat.st_size == entry["size"] and page_stat.st_mtime_ns == entry["mtime_ns"]
+
+    # Get a finished page (None if it is missing or damaged)
+    def get(self, page_file):
+        if not self.has(page_file):
+            return None
+        return read_purify_cache(os.path.join(self.work_dir, self.pages[page_file]["file"]))
+
+    # Save a finished page, page_stat is the source file's stat_file() from before it was read
+    def add(self, page_file, page_stat, pdf_image):
+        entry = {
+            "path": page_file,
+            "size": page_stat.st_size,
+            "mtime_ns": page_stat.st_mtime_ns,
+            "file": hashlib.sha256(page_file.encode("utf-8", "surrogateescape")).hexdigest()[:32] + purify_cache_ext
+            }
+        entry_file = os.path.join(self.work_dir, entry["file"])
+        # A page from the purify cache is linked, not written again (if the cache trims it away later, it is purified again)
+        linked = False
+        if pdf_image.get("cache_file") != None:
+            try:
+                link_file(pdf_image["cache_file"], entry_file)
+                linked = True
+            except OSError:
+                pass
+        if not linked:
+            write_purify_cache(entry_file, pdf_image)
+        self.pages[page_file] = entry
+        self.manifest.write(json.dumps(entry) + "\n")
+        self.manifest.flush()
+
+    # Stop adding pages (the work directory is kept for the next build)
+    def close(self):
+        if self.manifest != None:
+            self.manifest.close()
+            self.manifest = None
+
+    # Delete the work directory (after the PDF is saved)
+    def remove(self):
+        import shutil
+
+        self.close()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+# Settings to merge one book (the defaults are the same as the command line)
+class BookConfig:
+    def __init__(self, input_dir, output_file=None, output_dir=None, order_number_separator=None,
+            title=None, author=None, dpi=None, purify=False, sharpen_factor=2, thresh_setting=170,
+            purify_engine="pillow", purify_compression="flate", purify_jobs=1, cache_dir=None, cache_size=1024, max_memory=None,
+            max_dpi=None, prefetch=4, resume=False, parallel_parts=False, dedup=False, work_dir=None, linearize=False,
+            no_pdf=False, estimate=False, estimate_samples=8, estimate_json=False, profile=False, profile_json=False,
+            toc_break_limit=None, toc_number_prefix="Page #", toc_number_postfix="  ", toc_indent="--- "):
+        self.input_dir = os.path.realpath(input_dir)
+        self.output_file = output_file # Defaults to [title].pdf next to the input directory
+        self.output_dir = output_dir # Directory for [title].pdf, if output_file is not set
+        self.order_number_separator = order_number_separator
+        self.title = title # Overrides the title file
+        self.author = author # Overrides the author file
+        self.dpi = dpi # Overrides the DPI file
+        self.purify = purify
+        self.sharpen_factor = sharpen_factor
+        self.thresh_setting = thresh_setting
+        self.purify_engine = purify_engine # "pillow" or "numpy"
+        self.purify_compression = purify_compression # "flate" or "g4" (CCITT Group 4)
+        self.purify_jobs = purify_jobs # Only used if build_pdf() is not given a worker pool
+        self.cache_dir = cache_dir # Purify cache directory (None to disable)
+        self.cache_size = cache_size # Megabytes
+        self.max_memory = max_memory # Megabytes of pages being purified, converted, or read ahead at the same time (None for no limit)
+        self.max_dpi = max_dpi # Pages above this DPI are downsampled (None to keep every pixel)
+        self.prefetch = prefetch # Number of upcoming page files read ahead in threads (0 to read them one at a time)
+        self.resume = resume # Keep purified pages in [output_file].resume until the PDF is saved, and reuse them
+        self.parallel_parts = parallel_parts # Build the top level parts in parallel (with purify_jobs workers, not with a cache, resume, or dedup)
+        self.dedup = dedup # Embed identical page images only once
+        self.work_dir = work_dir # Directory for the unfinished PDF, its parts, and the --resume pages (defaults to next to the PDF)
+        self.linearize = linearize # Write a linearized PDF (fast web view, needs pikepdf or qpdf)
+
+        # Used by merge_book() (scan() and build_pdf() don't look at these)
+        self.no_pdf = no_pdf # Only scan the book and log its table of contents
+        self.estimate = estimate # Only estimate the PDF size, time, and peak memory (see estimate_build())
+        self.estimate_samples = estimate_samples
+        self.estimate_json = estimate_json # Save the estimate as [output_file].estimate.json
+        self.profile = profile # Log the BuildProfile of each stage
+        self.profile_json = profile_json # Save the profile as [output_file].profile.json
+        self.toc_break_limit = toc_break_limit # Table of contents formatting (see make_table_of_contents())
+        self.toc_number_prefix = toc_number_prefix
+        self.toc_number_postfix = toc_number_postfix
+        self.toc_indent = toc_indent
+
+        self.validate()
+
+    # Check the settings (the DPI is checked once the book's DPI file is read), raises ValueError for the first bad one
+    def validate(self):
+        # Purify settings (and if NumPy, or Pillow with libtiff for G4, is installed)
+        if self.sharpen_factor <= 0:
+            raise ValueError("sharpen_factor must be greater than 0.")
+        if self.thresh_setting < 0 or self.thresh_setting > 255:
+            raise ValueError("thresh_setting must be 0 <= threshold <= 255.")
+        if self.purify_engine not in ["pillow", "numpy"]:
+            raise ValueError("purify_engine must be 'pillow' or 'numpy'.")
+        if self.purify_engine == "numpy":
+            try:
+                import numpy
+            except ImportError:
+                raise ValueError("purify_engine 'numpy' needs NumPy to be installed.")
+        if self.purify_compression not in ["flate", "g4"]:
+            raise ValueError("purify_compression must be 'flate' or 'g4'.")
+        if self.purify_compression == "g4":
+            from PIL import features
+            if not features.check("libtiff"):
+                raise ValueError("purify_compression 'g4' needs Pillow to be built with libtiff.")
+        if self.purify_jobs < 1:
+            raise ValueError("purify_jobs must be at least 1.")
+
+        # Purify cache and work directory
+        if self.cache_dir != None and os.path.exists(self.cache_dir) and not os.path.isdir(self.cache_dir):
+            raise NotADirectoryError(self.cache_dir)
+        if self.cache_size < 0:
+            raise ValueError("cache_size must be a positive number of megabytes.")
+        if self.work_dir != None and os.path.exists(self.work_dir) and not os.path.isdir(self.work_dir):
+            raise NotADirectoryError(self.work_dir)
+
+        # Build settings
+        if self.max_memory != None and self.max_memory <= 0:
+            raise ValueError("max_memory must be a positive number of megabytes.")
+        if self.max_dpi != None and ((self.max_dpi < 72) or (self.max_dpi > 4800)):
+            raise ValueError("max_dpi must be 72 <= DPI <= 4800. Current setting: '{}'".format(self.max_dpi))
+        if self.prefetch < 0:
+            raise ValueError("prefetch must be a positive number of pages, or 0 to not read ahead.")
+        # Parallel parts can't reuse pages between builds
+        if self.parallel_parts and (self.resume or self.dedup):
+            raise ValueError("parallel_parts can not be used with resume or dedup.")
+        if self.linearize and not self.no_pdf and not self.estimate and get_linearize_tool() == None:
+            raise ValueError("linearize needs pikepdf or the qpdf command line tool to be installed.")
+
+        # merge_book() settings
+        if self.no_pdf and self.estimate:
+            raise ValueError("estimate can not be used with no_pdf.")
+        if self.estimate_samples < 1:
+            raise ValueError("estimate_samples must be at least 1.")
+        min_toc_break_limit = 10
+        if self.toc_break_limit != None and self.toc_break_limit <= min_toc_break_limit:
+            raise ValueError("toc_break_limit must be greater than {}, or None for no limit.".format(min_toc_break_limit))
 
-metadata_file_exts = rename_exts + author_exts + dpi_exts
-valid_exts = ignored_file_exts + page_exts + metadata_file_exts + blank_exts
+# A book: its settings from the main directory, then its pages and bookmarks (filled in by scan())
+class Book:
+    def __init__(self, config, log=print):
+        self.config = config
+        self.input_dir = config.input_dir
+        self.input_dir_name = self.input_dir.strip(os.path.sep).split(os.path.sep)[-1]
 
-# Get files in main input directory
-input_dir_files = [str(p) for p in Path(input_dir).glob("*") if os.path.isfile(p)]
-
-# Set/limit DPI
-dpi_files = [p for p in input_dir_files if path_to_ext(p) in dpi_exts]
-if len(dpi_files) > 1:
-    raise argparse.ArgumentTypeError("Multiple DPI files found in the main directory! Please use at most 1.")
-if args["dpi"] != None:
-    pdf_dpi = args["dpi"]
-    if len(dpi_files) > 0:
-        print("[WARNING]: A DPI file exists in the main directory, but the --dpi argument overrides this.")
-elif len(dpi_files) > 0:
-    try:
-        pdf_dpi = int(read_string_from_file(dpi_files[0]))
-    except ValueError:
-        argparse.ArgumentTypeError("DPI setting from DPI file must be a valid integer.")
-else:
-    pdf_dpi = int(300)
-if (pdf_dpi < 72) or (pdf_dpi > 4800):
-    raise argparse.ArgumentTypeError("DPI must be 72 <= DPI <= 4800. Current setting: '{}'".format(pdf_dpi))
-
-# Set PDF title
-title_files = [p for p in input_dir_files if path_to_ext(p) in rename_exts]
-if len(title_files) > 1:
-    raise argparse.ArgumentTypeError("Multiple title/name files found in the main directory! Please use at most 1.")
-use_pdf_title = True
-if args["title"] != None:
-    if len(title_files) > 0:
-        print("[WARNING]: A title/name file exists in the main directory, but the --title argument overrides this.")
-    pdf_title = args["title"]
-elif len(title_files) > 0:
-    pdf_title = read_string_from_file(title_files[0])
-else:
-    pdf_title = input_dir_name
-    use_pdf_title = False
-
-# Set PDF author
-author_files = [p for p in input_dir_files if path_to_ext(p) in author_exts]
-if len(author_files) > 1:
-    raise argparse.ArgumentTypeError("Multiple author files found in the main directory! Please use at most 1.")
-if args["author"] != None:
-    if len(author_files) > 0:
-        print("[WARNING]: An author file exists in the main directory, but the --author argument overrides this.")
-    pdf_author = args["author"].strip()
-elif len(author_files) > 0:
-    pdf_author = read_string_from_file(author_files[0])
-else:
-    pdf_author = ""
-
-# Resolve output filename
-if not args["no_pdf"]:
-    if args["output_file"] == None:
-        # Default to title
-        pdf_title_safe_filename = get_valid_filename(pdf_title)
-        output_file = os.path.join(main_dir, pdf_title_safe_filename) + os.path.extsep + "pdf"
-    else:
-        out_dir, out_name = os.path.split(args["output_file"])
-        out_name_split = out_name.split(os.path.extsep)
-        if len(out_name_split) >= 2:
-            # There is an extension
-            output_file = args["output_file"]
-            if out_name_split[-1].lower() != "pdf":
-                output_file += os.path.extsep + "pdf"
-        else:
-            # No extension provided
-            output_file = args["output_file"] + os.path.extsep + "pdf"
-    
-    output_file = os.path.realpath(output_file)  
-    output_file_dir, output_file_name = os.path.split(output_file)
-
-# Test if special ToC formatting is used
-if args["table_of_contents_format"] != None:
-    tocf_args = args["table_of_contents_format"]
-else:
-    tocf_args = ()
-
-# Defaults
-toc_line_break_limit = None
-pagenum_pre = "Page #"
-pagenum_post = "  "
-ident_str = "--- "
-
-# Parse ToC formatting sub arguments
-for tocf_arg in tocf_args:
-    tocf_arg_split = tocf_arg.split("=")
-    
-    # Only allow [string]=[string]
-    if len(tocf_arg_split) != 2:
-        raise argparse.ArgumentTypeError("Invalid argument format. Use arg_name=arg_value.")
-    
-    # Get name and value separately
-    tocf_arg_name, tocf_arg_value = [x.lower() for x in tocf_arg_split]
-    
-    # Parse ToC formatting named sub-arguments
-    if tocf_arg_name in ["break_limit", "b"]:
-        # Test if it's an int and set
-        worked = True
+        # Get main directory
+        self.main_dir = os.path.sep.join(self.input_dir.rstrip(os.path.sep).split(os.path.sep)[:-1])
+
+        # An archive is merged like the directory it was made from (next to the archive, named after it)
+        # The book keeps it open until close(), normal directories are read straight from the disk
+        self.archive = None
+        if is_archive_path(self.input_dir) and os.path.isfile(self.input_dir):
+            self.archive = BookArchive(self.input_dir)
+            self.input_dir = self.archive.root
+            if self.archive.root == self.archive.path:
+                self.input_dir_name = archive_base_name(self.archive.path)
+            else:
+                self.input_dir_name = os.path.basename(self.archive.root)
+            self.main_dir = os.path.dirname(self.archive.path)
+
+        # Pages to read ahead (none from a compressed TAR, they would only wait for each other)
+        self.prefetch = config.prefetch
         try:
-            toc_line_break_limit = int(tocf_arg_value.strip())
-        except(ValueError):
-            worked = False
-        
-        # Test if it's greater than min_toc_line_break_limit
-        min_toc_line_break_limit = 10
-        if toc_line_break_limit == 0:
-            toc_line_break_limit = None
-            workied=True
-        elif toc_line_break_limit <= min_toc_line_break_limit:
-            worked = False
-        
-        if not worked:
-            raise argparse.ArgumentTypeError("(--break_limit | -b) length must be an integer greater than {}, or 0 for no limit.".format(min_toc_line_break_limit))
-    elif tocf_arg_name in ["number_prefix", "p"]:
-        pagenum_pre = tocf_arg_value
-    elif tocf_arg_name in ["number_postfix", "a"]:
-        pagenum_post = tocf_arg_value
-    elif tocf_arg_name in ["indent", "i"]:
-        ident_str = tocf_arg_value
-    else:
-        raise argparse.ArgumentTypeError("'{}' is not a valid option for (--break_limit | -b).".format(tocf_arg_name))
-
-# Parse purify sub-arguments (values)
-if purify:
-    # Defaults
-    sharpen_factor = 2
-    thresh_setting = 170
-    
-    for p_arg in purify_args:
-        p_arg_split = p_arg.split("=")
-        
-        # Only allow [string]=[string]
-        if len(p_arg_split) != 2:
-            raise argparse.ArgumentTypeError("Invalid argument format. Use arg_name=arg_value.")
+            if self.archive != None and self.archive.is_compressed_tar:
+                self.prefetch = 0
+                if config.parallel_parts:
+                    # Every worker would decompress the whole archive to find its pages
+                    raise ValueError("Can not build the parts of a compressed TAR archive in parallel, extract it or use a ZIP archive.")
+            self.read_settings(config, log)
+        except BaseException:
+            self.close()
+            raise
 
-        # Get name and value separately
-        p_arg_name, p_arg_value = [x.lower().strip() for x in p_arg_split]
+        # Filled in by scan()
+        self.tree_root = None
+        self.tree_list = list()
+        self.page_list = list() # Page/blank file entries and empty directory entries, in page order
+        self.num_pages = 0
+        self.num_image_pages = 0
+        self.width = 0 # Size of the first image in pixels (used for blank pages)
+        self.height = 0
+        self.bookmarks = list() # Dicts with "name", "level", "page" (starting at 1), and "parent" (index or None)
+        self.bad_pages = list() # Image page entries that can't be opened
+        self.mismatched_pages = list() # Image page entries with a different size than most pages
 
-        # Parse purify named sub-arguments
-        if p_arg_name in ["sharpen", "s"]:
-            # Test if it's a float and set
-            worked = True
-            try:
-                sharpen_factor = float(p_arg_value)
-            except(ValueError):
-                worked = False
-            
-            # Test if it's greater than 0
-            if sharpen_factor <= 0:
-                worked = False
-            
-            if not worked:
-                raise argparse.ArgumentTypeError("(--purify | -p) sharpness must be a float greater than 0.")
-        elif p_arg_name in ["threshold", "t"]:
-            # Test if it's a float and set
-            worked = True
-            try:
-                thresh_setting = float(p_arg_value)
-            except(ValueError):
-                worked = False
-            
-            # Test if it's positive
-            if thresh_setting < 0:
-                worked = False
-            
-            # Test if it's <= 255
-            if thresh_setting > 255:
-                worked = False
-            
-            if not worked:
-                raise argparse.ArgumentTypeError("(--purify | -p) threshold must be a positive float <= 255.")
-        else:
-            raise argparse.ArgumentTypeError("'{}' is not a valid option for (--purify | -p).".format(p_arg_name))
+    # Close the book's archive, if it is made from one (reading the book after this opens it again)
+    def close(self):
+        if self.archive != None:
+            self.archive.close()
 
+    def __enter__(self):
+        return self
 
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
-# Print main program warnings
-if args["no_pdf"] and args["purify"] != None:
-    print("[WARNING]: Both (--purify|-p) and (--no_pdf|-n) arguments were passed, will not make PDF.")
+    # Read the settings files in the main directory (DPI, title, author) and work out the output file
+    def read_settings(self, config, log=print):
+        # Get files in main input directory
+        input_dir_files = [x.path for x in list_dir(self.input_dir, self.archive) if x.is_file()]
 
-# Print settings
-print()
-print("-------- PDF SETTINGS --------")
-pdf_no_title_string = "PDF will have no title."
-if use_pdf_title:
-    if len(pdf_title) <= 0:
-        print(pdf_no_title_string)
-    else:
-        print("PDF title: {}".format(pdf_title))
-else:
-    print(pdf_no_title_string)
+        # Set/limit DPI
+        dpi_files = [p for p in input_dir_files if path_to_ext(p) in dpi_exts]
+        if len(dpi_files) > 1:
+            raise ValueError("Multiple DPI files found in the main directory! Please use at most 1.")
+        if config.dpi != None:
+            self.dpi = config.dpi
+            if len(dpi_files) > 0:
+                log("[WARNING]: A DPI file exists in the main directory, but the --dpi argument overrides this.")
+        elif len(dpi_files) > 0:
+            try:
+                self.dpi = int(read_string_from_file(dpi_files[0], self.archive))
+            except ValueError:
+                raise ValueError("DPI setting from DPI file must be a valid integer.")
+        else:
+            self.dpi = int(300)
+        if (self.dpi < 72) or (self.dpi > 4800):
+            raise ValueError("DPI must be 72 <= DPI <= 4800. Current setting: '{}'".format(self.dpi))
 
-if len(pdf_author) <= 0:
-    print("PDF will have no author.")
-else:
-    print("PDF author: {}".format(pdf_author))
+        # Set PDF title
+        title_files = [p for p in input_dir_files if path_to_ext(p) in rename_exts]
+        if len(title_files) > 1:
+            raise ValueError("Multiple title/name files found in the main directory! Please use at most 1.")
+        self.use_title = True
+        if config.title != None:
+            if len(title_files) > 0:
+                log("[WARNING]: A title/name file exists in the main directory, but the --title argument overrides this.")
+            self.title = config.title
+        elif len(title_files) > 0:
+            self.title = read_string_from_file(title_files[0], self.archive)
+        else:
+            self.title = self.input_dir_name
+            self.use_title = False
 
-if not args["no_pdf"]:
-    print("PDF resolution: {} DPI".format(pdf_dpi))
+        # Set PDF author
+        author_files = [p for p in input_dir_files if path_to_ext(p) in author_exts]
+        if len(author_files) > 1:
+            raise ValueError("Multiple author files found in the main directory! Please use at most 1.")
+        if config.author != None:
+            if len(author_files) > 0:
+                log("[WARNING]: An author file exists in the main directory, but the --author argument overrides this.")
+            self.author = config.author.strip()
+        elif len(author_files) > 0:
+            self.author = read_string_from_file(author_files[0], self.archive)
+        else:
+            self.author = ""
 
-print("Input directory: {}".format(input_dir))
+        # Resolve output filename
+        if config.output_file == None:
+            # Default to title
+            title_safe_filename = get_valid_filename(self.title) + os.path.extsep + "pdf"
+            if config.output_dir == None:
+                self.output_file = os.path.join(self.main_dir, title_safe_filename)
+            else:
+                self.output_file = os.path.join(config.output_dir, title_safe_filename)
+        else:
+            out_dir, out_name = os.path.split(config.output_file)
+            out_name_split = out_name.split(os.path.extsep)
+            if len(out_name_split) >= 2:
+                # There is an extension
+                self.output_file = config.output_file
+                if out_name_split[-1].lower() != "pdf":
+                    self.output_file += os.path.extsep + "pdf"
+            else:
+                # No extension provided
+                self.output_file = config.output_file + os.path.extsep + "pdf"
+        self.output_file = os.path.realpath(self.output_file)
+        self.work_dir = os.path.dirname(self.output_file) if config.work_dir == None else os.path.realpath(config.work_dir)
+        self.work_file = os.path.join(self.work_dir, os.path.basename(self.output_file)) # Start of the names of the unfinished files
+        self.resume_dir = "{}.resume".format(self.work_file) # Work directory of --resume
 
-if args["no_pdf"]:
-    print("Will only print the Table of Contents, will NOT process images or save PDF.")
-else:
-    # Print target filename
-    print("Output filename: {}".format(output_file))
-
-if purify:
-    print("Will purify documents:")
-    print("\tSharpening factor: {}".format(sharpen_factor))
-    print("\tThreshold: {}.".format(thresh_setting))
-
-if args["table_of_contents_format"] != None:
-    print("Table of Contents formatting:")
-    print("\tName length break limit: {}".format(toc_line_break_limit))
-    print("\tPage number prefix: '{}'".format(pagenum_pre))
-    print("\tPage number postfix: '{}'".format(pagenum_post))
-    print("\tIndent text: '{}'".format(ident_str))
-
-
-# We will be catching KeyboardInterrupts
-try:
-    # Do main imports
-    import img2pdf
-    from PIL import Image, ImageEnhance
-    from collections import OrderedDict
-    from PyPDF2 import PdfFileWriter, PdfFileReader
-    import shutil
-    import textwrap
+# Function to scan a book directory into its pages and bookmarks
+# Takes a BookConfig (or a Book with its settings already read), returns the Book
+# Adds the "scan", "probe", and "bookmarks" stages to profile (a BuildProfile), if given
+def scan(book, cache=None, log=print, profile=None):
+    if isinstance(book, BookConfig):
+        book = Book(book, log=log)
 
-    print()
-    print("-------- DIRECTORY SCANNING --------")
-    print("Scanning directory: '{}'...".format(input_dir))
+    if profile != None:
+        scan_token = profile.start("scan", peak_rss=True)
+    log()
+    log("-------- DIRECTORY SCANNING --------")
+    log("Scanning directory: '{}'...".format(book.input_dir))
 
     # Walk though folder structure (recursive alphabetical, include all files/folders)
-    input_dir_list = [str(p) for p in sorted(Path(input_dir).glob('**/*'))]
-
-    # Prefix to prepend to temporary file/folder names
-    temp_name_prepend = "__temp__"
-
-    # The temporary directory name
-    temp_dir_name = temp_name_prepend + input_dir_name
-    temp_dir = os.path.join(main_dir, temp_dir_name)
-    
-    if not args["no_pdf"]:
-        # Delete temp dir if it exists
-        def clean_temp_dir():
-            if os.path.exists(temp_dir):
-                if os.path.isdir(temp_dir):
-                    shutil.rmtree(temp_dir)
-                elif os.path.isfile(temp_dir):
-                    os.remove(temp_dir)
-        clean_temp_dir()
-        
-        # Make temp directory
-        os.mkdir(temp_dir)
-        
-        # Set up exit function to clean up if exited early
-        def exit_clean_temp_dir():
-            print("Delete temporary directory: {}".format(temp_dir))
-            clean_temp_dir()
-            print("\tDone!")
-        exit_funcs.append(exit_clean_temp_dir)
-    
-    # Make final input dir names
-    if purify:
-        # Temp directory
-        final_input_dir = temp_dir
-    else:
-        # The original directory
-        final_input_dir = input_dir
+    book.tree_root, book.tree_list = scan_tree(book.input_dir, None if cache == None else cache.dirs, book.archive)
 
-    # Save image paths (and empty/ignored-file dirs) paths to ordered list
+    # Save image (and empty/ignored-file dir) tree entries to ordered list
     page_list = list()
-    # Make dict with rename (dir, bm_name)
-    page_dir_rename_dict = dict()
-    for p in input_dir_list:
-        if os.path.isfile(p):
+    for e in book.tree_list:
+        p = e.path
+        if not e.is_dir:
             # Check if it's an invalid extention, and if so, fully ignore it
-            p_ext = path_to_ext(p)
-            
-            if p_ext not in valid_exts:
-                print("[UNSUPPORTED]: {}".format(p))
+            if e.kind == "unsupported":
+                log("[UNSUPPORTED]: {}".format(p))
                 continue
-            
+
             # Test if it's a metadata file, and if so, fully ignore
-            if p_ext in metadata_file_exts:
+            if e.kind == "metadata":
                 continue
-            
+
             # Test if it should be ignored, and if so, fully ignore it
-            if p_ext in ignored_file_exts:
-                print("[IGNORING]: {}".format(p))
+            if e.kind == "ignored":
+                log("[IGNORING]: {}".format(p))
                 continue
-            
+
             # Test if the path length is nearing the Windows limit
             windows_path_limit = 260
             unix_path_limit = 4096
@@ -496,407 +1821,784 @@ try:
             p_path_length = len(p)
             min_path_length = min(windows_path_limit, unix_path_limit)
             if p_path_length > min_path_length - wiggle_room:
-                print("[WARNING] Dangerously long pathname: {}".format(p))
-                print("\tPath length: {} characters".format(p_path_length))
-                print("\tWindows maximum path length: {} characters".format(windows_path_limit))
-                print("\tUnix maximum path length: {} characters".format(unix_path_limit))
-                print("\tRenaming, moving, or downloading this folder may cause errors unless you shorten the names of the file/folders.")
-                print("\Recommended action: Use '.name' files (instead of the folder names) to define bookmark names.")
-                
-            page_list.append(p)
-        elif os.path.isdir(p):
-            # Get files and directories inside p
-            p_list = [os.path.realpath(str(x)) for x in sorted(Path(p).glob('*'))]
-            p_dir_list = [x for x in p_list if os.path.isdir(x)]
-            p_file_list = [x for x in p_list if os.path.isfile(x)]
-            
-            # Make file list without ignored files
-            p_file_list_ignored = list()
-            # Also update page_dir_rename_dict
-            for x in p_file_list:
-                x_path, x_filename = os.path.split(x)
-                x_ext = path_to_ext(x)
-
-                # Check if it's a valid extention
-                if x_ext in valid_exts:
-                    # If not ignored file, append to file list
-                    if x_ext not in ignored_file_exts + metadata_file_exts:
-                        p_file_list_ignored.append(x)
-                    # If it's a rename file, parse and append to rename dict
-                    if x_ext in rename_exts:
-                        # If purify, make sure it's referencing the final input dir
-                        if purify:
-                            relative_x_path = os.path.relpath(x_path, input_dir)
-                            rename_dir = os.path.join(final_input_dir, relative_x_path)
-                        else:
-                            rename_dir = x_path
-
-                        rename_name = read_string_from_file(x)
-                        
-                        page_dir_rename_dict[rename_dir] = rename_name
-            
+                log("[WARNING] Dangerously long pathname: {}".format(p))
+                log("\tPath length: {} characters".format(p_path_length))
+                log("\tWindows maximum path length: {} characters".format(windows_path_limit))
+                log("\tUnix maximum path length: {} characters".format(unix_path_limit))
+                log("\tRenaming, moving, or downloading this folder may cause errors unless you shorten the names of the file/folders.")
+                log("\Recommended action: Use '.name' files (instead of the folder names) to define bookmark names.")
+
+            page_list.append(e)
+        else:
             # Test if it's empty or contains only ignored files
-            if len(p_dir_list) <= 0 and len(p_file_list_ignored) <= 0:
+            if e.num_dirs <= 0 and e.num_files <= 0:
                 # Add path (used to make "empty" bookmarks)
-                page_list.append(p)
-    print("\tDone scanning directory!")
+                page_list.append(e)
+    book.page_list = page_list
+    log("\tDone scanning directory!")
 
     # Get number of pages
-    num_pages = len([p for p in page_list if os.path.isfile(p)])
-    num_image_pages = len([p for p in page_list if os.path.isfile(p) and os.path.splitext(p)[-1] not in blank_exts])
-    num_pages_len = len(str(num_pages))
-    num_image_pages_len = len(str(num_image_pages))
-    print("\tPage count: {}".format(num_pages))
-
-    # Run purification (save to temporary directory)
-    if purify and num_image_pages > 0:
-        print()
-        print("-------- PURIFICATION --------")
-        print("Saving purified images to temporary directory: {}".format(final_input_dir))
-        
-        # Delete temp dir (or file with same name) if it already exists
-        clean_temp_dir()
-        
-        # Create new page_list
-        new_page_list = list()
-        new_page_list_dirs = list()
-        new_page_list_files = list()
-        for p in page_list:
-            # Make final_p (replace input_dir with final_input_dir)
-            rel_p = os.path.relpath(p, input_dir)
-            final_p = os.path.join(final_input_dir, rel_p)
-            new_page_list.append(final_p)
-            if os.path.isdir(p):
-                new_page_list_dirs.append(final_p)
-            else:
-                new_page_list_files.append(final_p)
-        
-        # Make all directories first
-        for p in new_page_list_dirs:
-            Path(p).mkdir(parents=True, exist_ok=True)
-        for p in new_page_list_files:
-            Path(os.path.dirname(p)).mkdir(parents=True, exist_ok=True)
-        
-        # Process image files
-        curr_page = 0 # Will go to 1 before first print
-        for x, p in enumerate(page_list):
-            final_p = new_page_list[x]
-            if os.path.isfile(p):
-                # It's a page file
-                if os.path.splitext(p)[-1] in blank_exts:
-                    # It's a blank page file, just copy
-                    shutil.copy(p, final_p)
-                else:
-                    # It's an image file, process
-                    curr_page += 1
-                    with Image.open(p) as page_im:
-                        if purify:
-                            curr_page_str = str(curr_page).rjust(num_image_pages_len)
-                            print("[PURIFY] ({}/{}): {}".format(curr_page_str, num_image_pages, p))
-                            # Make greyscale
-                            gray = page_im.convert('L')
-                            
-                            # Sharpen 
-                            enhancer = ImageEnhance.Sharpness(gray)
-                            sharpen = enhancer.enhance(sharpen_factor)
-                            
-                            # Apply threshold
-                            thresh = sharpen.point(lambda p: p > thresh_setting and 255)  
-                            
-                            # Make 1 bit
-                            final_page_im = thresh.convert('1')
-                        else:
-                            final_page_im = page_im
-                    
-                    # Save image
-                    final_page_im.save(final_p, "PNG", dpi=(pdf_dpi, pdf_dpi))
-                
-        # Update page_list with new images/paths
-        page_list = new_page_list
-        
-        print("\tDone purifying images!")
-    
+    book.num_pages = len([e for e in page_list if not e.is_dir])
+    book.num_image_pages = len([e for e in page_list if e.kind == "page"])
+    log("\tPage count: {}".format(book.num_pages))
+
+    if profile != None:
+        profile.stop(scan_token, pages=book.num_pages)
+
+    probe_pages(book, cache=cache, log=log, profile=profile)
+    make_bookmarks(book, log=log, profile=profile)
+    return book
+
+# Function to read the header of a page image (size, mode, DPI, format) without decoding any pixels
+# Returns a dict with the error message instead, if the file can't be opened as an image
+def probe_page(page_file, archive=None):
+    from PIL import Image
+
+    bytes_read = 0
+    try:
+        with open_file(page_file, archive) as f:
+            try:
+                with Image.open(f) as im:
+                    image_dpi = im.info.get("dpi")
+                    probe = {
+                        "width": im.size[0],
+                        "height": im.size[1],
+                        "mode": im.mode,
+                        "format": im.format,
+                        "dpi": None if image_dpi == None else [float(x) for x in image_dpi],
+                        "error": None
+                        }
+            finally:
+                # Bytes taken from the file (a buffered file reads a little ahead of what Pillow looked at)
+                bytes_read = getattr(f, "raw", f).tell()
+    except Exception as ex:
+        probe = {
+            "width": None,
+            "height": None,
+            "mode": None,
+            "format": None,
+            "dpi": None,
+            "error": repr(ex)
+            }
+    probe["bytes_read"] = bytes_read # Header bytes read to probe the page
+    return probe
+
+# Function to read the headers of all image pages of a scanned book (in parallel threads, the work is mostly waiting for the disk)
+# Sets the probe and size of every page entry, the size of the book (first image), and the bad and mismatched pages
+def probe_pages(book, cache=None, log=print, profile=None, threads=None):
+    import concurrent.futures
+
+    if profile != None:
+        probe_token = profile.start("probe", peak_rss=True)
+    log()
+    log("-------- PAGE PROBING --------")
+    log("Reading image headers...")
+    image_entries = [e for e in book.page_list if e.kind == "page"]
+
+    # Headers of unchanged pages are reused from an earlier build (watch mode)
+    page_keys = dict()
+    to_probe = image_entries
+    if cache != None:
+        page_keys = {e.path: get_page_key(e.path, book.archive) for e in image_entries}
+        to_probe = [e for e in image_entries if page_keys[e.path] not in cache.probes]
+        for e in image_entries:
+            if page_keys[e.path] in cache.probes:
+                e.probe = cache.probes[page_keys[e.path]]
+    probe_bytes_read = 0
+    if len(to_probe) > 0:
+        if book.archive != None and book.archive.is_compressed_tar:
+            # Read a compressed TAR once from the start
+            to_probe = sorted(to_probe, key=lambda e: book.archive.get_offset(e.path))
+            threads = 1
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            for e, probe in zip(to_probe, executor.map(lambda p: probe_page(p, book.archive), [e.path for e in to_probe])):
+                e.probe = probe
+                probe_bytes_read += probe["bytes_read"]
+    if cache != None:
+        cache.probes = {page_keys[e.path]: e.probe for e in image_entries}
+
+    good_entries = [e for e in image_entries if e.probe["error"] == None]
+    for e in good_entries:
+        e.width = e.probe["width"]
+        e.height = e.probe["height"]
+
     # Get size from first image
-    pl_files_images = [p for p in page_list if os.path.isfile(p) and os.path.splitext(p)[-1] not in blank_exts]
-    if num_image_pages > 0:
-        with Image.open(pl_files_images[0]) as cover:
-            width, height = cover.size
+    if len(good_entries) > 0:
+        book.width, book.height = good_entries[0].width, good_entries[0].height
     else:
-        width = int(pdf_dpi * 8.5) # Assume 8.5in
-        height = int(pdf_dpi * 11) # Assume 11in
-    
-    # Get number of blank pages
-    num_blank_pages = num_pages - num_image_pages
-    
-    # Test if blank pages are used
-    if num_blank_pages > 0:
-        blanks_used = True
-    else:
-        blanks_used = False
-    
-    if blanks_used and not args["no_pdf"]:
-        print()
-        print("-------- BLANK PAGES --------")
-        print("Saving blank page images to temporary directory: {}".format(final_input_dir))
-    
-        # Make pure white images for .blank files
-        #TODO: Figure out how to make truly blank pages (or at least smaller file sizes)
-        new_page_list = list()
-        blank_page_num = 0 # Goes to 1 on first page
-        for p in page_list:
-            page_basename = os.path.relpath(p, input_dir)
-            page_temp = os.path.realpath(os.path.join(temp_dir, page_basename))
-            
-            if os.path.isfile(p):
-                if os.path.splitext(p)[-1] in blank_exts:
-                    blank_page_num += 1
-                    
-                    # Make a white PNG in the temporary folder
-                    blank_page_name = os.path.splitext(page_basename)[0] + ".png"
-                    blank_page_filename = os.path.realpath(os.path.join(temp_dir, blank_page_name))
-                    
-                    curr_page_str = str(blank_page_num).rjust(len(str(num_blank_pages)))
-                    print("[BLANK] ({}/{}): {}".format(curr_page_str, num_blank_pages, blank_page_filename))
-                    blank_page = Image.new('1', (width, height), color = "white")
-                    
-                    Path(os.path.dirname(blank_page_filename)).mkdir(parents=True, exist_ok=True)
-                    blank_page.save(blank_page_filename, "PNG", dpi=(pdf_dpi, pdf_dpi))
-                    new_page_list.append(blank_page_filename)
-                else:
-                    # Copy image to temp (fix extra bookmark due to relative directory error)
-                    if p != page_temp:
-                        Path(os.path.dirname(page_temp)).mkdir(parents=True, exist_ok=True)
-                        shutil.copy(p, page_temp)
-                    new_page_list.append(page_temp)
-            else:
-                # Make directory in temp (fixes error mentioned above)
-                Path(page_temp).mkdir(parents=True, exist_ok=True)
-                new_page_list.append(page_temp)
-        page_list = new_page_list
-        
-        print("\tDone creating blank pages!")
-    
-    # Make page_list but with only files
-    page_list_files = [p for p in page_list if os.path.isfile(p)]
-
-    # Create nested ordered dictionary from list
-    page_dict = OrderedDict()
-    for p in page_list:
-        p = os.path.relpath(p, final_input_dir) # Make relative
-        
-        current_level = page_dict
-        for part in p.split(os.path.sep):
-            if part not in current_level:
-                current_level[part] = OrderedDict()
-            current_level = current_level[part]
-
-
-
-    # Create PDF from page_list(no bookmarks)
-    if not args["no_pdf"]:
-        print()
-        print("-------- PDF CREATION --------")
-        temp_pdf = os.path.join(output_file_dir, temp_name_prepend + output_file_name)
-        print("Creating PDF document from image files...")
-        temp_pdf_file_binary = img2pdf.convert(page_list_files, dpi=pdf_dpi, x=None, y=None)
-        print("\tDone!")
-        
-        # Setup exit handler to delete temp PDF
-        input_pdf_file = None
-        def exit_clean_temp_pdf():
-            print("Delete temporary PDF: {}".format(temp_pdf))
-            if input_pdf_file != None:
-                input_pdf_file.close()
-            os.remove(temp_pdf)
-            print("\tDone!")
-        exit_funcs.append(exit_clean_temp_pdf)
-        
-        print("Saving temporary PDF: {}".format(temp_pdf))
-        with open(temp_pdf, "wb") as f:
-            f.write(temp_pdf_file_binary)
-        print("\tDone!")
-        
-        # Load PDF into PyPDF2
-        print("Loading temporary PDF into editing library...")
-        output_pdf = PdfFileWriter()
-        input_pdf_file = open(temp_pdf, 'rb')
-        input_pdf = PdfFileReader(input_pdf_file)
-        output_pdf.appendPagesFromReader(input_pdf)
-        print("\tDone!")
-    
-    
-    print()
-    print("-------- BOOKMARKS --------")
-    print("Creating bookmark hierarchy from directory structure...")
-    # Save ToC lines to list
-    #TODO: Save ToC to file option
-    toc_dict_list = list()
-    if len([p for p in page_dict.values() if p != OrderedDict()]) <= 0:
-        print()
-        if not args["no_pdf"]:
-            print("[WARNING]: No subdirectories found, not creating bookmarks.")
-        else:
-            print("[ERROR]: No subdirectories found, no table of contents to generate.")
+        book.width = int(book.dpi * 8.5) # Assume 8.5in
+        book.height = int(book.dpi * 11) # Assume 11in
+
+    # Size blank pages like the nearest image before them (or the first image, if there is none)
+    last_size = (book.width, book.height)
+    for e in book.page_list:
+        if e.kind == "page" and e.width != None:
+            last_size = (e.width, e.height)
+        elif e.kind == "blank":
+            e.width, e.height = last_size
+
+    # Report pages that can't be read, and pages with a different size than most (turned pages are fine)
+    book.bad_pages = [e for e in image_entries if e.probe["error"] != None]
+    for e in book.bad_pages:
+        log("[UNREADABLE]: {}".format(e.path))
+        log("\t{}".format(e.probe["error"]))
+    book.mismatched_pages = list()
+    if len(good_entries) > 0:
+        common_size = collections.Counter([(e.width, e.height) for e in good_entries]).most_common(1)[0][0]
+        for e in good_entries:
+            if (e.width, e.height) != common_size and (e.height, e.width) != common_size:
+                book.mismatched_pages.append(e)
+                log("[MISMATCH]: {} ( {}x{}, most pages are {}x{} )".format(e.path, e.width, e.height, common_size[0], common_size[1]))
+    log("\tDone! Probed {} images ( {} unreadable, {} with a different size )".format(
+        len(image_entries), len(book.bad_pages), len(book.mismatched_pages)))
+
+    if profile != None:
+        profile.stop(probe_token, pages=len(image_entries), bytes_read=probe_bytes_read)
+
+# Function to make the bookmark hierarchy of a scanned book from its tree index (sets book.bookmarks)
+def make_bookmarks(book, log=print, profile=None):
+    if profile != None:
+        bookmarks_token = profile.start("bookmarks", peak_rss=True)
+    log()
+    log("-------- BOOKMARKS --------")
+    log("Creating bookmark hierarchy from directory structure...")
+    book.bookmarks = list()
+    if len([e for e in book.tree_root.children if e.is_dir and (e.num_dirs > 0 or e.num_files > 0)]) <= 0:
+        log()
+        log("[WARNING]: No subdirectories found, not creating bookmarks.")
     else:
-        # Add nested bookmarks from page_dict
-        ident_level = 0
-        last_page_index = -1 # Because we want the next page to be 0
-        path_list = list()
-        bookmark_list = list()
-        page_ref = None
-        def iterdict(d, base_path="", empty_parents_in=list()):
-            global ident_level
-            global path_list
-            global last_page_index
-            global page_ref
-            global toc_dict_list
-
-            for k, v in d.items():
-                filepath = os.path.join(base_path, os.path.sep.join(path_list))
-                filename = os.path.join(filepath, k)
-                filename = os.path.realpath(filename)
-                
-                # Get parent bookmark
-                if len(bookmark_list) > 0:
-                    bm_parent = bookmark_list[-1]
-                else:
-                    bm_parent = None
-                
+        separator = book.config.order_number_separator
+
+        # Add nested bookmarks from the tree index (pages are referenced with the precomputed page offsets)
+        def add_bookmarks(dir_entry, ident_level=0, bm_parent=None):
+            for e in dir_entry.children:
+                # Only directories get bookmarks
+                if not e.is_dir:
+                    continue
+
                 # Get bookmark name
-                if filename in page_dir_rename_dict:
+                k = os.path.basename(e.rel_path)
+                if e.rename_name != None:
                     # Name is defined in a rename file
-                    bm_name = page_dir_rename_dict[filename]
-                elif args["order_number_separator"] != None:
+                    bm_name = e.rename_name
+                elif separator != None:
                     # Remove leading order numbers from dir name
-                    k_split = k.split(args["order_number_separator"])
+                    k_split = k.split(separator)
                     if len(k_split) <= 1:
                         bm_name = k
                     else:
-                        bm_name = args["order_number_separator"].join(k_split[1:]).strip(" ")
+                        bm_name = separator.join(k_split[1:]).strip(" ")
                 else:
                     bm_name = k
-                
-                page_ref = last_page_index + 1
-                
-                # Test if it's a file or a directory
-                if len(v) > 0:
-                    # It's a not-fully-empty dir (pages/folders)
-                    
-                    # Get recursive list of files and folders
-                    v_list = [str(x) for x in Path(filename).glob('**/*')]
-                    v_dir_list = [x for x in v_list if os.path.isdir(x)]
-                    v_file_list = [x for x in v_list if os.path.isfile(x) and os.path.splitext(x)[-1] in page_exts]
-                    
-                    # Deal with recursively empty folders
-                    empty_parents = list()
-                    if len(v_file_list) <= 0:
-                        # Test if is not a subdir of an empty_parent
-                        is_subdir_of_empty_parent = False
-                        for empty_parent in empty_parents:
-                            if os.path.commonpath([filename, empty_parent]) == empty_parent:
-                                is_subdir_of_empty_parent = True
-                        if not is_subdir_of_empty_parent:
-                            # This is the main parent
-                            page_ref += 1
-                            empty_parents.append(filename)
-                    
-                    # Prevent referencing non-existent pages
-                    page_ref = min(page_ref, num_pages - 1)
-                    
-                    # Save to toc_dict_list
-                    toc_dict_list.append({
-                        "name": bm_name,
-                        "level": ident_level,
-                        "page": page_ref + 1
-                        })
-                    
-                    ident_level += 1
-                    
-                    if not args["no_pdf"]:
-                        # Add bookmark w/ parent, save as potential parent
-                        bm = output_pdf.addBookmark(bm_name, page_ref, parent=bm_parent)
-                        
-                        # Add to bookmarks list
-                        bookmark_list.append(bm)
-                    
-                    path_list.append(k)
-                    
-                    # Do recursion
-                    iterdict(v, base_path=base_path, empty_parents_in=empty_parents)
-                    
-                    if not args["no_pdf"]:
-                        temp = bookmark_list.pop()
-                    temp = path_list.pop()
-                    
-                    ident_level -= 1
+
+                # Reference the first page after this directory's position
+                page_ref = e.page_offset
+
+                # Test if it's a totally empty directory (no pages/children)
+                is_empty_dir = e.num_dirs <= 0 and e.num_files <= 0
+
+                # Deal with recursively empty folders (and the empty directories directly inside them)
+                if not is_empty_dir:
+                    if e.num_pages <= 0:
+                        page_ref += 1
+                elif dir_entry != book.tree_root and dir_entry.num_pages <= 0:
+                    page_ref += 1
+
+                # Prevent referencing non-existent pages
+                page_ref = min(page_ref, book.num_pages - 1)
+
+                book.bookmarks.append({
+                    "name": bm_name,
+                    "level": ident_level,
+                    "page": page_ref + 1,
+                    "parent": bm_parent
+                    })
+                bm = len(book.bookmarks) - 1
+
+                # Do recursion (empty directories are abandoned as potential parents)
+                if not is_empty_dir:
+                    add_bookmarks(e, ident_level=ident_level + 1, bm_parent=bm)
+        add_bookmarks(book.tree_root)
+        log("\tDone!")
+
+    if profile != None:
+        profile.stop(bookmarks_token)
+    return book.bookmarks
+
+# Function to split the pages of a book into its top level parts (pages in the main directory next to each other are a part too)
+# Returns lists of page/blank entries, in page order
+def get_book_parts(book):
+    book_parts = list()
+    last_part_name = None
+    for e in book.page_list:
+        if e.is_dir:
+            continue
+        part_name = e.rel_path.split(os.path.sep)[0] if os.path.sep in e.rel_path else None
+        if len(book_parts) <= 0 or part_name != last_part_name:
+            book_parts.append(list())
+        book_parts[-1].append(e)
+        last_part_name = part_name
+    return book_parts
+
+# Function to write the pages of one part of a book to a PDF fragment file (runs inside worker processes)
+# Pages are (kind, path, width, height, memory), purify_settings is a purify task without the path (None to not purify)
+# archive_path is the archive the pages are in (None for a normal directory), the worker opens it for itself
+# max_memory is the part's share of the memory limit in bytes (None for no limit), pages are only read ahead while their memory fits in it
+# Returns the fragment's object offsets and page object numbers, the purify cache hits/misses, bytes read, CPU seconds, and peak memory
+def build_pdf_part(part_task):
+    fragment_file, first_id, pages_id, pages, dpi, max_dpi, prefetch, purify_settings, archive_path, max_memory = part_task
+    reset_peak_rss()
+    cpu_start = time.process_time()
+    part_result = {
+        "first_id": first_id,
+        "cache_hits": 0,
+        "cache_misses": 0,
+        "bytes_read": 0
+        }
+
+    archive = BookArchive(archive_path) if archive_path != None else None
+    image_pages = [x for x in pages if x[0] == "page"]
+    page_data = prefetch_map(lambda p: read_file(p, archive), [x[1] for x in image_pages], prefetch, [x[4] for x in image_pages], max_memory)
+    try:
+        with open(fragment_file, "wb") as f:
+            fragment = PdfStreamWriter(f, first_id=first_id, pages_id=pages_id)
+            for kind, page_file, width, height, memory in pages:
+                if kind == "blank":
+                    fragment.add_blank_page(width * 72 / dpi, height * 72 / dpi)
+                    continue
+                data = next(page_data)
+                part_result["bytes_read"] += len(data)
+                if purify_settings != None:
+                    pdf_image, cache_hit = purify_page((page_file,) + purify_settings, data)
+                    if cache_hit:
+                        part_result["cache_hits"] += 1
+                    else:
+                        part_result["cache_misses"] += 1
+                else:
+                    pdf_image = read_page_image(page_file, dpi, max_dpi, data=data)
+                fragment.add_image_page(pdf_image)
+    except BaseException:
+        if os.path.exists(fragment_file):
+            os.remove(fragment_file)
+        raise
+    finally:
+        page_data.close()
+        if archive != None:
+            archive.close()
+
+    part_result["obj_offsets"] = fragment.obj_offsets
+    part_result["page_ids"] = fragment.page_ids
+    part_result["cpu_seconds"] = time.process_time() - cpu_start
+    part_result["peak_rss"] = get_peak_rss()
+    return part_result
+
+# Function to write the PDF of a scanned book (to a temporary file first, so the old PDF is only replaced by a finished one)
+# Purifies with purify_pool if given, otherwise makes its own pool for config.purify_jobs workers
+# With config.parallel_parts, the top level parts are built in their own pool of config.purify_jobs workers instead
+# Returns the build stats: pages, output_file, size, cache_hits, cache_misses, reused, resumed, dedup_pages, dedup_bytes
+# Adds the "pdf" stage (and its "read", "purify", "parts", "write", and "linearize" parts) and the "cache_trim" stage to profile, if given
+def build_pdf(book, purify_pool=None, cache=None, log=print, profile=None):
+    config = book.config
+    purify = config.purify
+    page_list = book.page_list
+    num_image_pages_len = len(str(book.num_image_pages))
+    num_blank_pages = book.num_pages - book.num_image_pages
+    num_blank_pages_len = len(str(num_blank_pages))
+    stats = {
+        "pages": book.num_pages,
+        "output_file": book.output_file,
+        "size": 0,
+        "cache_hits": 0,
+        "cache_misses": 0,
+        "reused": 0,
+        "resumed": 0,
+        "dedup_pages": 0,
+        "dedup_bytes": 0
+        }
+
+    # Time the parts of the build into a throwaway profile if none is given (it is cheap and keeps the page loop simple)
+    # Memory and worker CPU time are only measured when asked for
+    profiling = profile != None
+    if not profiling:
+        profile = BuildProfile()
+    purify_func = profile_purify_page if profiling else purify_page
+    pdf_token = profile.start("pdf", peak_rss=profiling)
+    pdf_bytes_read = 0
+
+    # Stop before writing anything if a page can't be read
+    if len(book.bad_pages) > 0:
+        raise ValueError("{} page(s) can not be read as images, the first one is: {}".format(len(book.bad_pages), book.bad_pages[0].path))
+
+    log()
+    log("-------- PDF CREATION --------")
+    log("Creating PDF document from image files: {}".format(book.output_file))
+    output_temp_file = "{}.{}.tmp".format(book.work_file, os.getpid())
+    linear_temp_file = "{}.{}.linear.tmp".format(book.work_file, os.getpid())
+
+    # With a memory limit, every page counts with the most memory it can use (its purified or converted size, from its header)
+    # Pages being purified, converted, or read ahead are only started while they fit in it
+    max_memory_bytes = None
+    page_memory = dict()
+    if config.max_memory != None:
+        max_memory_bytes = config.max_memory * 1024 * 1024
+        page_memory = {e.path: estimate_purify_memory(e.path, e.probe, book.archive) for e in page_list if e.kind == "page"}
+        if len(page_memory) > 0 and max(page_memory.values()) > max_memory_bytes:
+            log("[WARNING]: Some pages need more than the memory limit, they will be processed one at a time.")
+
+    # Function to read pages in a thread ahead of using them (as many as --prefetch and the memory limit allow)
+    def read_ahead(page_files, depth=book.prefetch):
+        return prefetch_map(lambda p: read_file(p, book.archive), page_files, depth,
+            [page_memory[p] for p in page_files] if max_memory_bytes != None else None, max_memory_bytes)
+
+    if config.work_dir != None:
+        os.makedirs(book.work_dir, exist_ok=True)
+    own_pool = None
+    page_data = None
+    resume = None
+    fragment_files = list()
+    output_pdf_file = open(output_temp_file, "wb")
+    try:
+        output_pdf = PdfStreamWriter(output_pdf_file, dedup_images=config.dedup)
+
+        # Build the top level parts of the book in parallel worker processes, then join them (--parallel_parts)
+        # Object numbers are worked out first, so each part is written as a fragment of this PDF and copied in as it is
+        book_parts = list()
+        # Parts can't share images with each other, so they are not used with dedup
+        if config.parallel_parts and config.purify_jobs > 1 and cache == None and not config.resume and not config.dedup:
+            book_parts = get_book_parts(book)
+        if len(book_parts) > 1:
+            log("Building {} parts in {} worker processes...".format(len(book_parts), config.purify_jobs))
+            purify_settings = None
+            if purify:
+                purify_settings = (config.sharpen_factor, config.thresh_setting, book.dpi, config.cache_dir, config.purify_engine,
+                    config.purify_compression, config.max_dpi)
+            part_tasks = list()
+            first_id = output_pdf.first_id + len(output_pdf.obj_offsets)
+            for n, part in enumerate(book_parts):
+                part_pages = [(e.kind, e.path, e.width, e.height, page_memory.get(e.path, 0)) for e in part]
+                fragment_files.append("{}.{}.part{}.tmp".format(book.work_file, os.getpid(), n + 1))
+                # Every worker gets the same share of the memory limit
+                part_tasks.append((fragment_files[-1], first_id, output_pdf.pages_id, part_pages, book.dpi, config.max_dpi,
+                    book.prefetch, purify_settings, book.archive.path if book.archive != None else None,
+                    max_memory_bytes // config.purify_jobs if max_memory_bytes != None else None))
+                first_id += sum([PdfStreamWriter.image_page_objects if e.kind == "page" else PdfStreamWriter.blank_page_objects for e in part])
+
+            # Parts have their own pool, so it can be stopped before the fragments are cleaned up
+            own_pool = multiprocessing.Pool(processes=config.purify_jobs, initializer=purify_worker_init)
+            part_results = own_pool.imap(build_pdf_part, part_tasks)
+            num_parts_len = len(str(len(book_parts)))
+            for n, part in enumerate(book_parts):
+                # The wall time is the time spent waiting for the part
+                part_start = time.perf_counter()
+                part_result = next(part_results)
+                profile.add("parts", wall_seconds=time.perf_counter() - part_start, cpu_seconds=part_result["cpu_seconds"],
+                    pages=len(part), bytes_read=part_result["bytes_read"], peak_rss=part_result["peak_rss"] if profiling else None)
+                pdf_bytes_read += part_result["bytes_read"]
+                stats["cache_hits"] += part_result["cache_hits"]
+                stats["cache_misses"] += part_result["cache_misses"]
+
+                write_token = profile.start("write")
+                write_start = output_pdf_file.tell()
+                output_pdf.add_fragment(fragment_files[n], part_result["first_id"], part_result["obj_offsets"], part_result["page_ids"])
+                profile.stop(write_token, pages=len(part), bytes_written=output_pdf_file.tell() - write_start)
+                os.remove(fragment_files[n])
+
+                part_name = part[0].rel_path.split(os.path.sep)[0] if os.path.sep in part[0].rel_path else book.input_dir_name
+                log("[PART] ({}/{}): {} ( {} pages )".format(str(n + 1).rjust(num_parts_len), len(book_parts), part_name, len(part)))
+            own_pool.close()
+            own_pool.join()
+            own_pool = None
+        else:
+            # Purify image pages in memory (in page order, even when using multiple workers)
+            if purify and book.num_image_pages > 0:
+                log("Purifying images in memory (no temporary files)...")
+                # Pages purified by an earlier build (watch mode) are reused if the file did not change
+                # They are taken out of the cache first, so pages added during this build can't push them out before they are written
+                page_keys = dict()
+                reused_pages = dict()
+                if cache != None:
+                    page_keys = {e.path: get_page_key(e.path, book.archive) for e in page_list if e.kind == "page"}
+                    cache.keep_pages(page_keys.values())
+                    reused_pages = {p: cache.get_page(k) for p, k in page_keys.items() if k in cache.pages}
+                # Pages finished by an earlier build that did not complete are reused if the file did not change (--resume)
+                resumed_paths = set()
+                if config.resume:
+                    resume = ResumeManifest(book.resume_dir, {
+                        "sharpen_factor": float(config.sharpen_factor),
+                        "thresh_setting": float(config.thresh_setting),
+                        "dpi": book.dpi,
+                        "compression": config.purify_compression,
+                        "max_dpi": config.max_dpi
+                        }, book.archive)
+                    log("Loading finished pages of an earlier build: {}".format(book.resume_dir))
+                    resume.open()
+                    page_stats = {e.path: stat_file(e.path, book.archive) for e in page_list if e.kind == "page"}
+                    resumed_paths = set([p for p in page_stats if p not in reused_pages and resume.has(p)])
+                    log("\tFound {} finished pages".format(len(resumed_paths)))
+
+                def make_purify_task(page_file):
+                    return (page_file, config.sharpen_factor, config.thresh_setting, book.dpi, config.cache_dir, config.purify_engine,
+                        config.purify_compression, config.max_dpi)
+                purify_tasks = [make_purify_task(e.path) for e in page_list
+                    if e.kind == "page" and e.path not in reused_pages and e.path not in resumed_paths]
+                if purify_pool == None and config.purify_jobs > 1 and len(purify_tasks) > 1:
+                    own_pool = multiprocessing.Pool(processes=config.purify_jobs, initializer=purify_worker_init)
+                    purify_pool = own_pool
+                if purify_pool != None and len(purify_tasks) > 1:
+                    worker_func = purify_func
+                    worker_tasks = purify_tasks
+                    if book.archive != None:
+                        # Workers can't use the book's open archive, so its pages are read here (a few ahead) and sent with the task
+                        # With a memory limit a page is only read when it is started, so it is counted with the pages in flight
+                        page_data = read_ahead([x[0] for x in purify_tasks], book.prefetch if max_memory_bytes == None else 0)
+                        worker_func = star_call
+                        worker_tasks = ((purify_func, (x, data)) for x, data in zip(purify_tasks, page_data))
+                    if max_memory_bytes != None:
+                        # Only start as many pages as fit in the memory limit (finished pages are written right away)
+                        purified_pages = bounded_imap(purify_pool, worker_func, worker_tasks, [page_memory[x[0]] for x in purify_tasks], max_memory_bytes)
+                    elif book.archive != None:
+                        # Pool.imap would read the whole archive ahead, so only a couple of pages per worker are in flight
+                        purified_pages = bounded_imap(purify_pool, worker_func, worker_tasks, [1] * len(purify_tasks),
+                            2 * max(1, config.purify_jobs))
+                    else:
+                        purified_pages = purify_pool.imap(worker_func, worker_tasks)
                 else:
-                    # Either it's a file or an empty (placeholder) dir
-                    if os.path.isdir(filename):
-                        # It's a totally empty directory, make an "empty" bookmark (no pages/children, references next page)
-                        
-                        # Deal with children of empty parents
-                        empty_parents = empty_parents_in
-                        is_subdir_of_empty_parent = False
-                        for empty_parent in empty_parents:
-                            if os.path.commonpath([filename, empty_parent]) == empty_parent:
-                                is_subdir_of_empty_parent = True
-                        if is_subdir_of_empty_parent:
-                            # Adjust page number forward
-                            page_ref += 1
-                        
-                        # Prevent referencing non-existent pages
-                        page_ref = min(page_ref, num_pages - 1)
-                        
-                        # Save to toc_dict_list
-                        toc_dict_list.append({
-                            "name": bm_name,
-                            "level": ident_level,
-                            "page": page_ref + 1
-                            })
-                        
-                        if not args["no_pdf"]:
-                            # Add bookmark w/ parent, abandon as potential parent
-                            temp = output_pdf.addBookmark(bm_name, page_ref, parent=bm_parent)
+                    # Read the upcoming pages while this one is purified (workers of a pool read their own pages)
+                    page_data = read_ahead([x[0] for x in purify_tasks])
+                    purified_pages = map(purify_func, purify_tasks, page_data)
+            else:
+                # Read the upcoming pages while this one is written
+                page_data = read_ahead([e.path for e in page_list if e.kind == "page"])
+
+            # Write pages one at a time (the bookmarks and metadata are added when saving)
+            curr_page = 0 # Will go to 1 before first print
+            blank_page_num = 0 # Goes to 1 on first page
+            for e in page_list:
+                if e.is_dir:
+                    continue
+                if e.kind == "blank":
+                    # Make a truly blank page (no image) the same size as the first image
+                    blank_page_num += 1
+                    curr_page_str = str(blank_page_num).rjust(num_blank_pages_len)
+                    log("[BLANK] ({}/{}): {}".format(curr_page_str, num_blank_pages, e.path))
+                    write_token = profile.start("write")
+                    write_start = output_pdf_file.tell()
+                    output_pdf.add_blank_page(e.width * 72 / book.dpi, e.height * 72 / book.dpi)
+                    profile.stop(write_token, pages=1, bytes_written=output_pdf_file.tell() - write_start)
+                    continue
+                if purify and e.kind == "page":
+                    curr_page += 1
+                    curr_page_str = str(curr_page).rjust(num_image_pages_len)
+                    if e.path in reused_pages:
+                        pdf_image = reused_pages.pop(e.path)
+                        stats["reused"] += 1
+                        log("[REUSED] ({}/{}): {}".format(curr_page_str, book.num_image_pages, e.path))
+                        write_token = profile.start("write")
+                        write_start = output_pdf_file.tell()
+                        output_pdf.add_image_page(pdf_image)
+                        profile.stop(write_token, pages=1, bytes_written=output_pdf_file.tell() - write_start)
+                        continue
+                    if e.path in resumed_paths:
+                        read_token = profile.start("read")
+                        pdf_image = resume.get(e.path)
+                        if pdf_image == None:
+                            # Damaged since it was found, purify it again
+                            pdf_image, cache_hit = purify_page(make_purify_task(e.path), read_file(e.path, book.archive))
+                            resume.add(e.path, page_stats[e.path], pdf_image)
+                        profile.stop(read_token, pages=1, bytes_read=len(pdf_image["data"]))
+                        if cache != None:
+                            cache.add_page(page_keys[e.path], pdf_image)
+                        stats["resumed"] += 1
+                        log("[RESUMED] ({}/{}): {}".format(curr_page_str, book.num_image_pages, e.path))
+                        write_token = profile.start("write")
+                        write_start = output_pdf_file.tell()
+                        output_pdf.add_image_page(pdf_image)
+                        profile.stop(write_token, pages=1, bytes_written=output_pdf_file.tell() - write_start)
+                        continue
+                    # The wall time is the time spent waiting for the page (the CPU time is measured in the workers)
+                    purify_start = time.perf_counter()
+                    if profiling:
+                        pdf_image, cache_hit, purify_cpu, purify_peak_rss, purify_bytes_read = next(purified_pages)
+                        profile.add("purify", wall_seconds=time.perf_counter() - purify_start, cpu_seconds=purify_cpu, pages=1,
+                            bytes_read=purify_bytes_read, peak_rss=purify_peak_rss)
+                        pdf_bytes_read += purify_bytes_read
+                    else:
+                        pdf_image, cache_hit = next(purified_pages)
+                        profile.add("purify", wall_seconds=time.perf_counter() - purify_start, pages=1)
+                    if cache != None:
+                        cache.add_page(page_keys[e.path], pdf_image)
+                    if resume != None:
+                        resume.add(e.path, page_stats[e.path], pdf_image)
+                    if cache_hit:
+                        stats["cache_hits"] += 1
+                        log("[CACHED] ({}/{}): {}".format(curr_page_str, book.num_image_pages, e.path))
                     else:
-                        # It's a file
-                        page_index = page_list_files.index(filename)
-                        last_page_index = page_index
-        iterdict(page_dict, base_path=final_input_dir)
-        print("\tDone!")
-        
-    if not args["no_pdf"]:
-        print("Saving bookmarked PDF: {}".format(output_file))
-        
+                        stats["cache_misses"] += 1
+                        log("[PURIFY] ({}/{}): {}".format(curr_page_str, book.num_image_pages, e.path))
+                else:
+                    # The wall time includes waiting for the page to be read ahead
+                    read_token = profile.start("read")
+                    data = next(page_data)
+                    pdf_image = read_page_image(e.path, book.dpi, config.max_dpi, data=data)
+                    read_bytes = len(data)
+                    profile.stop(read_token, pages=1, bytes_read=read_bytes)
+                    pdf_bytes_read += read_bytes
+                write_token = profile.start("write")
+                write_start = output_pdf_file.tell()
+                output_pdf.add_image_page(pdf_image)
+                profile.stop(write_token, pages=1, bytes_written=output_pdf_file.tell() - write_start)
+        log("\tDone!")
+        if config.dedup:
+            stats["dedup_pages"] = output_pdf.dedup_pages
+            stats["dedup_bytes"] = output_pdf.dedup_bytes
+            log("\tPages sharing an earlier identical image: {} ( {} bytes saved )".format(output_pdf.dedup_pages, output_pdf.dedup_bytes))
+
+        # Add bookmarks (the writer numbers them in the same order, so parents match)
+        for bm in book.bookmarks:
+            output_pdf.add_bookmark(bm["name"], bm["page"] - 1, parent=bm["parent"])
+
+        log("Saving bookmarked PDF: {}".format(book.output_file))
+
         # Create PDF metadata
         pdf_metadata_dict = dict()
-        if use_pdf_title:
-            pdf_metadata_dict['/Title'] = pdf_title
-        
-        pdf_metadata_dict['/Author'] = pdf_author
-        
+        if book.use_title:
+            pdf_metadata_dict['/Title'] = book.title
+
+        pdf_metadata_dict['/Author'] = book.author
+
         pdf_metadata_dict['/Producer'] = PROG_FILE_NAME
-        
-        # Add metadata to PDF
-        output_pdf.addMetadata(pdf_metadata_dict)
-        
-        # Save final PDF
-        with open(output_file, 'wb') as f:
-            output_pdf.write(f)
-        
-        print("\tDone!")
-    
-    
-    
-    print()
-    print("-------- TABLE OF CONTENTS --------")
-    print("Building Table of Contents from bookmark hierarchy...")
-    
+
+        # Add metadata and bookmarks, then finish the PDF
+        write_token = profile.start("write")
+        write_start = output_pdf_file.tell()
+        output_pdf.close(pdf_metadata_dict)
+        profile.stop(write_token, bytes_written=output_pdf_file.tell() - write_start)
+        output_pdf_file.close()
+
+        # Rewrite the PDF with the first page and hint tables up front, so it can be shown while it downloads
+        if config.linearize:
+            log("\tLinearizing (fast web view)...")
+            linearize_token = profile.start("linearize")
+            linearize_read = os.path.getsize(output_temp_file)
+            linearize_pdf(output_temp_file, linear_temp_file)
+            os.replace(linear_temp_file, output_temp_file)
+            profile.stop(linearize_token, pages=book.num_pages, bytes_read=linearize_read, bytes_written=os.path.getsize(output_temp_file))
+
+        # Moved within the work directory's file system, or copied if the PDF goes to another one
+        move_file(output_temp_file, book.output_file)
+        log("\tDone!")
+
+        # The finished pages are not needed anymore
+        if resume != None:
+            log("Deleting finished pages: {}".format(book.resume_dir))
+            resume.remove()
+            resume = None
+            log("\tDone!")
+    except BaseException:
+        # Stop all workers and page reads before any cleanup happens
+        if page_data != None:
+            page_data.close()
+            page_data = None
+        if own_pool != None:
+            own_pool.terminate()
+            own_pool.join()
+            own_pool = None
+        output_pdf_file.close()
+        if os.path.exists(output_temp_file):
+            log()
+            log("-------- CLEANUP --------")
+            log("Delete incomplete PDF: {}".format(output_temp_file))
+            os.remove(output_temp_file)
+            log("\tDone!")
+        if os.path.exists(linear_temp_file):
+            os.remove(linear_temp_file)
+        for fragment_file in fragment_files:
+            if os.path.exists(fragment_file):
+                os.remove(fragment_file)
+        if resume != None:
+            resume.close()
+            resume = None
+            log("Finished pages are kept for --resume: {}".format(book.resume_dir))
+        raise
+    finally:
+        if page_data != None:
+            page_data.close()
+        if resume != None:
+            resume.close()
+        if own_pool != None:
+            own_pool.terminate()
+            own_pool.join()
+        # The book's archive is not kept open after the build (it is opened again if the book is read)
+        book.close()
+
+    stats["size"] = os.path.getsize(book.output_file)
+    profile.stop(pdf_token, pages=book.num_pages, bytes_read=pdf_bytes_read, bytes_written=stats["size"])
+
+    # Keep the purify cache under its size limit
+    if purify and config.cache_dir != None and os.path.isdir(config.cache_dir):
+        trim_token = profile.start("cache_trim", peak_rss=profiling)
+        log("Trimming purify cache: {}".format(config.cache_dir))
+        num_removed, size_removed = trim_purify_cache(config.cache_dir, config.cache_size * 1024 * 1024)
+        log("\tRemoved {} least recently used pages ( {} bytes )".format(num_removed, size_removed))
+        profile.stop(trim_token)
+
+    return stats
+
+# Function to estimate the size, time, and peak memory of building the PDF of a scanned book, without building it
+# A few image pages spread over the book are read, purified/converted, and written in memory (never to the purify cache)
+# The results are scaled to the whole book by pixels (purified pages) or file size (converted pages), using the page probes
+# Scan, probe, and bookmark times are taken from profile (a BuildProfile), if given
+# Returns the estimate as a dict (bytes and seconds), assumes nothing is in the purify cache and no pages are deduplicated
+def estimate_build(book, samples=8, profile=None, log=print):
+    from PIL import Image
+
+    config = book.config
+    purify = config.purify
+    image_entries = [e for e in book.page_list if e.kind == "page" and e.probe != None and e.probe["error"] == None]
+    num_blank_pages = book.num_pages - book.num_image_pages
+    base_rss = get_peak_rss()
+
+    log()
+    log("-------- ESTIMATE --------")
+    log("Sampling up to {} of {} image pages...".format(samples, len(image_entries)))
+
+    # Size of every page (the pixels and file size of each image, the blank pages as they will be)
+    page_pixels = [e.width * e.height for e in image_entries]
+    page_sizes = [stat_file(e.path, book.archive).st_size for e in image_entries]
+
+    # Everything except the images: a PDF with a blank page for every page, the bookmarks, and the metadata
+    skeleton = PdfStreamWriter(io.BytesIO())
+    for e in book.page_list:
+        if e.kind in ["page", "blank"] and e.width != None:
+            skeleton.add_blank_page(e.width * 72 / book.dpi, e.height * 72 / book.dpi)
+        elif e.kind in ["page", "blank"]:
+            skeleton.add_blank_page(book.width * 72 / book.dpi, book.height * 72 / book.dpi)
+    for bm in book.bookmarks:
+        skeleton.add_bookmark(bm["name"], bm["page"] - 1, parent=bm["parent"])
+    skeleton.close({"/Title": book.title, "/Author": book.author, "/Producer": PROG_FILE_NAME})
+    skeleton_bytes = skeleton.f.tell()
+
+    # Read, purify/convert, and write the sample pages (spread evenly over the book)
+    num_samples = min(samples, len(image_entries))
+    sample_indexes = sorted(set([int((n + 0.5) * len(image_entries) / num_samples) for n in range(num_samples)]))
+    sample = {"pixels": 0, "bytes": 0, "read_seconds": 0.0, "process_seconds": 0.0, "write_seconds": 0.0, "image_bytes": 0}
+    for n, x in enumerate(sample_indexes):
+        e = image_entries[x]
+        read_start = time.perf_counter()
+        data = read_file(e.path, book.archive)
+        process_start = time.perf_counter()
+        if purify:
+            pdf_image, cache_hit = purify_page((e.path, config.sharpen_factor, config.thresh_setting, book.dpi, None,
+                config.purify_engine, config.purify_compression, config.max_dpi), data)
+        else:
+            pdf_image = read_page_image(e.path, book.dpi, config.max_dpi, data=data)
+        write_start = time.perf_counter()
+        sample_pdf = PdfStreamWriter(io.BytesIO())
+        page_start = sample_pdf.f.tell()
+        sample_pdf.add_image_page(pdf_image)
+        blank_start = sample_pdf.f.tell()
+        write_end = time.perf_counter()
+        sample_pdf.add_blank_page(pdf_image["width"] * 72 / pdf_image["dpi"], pdf_image["height"] * 72 / pdf_image["dpi"])
+        sample["pixels"] += page_pixels[x]
+        sample["bytes"] += page_sizes[x]
+        sample["read_seconds"] += process_start - read_start
+        sample["process_seconds"] += write_start - process_start
+        sample["write_seconds"] += write_end - write_start
+        # Only what the image page adds over a blank page of the same size (the skeleton already has that)
+        sample["image_bytes"] += (blank_start - page_start) - (sample_pdf.f.tell() - blank_start)
+        log("[SAMPLE] ({}/{}): {}".format(n + 1, len(sample_indexes), e.path))
+
+    # Scale the samples to the whole book (purify time and size follow the pixels, converted pages follow the file size)
+    total_pixels = sum(page_pixels)
+    total_bytes = sum(page_sizes)
+    if len(sample_indexes) > 0:
+        scale = total_pixels / max(sample["pixels"], 1) if purify else total_bytes / max(sample["bytes"], 1)
+        read_seconds = sample["read_seconds"] * total_bytes / max(sample["bytes"], 1)
+    else:
+        scale = 0
+        read_seconds = 0.0
+    process_seconds = sample["process_seconds"] * scale
+    write_seconds = sample["write_seconds"] * scale
+    output_bytes = skeleton_bytes + int(sample["image_bytes"] * scale)
+
+    # Work split over the worker processes (each reads its own pages), or read ahead while converting in this process
+    jobs = 1
+    if (purify or config.parallel_parts) and config.purify_jobs > 1:
+        jobs = min(config.purify_jobs, max(1, len(image_entries)))
+    if jobs > 1:
+        pdf_seconds = max((read_seconds + process_seconds) / jobs, write_seconds)
+    elif book.prefetch > 0:
+        pdf_seconds = max(read_seconds, process_seconds) + write_seconds
+    else:
+        pdf_seconds = read_seconds + process_seconds + write_seconds
+
+    # Peak memory: what this process uses now, the biggest pages being worked on at the same time, and the pages read ahead
+    if len(image_entries) > 0:
+        if purify:
+            page_memory = max([estimate_purify_memory(e.path, e.probe, book.archive) for e in image_entries])
+        else:
+            page_memory = max([e.width * e.height * Image.getmodebands(e.probe["mode"]) for e in image_entries])
+        page_memory += max(page_sizes)
+    else:
+        page_memory = 0
+    pages_in_memory = jobs
+    prefetch_pages = book.prefetch
+    if config.max_memory != None:
+        # Pages read ahead count with their page memory too, so they only fill what the pages being worked on leave
+        max_pages = config.max_memory * 1024 * 1024 // max(page_memory, 1)
+        pages_in_memory = max(1, min(jobs, max_pages))
+        prefetch_pages = max(0, min(prefetch_pages, max_pages - pages_in_memory))
+    peak_rss = None
+    if base_rss != None:
+        peak_rss = base_rss + page_memory * pages_in_memory + max(page_sizes + [0]) * prefetch_pages
+
+    stages = collections.OrderedDict()
+    if profile != None:
+        for name in ["scan", "probe", "bookmarks"]:
+            if name in profile.stages:
+                stages[name] = profile.stages[name]["wall_seconds"]
+    stages["read"] = read_seconds
+    stages["purify" if purify else "convert"] = process_seconds
+    stages["write"] = write_seconds
+    stages["pdf"] = pdf_seconds
+    estimate = {
+        "pages": book.num_pages,
+        "image_pages": len(image_entries),
+        "blank_pages": num_blank_pages,
+        "unreadable_pages": len(book.bad_pages),
+        "sampled_pages": len(sample_indexes),
+        "input_bytes": total_bytes,
+        "input_pixels": total_pixels,
+        "output_bytes": output_bytes,
+        "jobs": jobs,
+        "stage_seconds": stages,
+        "total_seconds": sum([v for k, v in stages.items() if k not in ["read", "purify", "convert", "write"]]),
+        "peak_rss": peak_rss
+        }
+
+    log("\tDone!")
+    log("Estimated PDF size: {} bytes ( {:.1f} MB )".format(output_bytes, output_bytes / 1024 / 1024))
+    log("Estimated time: {:.1f} seconds".format(estimate["total_seconds"]))
+    for name, seconds in stages.items():
+        log("\t{}: {:.2f} seconds".format(name, seconds))
+    if peak_rss != None:
+        log("Estimated peak memory: {:.1f} MB".format(peak_rss / 1024 / 1024))
+    if len(book.bad_pages) > 0:
+        log("[WARNING]: {} page(s) can not be read, the build will stop before writing.".format(len(book.bad_pages)))
+    return estimate
+
+# Function to make the lines of the text table of contents of a scanned book
+def make_table_of_contents(book, toc_line_break_limit=None, pagenum_pre="Page #", pagenum_post="  ", ident_str="--- "):
+    import textwrap
+
+    num_pages_len = len(str(book.num_pages))
+
     # Make row of ToC function
     def make_toc_row(bm_dict_in):
         ident = "".join([ident_str for x in range(bm_dict_in["level"])])
         page_toc_prefix = pagenum_pre + str(bm_dict_in["page"]).ljust(num_pages_len) + pagenum_post
         page_toc_base = page_toc_prefix + ident
-        
+
         final_row = ""
         # Break name into multiple lines if it's too long
         if toc_line_break_limit != None:
@@ -907,60 +2609,646 @@ try:
                     base_space = "".join([" " for x in range(len(page_toc_base))])
                     final_row += "\n" + base_space + l
                 return final_row
-            
+
         # If we didn't break it up, just return it
         final_row += page_toc_base + bm_dict_in["name"]
         return final_row
-    
+
     # Make rows of ToC
-    toc_row_list = [make_toc_row(r) for r in toc_dict_list]
-    
+    toc_row_list = [make_toc_row(r) for r in book.bookmarks]
+
     # Get max line width
-    toc_header_width = max([max([len(y) for y in x.split("\n")]) for x in toc_row_list])
-    
+    if len(toc_row_list) > 0:
+        toc_header_width = max([max([len(y) for y in x.split("\n")]) for x in toc_row_list])
+    else:
+        toc_header_width = len("Table of Contents")
+
     # Get ToC title
-    toc_title_lines = textwrap.fill(pdf_title, width=toc_header_width, break_long_words=False).split("\n")
+    toc_title_lines = textwrap.fill(book.title, width=toc_header_width, break_long_words=False).split("\n")
     toc_title = ["\n".join([x.center(toc_header_width) for x in toc_title_lines])]
-    
+
     # Get ToC author (if applicable)
     toc_author = list()
-    if len(pdf_author) > 0:
-        toc_header_author = "by " + pdf_author
+    if len(book.author) > 0:
+        toc_header_author = "by " + book.author
         toc_author_lines = textwrap.fill(toc_header_author, width=toc_header_width, break_long_words=False).split("\n")
         toc_author = ["\n".join([x.center(toc_header_width) for x in toc_author_lines])]
-    
+
     # Get ToC label
     toc_label_lines = textwrap.fill("Table of Contents", width=toc_header_width, break_long_words=False).split("\n")
     toc_label = ["\n".join([x.center(toc_header_width) for x in toc_label_lines])]
-    
+
     # Get ToC seperator
     toc_sep = ["".join(["-" for x in range(toc_header_width)])]
-    
+
     # Get page count text
-    toc_pagecount = ["\tPage count: {}".format(num_pages)]
-    
+    toc_pagecount = ["\tPage count: {}".format(book.num_pages)]
+
     # Make list with all ToC lines
-    final_toc_list = toc_title + toc_author + toc_label + toc_sep + toc_row_list + toc_pagecount
-    
-    print("\tDone!")
-    
+    return toc_title + toc_author + toc_label + toc_sep + toc_row_list + toc_pagecount
+
+# Function to get the path of the JSON profile of a book
+def get_profile_file(book_output_file):
+    return os.path.splitext(book_output_file)[0] + os.path.extsep + "profile" + os.path.extsep + "json"
+
+# Function to get the path of the JSON estimate of a book
+def get_estimate_file(book_output_file):
+    return os.path.splitext(book_output_file)[0] + os.path.extsep + "estimate" + os.path.extsep + "json"
+
+# Function to log the settings of a book before it is merged
+def log_settings(book, log=print):
+    config = book.config
+    log()
+    log("-------- PDF SETTINGS --------")
+    pdf_no_title_string = "PDF will have no title."
+    if book.use_title:
+        if len(book.title) <= 0:
+            log(pdf_no_title_string)
+        else:
+            log("PDF title: {}".format(book.title))
+    else:
+        log(pdf_no_title_string)
+
+    if len(book.author) <= 0:
+        log("PDF will have no author.")
+    else:
+        log("PDF author: {}".format(book.author))
+
+    if not config.no_pdf:
+        log("PDF resolution: {} DPI".format(book.dpi))
+        if config.max_dpi != None and book.dpi > config.max_dpi:
+            log("\tPages will be downsampled to {} DPI.".format(config.max_dpi))
+        if book.prefetch > 0:
+            log("Will read up to {} pages ahead.".format(book.prefetch))
+        elif config.prefetch > 0:
+            log("Will not read pages ahead from a compressed TAR archive.")
+        if config.dedup:
+            log("Will embed identical page images only once.")
+        if config.linearize and not config.estimate:
+            log("Will linearize the PDF for fast web view ( with {} ).".format(get_linearize_tool()))
+        if config.parallel_parts:
+            if config.purify_jobs > 1:
+                log("Will build the top level parts in parallel ( {} worker processes ).".format(config.purify_jobs))
+            else:
+                log("[WARNING]: (--parallel_parts) needs more than 1 (--jobs | -j), the parts will be built one at a time.")
+
+    log("Input directory: {}".format(book.input_dir))
+
+    if config.no_pdf:
+        log("Will only print the Table of Contents, will NOT process images or save PDF.")
+    elif config.estimate:
+        log("Will only estimate the PDF size, time, and peak memory from {} sample pages, will NOT save PDF.".format(config.estimate_samples))
+        if config.estimate_json:
+            log("\tEstimate file: {}".format(get_estimate_file(book.output_file)))
+    else:
+        # Print target filename
+        log("Output filename: {}".format(book.output_file))
+        if config.work_dir != None:
+            log("\tWork directory: {}".format(book.work_dir))
+
+    if config.purify:
+        log("Will purify documents:")
+        log("\tSharpening factor: {}".format(config.sharpen_factor))
+        log("\tThreshold: {}.".format(config.thresh_setting))
+        log("\tEngine: {}".format(config.purify_engine))
+        log("\tCompression: {}".format(config.purify_compression))
+        log("\tWorker processes: {}".format(config.purify_jobs))
+        if config.max_memory != None:
+            log("\tMemory limit: {} MB".format(config.max_memory))
+        if config.cache_dir != None:
+            log("\tCache directory: {} ( max {} MB )".format(config.cache_dir, config.cache_size))
+        if config.resume:
+            log("\tFinished pages are kept until the PDF is saved: {}".format(book.resume_dir))
+
+    if config.profile:
+        log("Will profile each stage.")
+        if config.profile_json:
+            log("\tProfile file: {}".format(get_profile_file(book.output_file)))
+
+    if (config.toc_break_limit, config.toc_number_prefix, config.toc_number_postfix, config.toc_indent) != (None, "Page #", "  ", "--- "):
+        log("Table of Contents formatting:")
+        log("\tName length break limit: {}".format(config.toc_break_limit))
+        log("\tPage number prefix: '{}'".format(config.toc_number_prefix))
+        log("\tPage number postfix: '{}'".format(config.toc_number_postfix))
+        log("\tIndent text: '{}'".format(config.toc_indent))
+
+# Function to log the summary of a merged book (the stats from merge_book)
+def log_job_complete(config, stats, log=print):
+    log()
+    log("-------- JOB COMPLETE --------")
+    log("Page count: {}".format(stats["pages"]))
+    if config.estimate:
+        log("Estimated PDF size: {} bytes".format(stats["estimate"]["output_bytes"]))
+        log("Estimated time: {:.1f} seconds".format(stats["estimate"]["total_seconds"]))
+        if stats["estimate"]["peak_rss"] != None:
+            log("Estimated peak memory: {:.1f} MB".format(stats["estimate"]["peak_rss"] / 1024 / 1024))
+        if "estimate_file" in stats:
+            log("Estimate saved: {}".format(stats["estimate_file"]))
+    elif not config.no_pdf:
+        log("Final PDF location: {}".format(stats["output_file"]))
+        log("File size: {} bytes".format(stats["size"]))
+        if config.purify and config.cache_dir != None:
+            log("Purify cache hits: {}".format(stats["cache_hits"]))
+            log("Purify cache misses: {}".format(stats["cache_misses"]))
+        if config.purify and stats["rebuild"]:
+            log("Reused purified pages: {}".format(stats["reused"]))
+        if config.purify and config.resume:
+            log("Resumed purified pages: {}".format(stats["resumed"]))
+        if config.dedup:
+            log("Pages sharing an identical image: {} ( {} bytes saved )".format(stats["dedup_pages"], stats["dedup_bytes"]))
+    if stats["profile"] != None:
+        log("Profile:")
+        for line in stats["profile"].report_lines():
+            log("\t" + line)
+        if "profile_file" in stats:
+            log("Profile saved: {}".format(stats["profile_file"]))
+
+# Function to do the whole job for one book like the command line (settings, scan, PDF or estimate, table of contents, summary)
+# Returns the Book and the build stats
+def merge_book(config, purify_pool=None, cache=None, log=print):
+    # The estimate uses the scan times, so it always gets a profile (it is only logged with config.profile)
+    profile = BuildProfile() if config.profile or config.estimate else None
+    # The book's archive (if it is one) is closed once its pages are read
+    with Book(config, log=log) as book:
+        log_settings(book, log)
+        book = scan(book, cache=cache, log=log, profile=profile)
+        if config.no_pdf or config.estimate:
+            stats = {"pages": book.num_pages, "output_file": None, "size": 0, "cache_hits": 0, "cache_misses": 0, "reused": 0, "resumed": 0,
+                "dedup_pages": 0, "dedup_bytes": 0}
+            if config.estimate:
+                stats["estimate"] = estimate_build(book, samples=config.estimate_samples, profile=profile, log=log)
+                if config.estimate_json:
+                    stats["estimate_file"] = get_estimate_file(book.output_file)
+                    with open(stats["estimate_file"], "w") as f:
+                        json.dump(stats["estimate"], f, indent=2)
+                        f.write("\n")
+        else:
+            stats = build_pdf(book, purify_pool=purify_pool, cache=cache, log=log, profile=profile)
+    stats["rebuild"] = cache != None # Pages can be reused from the last build
+
+    if profile != None:
+        toc_token = profile.start("toc", peak_rss=True)
+    log()
+    log("-------- TABLE OF CONTENTS --------")
+    log("Building Table of Contents from bookmark hierarchy...")
+    final_toc_list = make_table_of_contents(book, config.toc_break_limit, config.toc_number_prefix, config.toc_number_postfix, config.toc_indent)
+    log("\tDone!")
+
     # Print ToC lines
-    print()
+    log()
     for r in final_toc_list:
-        print(r)
-    
-    
-        
-    # Set to print after other exit tasks
-    def job_complete():
-        print()
-        print("-------- JOB COMPLETE --------")
-        print("Page count: {}".format(num_pages))
-        if not args["no_pdf"]:
-            print("Final PDF location: {}".format(output_file))
-            print("File size: {} bytes".format(os.path.getsize(output_file)))
-except KeyboardInterrupt:
-    print()
-    print()
+        log(r)
+
+    if not config.profile:
+        profile = None
+    stats["profile"] = profile
+    if profile != None:
+        profile.stop(toc_token)
+        if config.profile_json:
+            stats["profile_file"] = get_profile_file(book.output_file)
+            profile.save(stats["profile_file"])
+
+    log_job_complete(config, stats, log)
+    return book, stats
+
+# Function to merge one book of a batch, a failed book does not stop the others
+# Returns the book's result for the batch report
+def merge_batch_book(config, purify_pool=None, log=print):
+    book_result = {"dir": config.input_dir, "pages": 0, "size": 0, "error": None}
+    try:
+        book, stats = merge_book(config, purify_pool=purify_pool, log=log)
+        book_result["pages"] = stats["pages"]
+        book_result["size"] = stats["size"]
+    except Exception as ex:
+        log()
+        log("[ERROR]: Book failed: {}".format(repr(ex)))
+        book_result["error"] = repr(ex)
+    return book_result
+
+# Function to merge one book of a batch in a worker process, returns its result with everything it logged
+def merge_batch_book_worker(config):
+    book_log = io.StringIO()
+    book_result = merge_batch_book(config, log=lambda *x: print(*x, file=book_log))
+    book_result["log"] = book_log.getvalue()
+    return book_result
+
+# Function to list the books in a directory for merge_books() (every subdirectory and archive in it)
+def find_books(dir_path):
+    with os.scandir(dir_path) as it:
+        return sorted([x.path for x in it if x.is_dir() or (x.is_file() and is_archive_path(x.path))], key=os.path.normcase)
+
+# Function to merge several books, each into its own PDF (like merge_book)
+# With more than 1 job, several books are merged at the same time, one book per worker process
+# A failed book does not stop the others, the report at the end lists them
+# Returns the results of the books (dicts with "dir", "pages", "size", and "error" or None), in the order of configs
+def merge_books(configs, jobs=1, log=print):
+    import copy
+
+    batch_start_time = time.perf_counter()
+    batch_results = list()
+
+    for config in configs:
+        if config.output_dir != None and not config.no_pdf:
+            os.makedirs(config.output_dir, exist_ok=True)
+
+    # Find the books that would be saved over another book of the batch before merging any (they may be merged at the same time)
+    batch_errors = dict()
+    batch_output_files = list()
+    for config in configs:
+        if config.no_pdf:
+            continue
+        try:
+            with Book(config, log=lambda *x: None) as book:
+                book_output_file = book.output_file
+        except Exception:
+            # The book fails with the same error when it is merged
+            continue
+        if book_output_file in batch_output_files:
+            batch_errors[config.input_dir] = repr(FileExistsError("Another book in this batch is saved as: {}".format(book_output_file)))
+        else:
+            batch_output_files.append(book_output_file)
+
+    # Function to log the header of the next finished book of the batch
+    def log_book_header(book_dir):
+        log()
+        log("-------- BOOK {}/{} --------".format(len(batch_results) + 1, len(configs)))
+        log("Book directory: {}".format(book_dir))
+
+    for config in [x for x in configs if x.input_dir in batch_errors]:
+        log_book_header(config.input_dir)
+        log()
+        log("[ERROR]: Book failed: {}".format(batch_errors[config.input_dir]))
+        batch_results.append({"dir": config.input_dir, "pages": 0, "size": 0, "error": batch_errors[config.input_dir]})
+    batch_configs = [x for x in configs if x.input_dir not in batch_errors]
+
+    # The estimate is made for the given number of jobs, so those books are still estimated one at a time
+    batch_pool = None
+    purify_pool = None
+    try:
+        if jobs > 1 and len(batch_configs) > 1 and not any([x.estimate for x in batch_configs]):
+            # The books are the jobs, a worker process can't start its own workers
+            worker_configs = [copy.copy(x) for x in batch_configs]
+            for config in worker_configs:
+                config.purify_jobs = 1
+                config.parallel_parts = False
+
+            # Each book logs everything at once when it's done, so the books don't mix
+            batch_pool = multiprocessing.Pool(processes=min(jobs, len(worker_configs)), initializer=batch_worker_init)
+            for book_result in batch_pool.imap_unordered(merge_batch_book_worker, worker_configs):
+                log_book_header(book_result["dir"])
+                for line in book_result.pop("log").split("\n")[:-1]:
+                    log(line)
+                batch_results.append(book_result)
+        else:
+            # One worker pool for the pages of every book, parallel parts make their own
+            if jobs > 1 and any([x.purify and not x.parallel_parts and not x.estimate for x in batch_configs]):
+                purify_pool = multiprocessing.Pool(processes=jobs, initializer=purify_worker_init)
+            for config in batch_configs:
+                log_book_header(config.input_dir)
+                batch_results.append(merge_batch_book(config, purify_pool if not config.parallel_parts else None, log=log))
+    finally:
+        # Stop all workers
+        if purify_pool != None:
+            purify_pool.terminate()
+            purify_pool.join()
+        if batch_pool != None:
+            batch_pool.terminate()
+            batch_pool.join()
+
+    # List the books in batch order
+    batch_dirs = [x.input_dir for x in configs]
+    batch_results.sort(key=lambda x: batch_dirs.index(x["dir"]))
+    batch_time = time.perf_counter() - batch_start_time
+    batch_failed = [x for x in batch_results if x["error"] != None]
+    batch_pages = sum([x["pages"] for x in batch_results])
+    batch_size = sum([x["size"] for x in batch_results])
+    batch_seconds = max(batch_time, 0.001)
+    batch_pdf = not all([x.no_pdf for x in configs])
+
+    log()
+    log("-------- BATCH COMPLETE --------")
+    log("Books merged: {}/{}".format(len(batch_results) - len(batch_failed), len(batch_results)))
+    for x in batch_failed:
+        log("[FAILED]: {}".format(x["dir"]))
+        log("\t{}".format(x["error"]))
+    log("Page count: {}".format(batch_pages))
+    if batch_pdf:
+        log("Total PDF size: {} bytes".format(batch_size))
+    log("Time: {:.1f} seconds".format(batch_time))
+    log("Throughput: {:.2f} pages per second, {:.2f} books per minute".format(
+        batch_pages / batch_seconds, len(batch_results) * 60 / batch_seconds))
+    if batch_pdf:
+        log("Output rate: {:.2f} MB per second".format(batch_size / batch_seconds / 1024 / 1024))
+    return batch_results
+
+# Function to merge a book (like merge_book), then merge it again whenever its directory changes, until it is stopped (with CTRL-C)
+# Directory listings, image headers, and purified pages that did not change are reused (see BuildCache)
+# delay is the number of seconds without changes to wait for before rebuilding, poll=True polls for changes instead of using inotify
+def watch_book(config, delay=2.0, poll=False, log=print):
+    if delay < 0:
+        raise ValueError("delay must be a positive number of seconds.")
+    if not os.path.isdir(config.input_dir):
+        raise ValueError("Can only watch a directory, not an archive.")
+    if config.parallel_parts or config.estimate:
+        raise ValueError("Can not watch a book with parallel_parts or estimate.")
+
+    input_dir = config.input_dir
+    # The purified pages kept in memory are limited like the purify cache
+    cache = BuildCache(config.cache_size * 1024 * 1024)
+
+    # Start watching before the first build, so changes made during it are not missed
+    with Book(config, log=lambda *x: None) as watch_book:
+        watch_output_file = watch_book.output_file
+        watch_ignore_paths = [get_profile_file(watch_output_file), watch_book.resume_dir]
+        if not config.no_pdf:
+            watch_ignore_paths += [watch_output_file, "{}.{}.tmp".format(watch_output_file, os.getpid()),
+                "{}.{}.tmp".format(watch_book.work_file, os.getpid()), "{}.{}.linear.tmp".format(watch_book.work_file, os.getpid())]
+    if config.work_dir != None:
+        watch_ignore_paths.append(config.work_dir)
+    watcher = None
+    if not poll:
+        try:
+            watcher = InotifyWatcher(input_dir, watch_ignore_paths)
+        except (OSError, AttributeError) as ex:
+            log("[WARNING]: Could not use inotify ( {} ), polling for changes instead.".format(ex))
+    if watcher == None:
+        watcher = PollingWatcher(input_dir, watch_ignore_paths)
+
+    # One worker pool for the pages of every rebuild
+    purify_pool = None
+    if config.purify and config.purify_jobs > 1:
+        purify_pool = multiprocessing.Pool(processes=config.purify_jobs, initializer=purify_worker_init)
+    try:
+        while True:
+            try:
+                merge_book(config, purify_pool=purify_pool, cache=cache, log=log)
+            except Exception as ex:
+                # Keep watching after a failed build (like a page that was still being copied)
+                log()
+                log("[ERROR]: Build failed: {}".format(repr(ex)))
+
+            try:
+                new_dirs = watcher.update(list(cache.dirs.keys()))
+            except OSError as ex:
+                # Probably out of inotify watches
+                log("[WARNING]: {}, polling for changes instead.".format(ex))
+                watcher.close()
+                watcher = PollingWatcher(input_dir, watch_ignore_paths)
+                watcher.changed_paths.add(input_dir)
+                new_dirs = list()
+
+            # Catch files added or removed in a directory before it was watched
+            for d in new_dirs:
+                if d in cache.dirs:
+                    try:
+                        d_names = sorted(os.listdir(d))
+                    except OSError:
+                        d_names = None
+                    if d_names != sorted([x.name for x in cache.dirs[d][0]]):
+                        watcher.changed_paths.add(d)
+
+            log()
+            log("-------- WATCHING --------")
+            log("Waiting for changes in: {}".format(input_dir))
+            log("\tWill rebuild after {} seconds without changes.".format(delay))
+            log("\tPress CTRL-C to stop.")
+            changed_paths = watcher.wait_for_changes(delay)
+            log("\tChanged paths: {}, rebuilding...".format(len(changed_paths)))
+            cache.forget_paths(changed_paths)
+    finally:
+        # Stop all workers
+        watcher.close()
+        if purify_pool != None:
+            purify_pool.terminate()
+            purify_pool.join()
+
+# Command line interface, returns the exit code
+def main(argv=None):
+    # Parse arguments before running main program
+    def dir_path(string):
+        if os.path.isdir(string) or (os.path.isfile(string) and is_archive_path(string)):
+            return string
+        else:
+            raise NotADirectoryError(string)
+
+    #TODO: Add usage examples
+    ap = argparse.ArgumentParser(description="Merge nested image directory into PDF with nested bookmarks.")
+    ap.add_argument("-i", "--input_dir", type=dir_path, required=True, nargs="+",
+        help="path to nested image directory ( or ZIP/CBZ/TAR archive of one ) to merge ( more than one merges each into its own PDF )")
+    ap.add_argument("-o", "--output_file", type=str, default=None,
+        help="output file path ( defaults to [input_dir].pdf, the output directory when merging more than one book )")
+    ap.add_argument("-s", "--order_number_separator", type=str, default=None,
+        help="the character used to separate the directory ordering numbers from the bookmark names ( like '.' or ')' )")
+    ap.add_argument("-n", "--no_pdf", action="store_true",
+        help="just scan directory and print table of contents")
+    ap.add_argument("-p", "--purify", action="store", default=None, nargs="*", type=str,
+        help="purify scanned B&W page ( greyscale, sharpen, threshold ), named sub-arguments: (sharpen|s) (threshold|t) (engine|e) (compression|c)")
+    ap.add_argument("-d", "--dpi", type=int, default=None,
+        help="dots-per-inch of the input images")
+    ap.add_argument("-t", "--title", type=str, default=None,
+        help="the PDF title ( defaults to the directory basename )")
+    ap.add_argument("-a", "--author", type=str, default=None,
+        help="the PDF author")
+    ap.add_argument("-f", "--table_of_contents_format", action="store", default=None, nargs="*", type=str,
+        help="formatting options for the table of contents, named sub-arguments: (break_limit|b) (number_prefix|p) (number_postfix|a) (indent|i)")
+    ap.add_argument("-j", "--jobs", type=int, default=1,
+        help="number of worker processes used to purify pages, build parts, or merge the books of a batch ( 0 uses all CPU cores, defaults to 1 )")
+    ap.add_argument("-c", "--cache_dir", type=str, default=None,
+        help="directory to keep purified pages in, so unchanged pages are not purified again on the next run")
+    ap.add_argument("--cache_size", type=int, default=1024,
+        help="maximum size of the purify cache in megabytes ( and of the purified pages kept in memory by --watch ), least recently used pages are deleted first ( defaults to 1024 )")
+    ap.add_argument("-m", "--max_memory", type=int, default=None,
+        help="memory limit in megabytes for the pages being purified, converted, or read ahead at the same time ( defaults to no limit )")
+    ap.add_argument("--max_dpi", type=int, default=None,
+        help="downsample pages above this resolution while converting ( defaults to keeping every pixel )")
+    ap.add_argument("--prefetch", type=int, default=4,
+        help="number of upcoming page files to read ahead while the current page is processed, 0 reads them one at a time ( defaults to 4 )")
+    ap.add_argument("-r", "--resume", action="store_true",
+        help="keep purified pages in [output_file].resume until the PDF is saved, so a build that fails or is stopped continues where it left off")
+    ap.add_argument("--parallel_parts", action="store_true",
+        help="build each top level directory in its own worker process ( with --jobs ), then join them into the PDF")
+    ap.add_argument("--dedup", action="store_true",
+        help="embed identical page images ( same file, or same purified page ) only once, the pages share it")
+    ap.add_argument("--work_dir", type=str, default=None,
+        help="directory for the unfinished PDF, its parts, and the --resume pages, like a local SSD or tmpfs ( defaults to next to the PDF )")
+    ap.add_argument("--linearize", action="store_true",
+        help="write a linearized PDF ( fast web view ), so viewers can show the first page before the whole file is downloaded, needs pikepdf or qpdf")
+    ap.add_argument("-b", "--batch", action="store_true",
+        help="merge every subdirectory and archive in the input directories into its own PDF, using one shared worker pool")
+    ap.add_argument("-w", "--watch", action="store_true",
+        help="keep running and rebuild the PDF whenever the input directory changes")
+    ap.add_argument("--watch_delay", type=float, default=2.0,
+        help="seconds to wait after the last change before rebuilding ( defaults to 2 )")
+    ap.add_argument("--watch_poll", action="store_true",
+        help="poll for changes instead of using inotify ( for network drives or when inotify is not available )")
+    ap.add_argument("--profile", action="store_true",
+        help="measure the time, CPU time, bytes read/written, pages per second, and peak memory of each stage")
+    ap.add_argument("--profile_json", action="store_true",
+        help="also save the measurements as JSON next to the PDF ( [output_file].profile.json, implies --profile )")
+    ap.add_argument("-e", "--estimate", action="store_true",
+        help="only estimate the PDF size, build time, and peak memory from a few sample pages, will NOT save the PDF")
+    ap.add_argument("--estimate_json", action="store_true",
+        help="also save the estimate as JSON next to where the PDF would be ( [output_file].estimate.json, implies --estimate )")
+    ap.add_argument("--estimate_samples", type=int, default=8,
+        help="number of pages the estimate is made from, spread over the book ( defaults to 8 )")
+    args = vars(ap.parse_args(argv))
+
     print()
-    print("[CTRL-C] Exiting...")
\ No newline at end of file
+
+    # Function to resolve a directory into an absolute path (relative to working directory!)
+    def resolve_input_dir(input_dir):
+        input_dir = os.path.realpath(input_dir)
+        if not os.path.isabs(input_dir):
+            input_dir_split = input_dir.split(os.path.sep)
+            if input_dir_split[0] == os.path.curdir:
+                input_dir = os.path.sep.join(input_dir_split[1:])
+            input_dir = os.path.join(COMMAND_PATH, input_dir)
+        return input_dir
+
+    # Get the books to merge (in batch mode, every subdirectory and archive in the input directories is a book)
+    book_dirs = list()
+    for d in args["input_dir"]:
+        d = resolve_input_dir(d)
+        if args["batch"]:
+            book_dirs += find_books(d)
+        else:
+            book_dirs.append(d)
+    if len(book_dirs) <= 0:
+        raise argparse.ArgumentTypeError("No book directories found in the input directories.")
+    batch = args["batch"] or len(book_dirs) > 1
+    if batch and args["watch"]:
+        raise argparse.ArgumentTypeError("(--watch | -w) can only watch a single input directory.")
+
+    # Test if/which purify flavor is being used (not if --no_pdf is set)
+    purify = args["purify"] != None and not args["no_pdf"]
+    purify_args = args["purify"] if args["purify"] != None else ()
+
+    # Set number of purification worker processes
+    purify_jobs = multiprocessing.cpu_count() if args["jobs"] == 0 else args["jobs"]
+
+    # Parse ToC formatting sub-arguments (the values are checked by BookConfig)
+    toc_settings = {"toc_break_limit": None, "toc_number_prefix": "Page #", "toc_number_postfix": "  ", "toc_indent": "--- "}
+    for tocf_arg in args["table_of_contents_format"] if args["table_of_contents_format"] != None else ():
+        tocf_arg_split = tocf_arg.split("=")
+
+        # Only allow [string]=[string]
+        if len(tocf_arg_split) != 2:
+            raise argparse.ArgumentTypeError("Invalid argument format. Use arg_name=arg_value.")
+
+        # Get name and value separately
+        tocf_arg_name, tocf_arg_value = [x.lower() for x in tocf_arg_split]
+
+        if tocf_arg_name in ["break_limit", "b"]:
+            try:
+                toc_settings["toc_break_limit"] = int(tocf_arg_value.strip())
+            except ValueError:
+                raise argparse.ArgumentTypeError("(--break_limit | -b) length must be an integer, or 0 for no limit.")
+            if toc_settings["toc_break_limit"] == 0:
+                toc_settings["toc_break_limit"] = None
+        elif tocf_arg_name in ["number_prefix", "p"]:
+            toc_settings["toc_number_prefix"] = tocf_arg_value
+        elif tocf_arg_name in ["number_postfix", "a"]:
+            toc_settings["toc_number_postfix"] = tocf_arg_value
+        elif tocf_arg_name in ["indent", "i"]:
+            toc_settings["toc_indent"] = tocf_arg_value
+        else:
+            raise argparse.ArgumentTypeError("'{}' is not a valid option for (--break_limit | -b).".format(tocf_arg_name))
+
+    # Parse purify sub-arguments (the values are checked by BookConfig)
+    purify_settings = dict()
+    for p_arg in purify_args:
+        p_arg_split = p_arg.split("=")
+
+        # Only allow [string]=[string]
+        if len(p_arg_split) != 2:
+            raise argparse.ArgumentTypeError("Invalid argument format. Use arg_name=arg_value.")
+
+        # Get name and value separately
+        p_arg_name, p_arg_value = [x.lower().strip() for x in p_arg_split]
+
+        if p_arg_name in ["sharpen", "s", "threshold", "t"]:
+            p_setting = "sharpen_factor" if p_arg_name in ["sharpen", "s"] else "thresh_setting"
+            try:
+                purify_settings[p_setting] = float(p_arg_value)
+            except ValueError:
+                raise argparse.ArgumentTypeError("(--purify | -p) {} must be a number.".format(p_arg_name))
+        elif p_arg_name in ["engine", "e"]:
+            purify_settings["purify_engine"] = p_arg_value
+        elif p_arg_name in ["compression", "c"]:
+            purify_settings["purify_compression"] = p_arg_value
+        else:
+            raise argparse.ArgumentTypeError("'{}' is not a valid option for (--purify | -p).".format(p_arg_name))
+
+    # Print main program warnings
+    if args["no_pdf"] and args["purify"] != None:
+        print("[WARNING]: Both (--purify|-p) and (--no_pdf|-n) arguments were passed, will not make PDF.")
+    if args["resume"] and not purify:
+        print("[WARNING]: (--resume|-r) only keeps purified pages, it does nothing without (--purify|-p).")
+
+    # Function to get the settings for one book (bad settings are command line errors)
+    def make_config(book_dir):
+        try:
+            return BookConfig(book_dir,
+                output_file=None if batch else args["output_file"],
+                output_dir=args["output_file"] if batch else None,
+                order_number_separator=args["order_number_separator"],
+                title=args["title"],
+                author=args["author"],
+                dpi=args["dpi"],
+                purify=purify,
+                purify_jobs=purify_jobs,
+                cache_dir=os.path.realpath(args["cache_dir"]) if args["cache_dir"] != None else None,
+                cache_size=args["cache_size"],
+                max_memory=args["max_memory"],
+                max_dpi=args["max_dpi"],
+                prefetch=args["prefetch"],
+                resume=args["resume"],
+                parallel_parts=args["parallel_parts"],
+                dedup=args["dedup"],
+                work_dir=os.path.realpath(args["work_dir"]) if args["work_dir"] != None else None,
+                linearize=args["linearize"],
+                no_pdf=args["no_pdf"],
+                estimate=args["estimate"] or args["estimate_json"],
+                estimate_samples=args["estimate_samples"],
+                estimate_json=args["estimate_json"],
+                profile=args["profile"] or args["profile_json"],
+                profile_json=args["profile_json"],
+                **purify_settings,
+                **toc_settings)
+        except ValueError as ex:
+            raise argparse.ArgumentTypeError(str(ex))
+
+    # We will be catching KeyboardInterrupts
+    try:
+        if batch:
+            batch_results = merge_books([make_config(x) for x in book_dirs], jobs=purify_jobs)
+
+            # Let job runners know that not every book was merged
+            if len([x for x in batch_results if x["error"] != None]) > 0:
+                return 1
+        elif args["watch"]:
+            try:
+                watch_book(make_config(book_dirs[0]), delay=args["watch_delay"], poll=args["watch_poll"])
+            except ValueError as ex:
+                raise argparse.ArgumentTypeError(str(ex))
+        else:
+            try:
+                merge_book(make_config(book_dirs[0]))
+            except (ValueError, OSError) as ex:
+                # Problems with the book (like its settings files or pages), not with the program
+                print()
+                print("[ERROR]: Book failed: {}".format(ex))
+                return 1
+    except KeyboardInterrupt:
+        print()
+        print()
+        print()
+        print("[CTRL-C] Exiting...")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    # Needed for worker processes in the PyInstaller executable
+    multiprocessing.freeze_support()
+
+    sys.exit(main())
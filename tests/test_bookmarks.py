@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+
+# Regression test of make_bookmarks() (linear page offsets over the tree index) against the original iterdict algorithm
+# The original is kept below as it was (minus the PDF writer and globals), so the special cases of the linear walk can't drift:
+#   - a directory with subdirectories but no pages anywhere inside points one page further
+#   - an empty directory inside such a directory (but not in the main directory) points one page further too
+#   - no bookmark points past the last page
+# Run from the repository: python -m pytest -q tests
+
+import os, sys
+from collections import OrderedDict
+from pathlib import Path
+
+import pytest
+
+# Import bookdir2pdf.py (one directory up)
+TESTS_PATH = os.path.dirname(os.path.realpath(__file__))
+REPO_PATH = os.path.dirname(TESTS_PATH)
+sys.path.insert(0, REPO_PATH)
+import bookdir2pdf
+
+# File extentions of the original script
+old_ignored_file_exts = [".ignore", ".db"]
+old_page_exts = [".jpg", ".jpeg", ".png", ".gif", ".blank"]
+old_rename_exts = [".name", ".title"]
+old_metadata_file_exts = old_rename_exts + [".author", ".dpi"]
+old_valid_exts = old_ignored_file_exts + old_page_exts + old_metadata_file_exts
+
+# Function to read the first line in a text file (original)
+def old_read_string_from_file(string_file_name):
+    with open(string_file_name, 'r', encoding='utf-8') as f:
+        result = f.read()
+    return result.strip().split("\n")[0].strip()
+
+# Function to turn a path into the name after the os.path.extsep (original)
+def old_path_to_ext(path_in):
+    path_in_path, path_in_filename = os.path.split(path_in)
+    path_in_basename, path_in_ext = os.path.splitext(path_in_filename)
+    path_in_ext = path_in_ext.lower()
+    if path_in_ext == "":
+        path_in_ext = path_in_basename
+    if len(path_in_ext) <= 0:
+        return None
+    elif path_in_ext[0] != ".":
+        return ""
+    else:
+        return path_in_ext
+
+# Function to make the bookmarks of a book directory with the original algorithm (glob scan, nested dict, iterdict)
+# Returns a list of {"name", "level", "page", "parent"} dicts, like make_bookmarks()
+def old_bookmarks(input_dir, order_number_separator=None):
+    input_dir = os.path.realpath(input_dir)
+    input_dir_list = [str(p) for p in sorted(Path(input_dir).glob('**/*'))]
+
+    # Save image paths (and empty/ignored-file dirs) paths to ordered list
+    page_list = list()
+    page_dir_rename_dict = dict()
+    for p in input_dir_list:
+        if os.path.isfile(p):
+            p_ext = old_path_to_ext(p)
+            if p_ext not in old_valid_exts or p_ext in old_metadata_file_exts or p_ext in old_ignored_file_exts:
+                continue
+            page_list.append(p)
+        elif os.path.isdir(p):
+            p_list = [os.path.realpath(str(x)) for x in sorted(Path(p).glob('*'))]
+            p_dir_list = [x for x in p_list if os.path.isdir(x)]
+            p_file_list = [x for x in p_list if os.path.isfile(x)]
+            p_file_list_ignored = list()
+            for x in p_file_list:
+                x_path, x_filename = os.path.split(x)
+                x_ext = old_path_to_ext(x)
+                if x_ext in old_valid_exts:
+                    if x_ext not in old_ignored_file_exts + old_metadata_file_exts:
+                        p_file_list_ignored.append(x)
+                    if x_ext in old_rename_exts:
+                        page_dir_rename_dict[x_path] = old_read_string_from_file(x)
+            if len(p_dir_list) <= 0 and len(p_file_list_ignored) <= 0:
+                page_list.append(p)
+    num_pages = len([p for p in page_list if os.path.isfile(p)])
+    page_list_files = [p for p in page_list if os.path.isfile(p)]
+
+    # Create nested ordered dictionary from list
+    page_dict = OrderedDict()
+    for p in page_list:
+        p = os.path.relpath(p, input_dir)
+        current_level = page_dict
+        for part in p.split(os.path.sep):
+            if part not in current_level:
+                current_level[part] = OrderedDict()
+            current_level = current_level[part]
+
+    bookmarks = list()
+    if len([p for p in page_dict.values() if p != OrderedDict()]) <= 0:
+        return bookmarks
+
+    state = {"ident_level": 0, "last_page_index": -1}
+    path_list = list()
+    bookmark_list = list()
+    def iterdict(d, base_path="", empty_parents_in=list()):
+        for k, v in d.items():
+            filepath = os.path.join(base_path, os.path.sep.join(path_list))
+            filename = os.path.realpath(os.path.join(filepath, k))
+
+            # Get parent bookmark
+            if len(bookmark_list) > 0:
+                bm_parent = bookmark_list[-1]
+            else:
+                bm_parent = None
+
+            # Get bookmark name
+            if filename in page_dir_rename_dict:
+                bm_name = page_dir_rename_dict[filename]
+            elif order_number_separator != None:
+                k_split = k.split(order_number_separator)
+                if len(k_split) <= 1:
+                    bm_name = k
+                else:
+                    bm_name = order_number_separator.join(k_split[1:]).strip(" ")
+            else:
+                bm_name = k
+
+            page_ref = state["last_page_index"] + 1
+
+            if len(v) > 0:
+                # It's a not-fully-empty dir (pages/folders)
+                v_list = [str(x) for x in Path(filename).glob('**/*')]
+                v_file_list = [x for x in v_list if os.path.isfile(x) and os.path.splitext(x)[-1] in old_page_exts]
+
+                # Deal with recursively empty folders
+                empty_parents = list()
+                if len(v_file_list) <= 0:
+                    is_subdir_of_empty_parent = False
+                    for empty_parent in empty_parents:
+                        if os.path.commonpath([filename, empty_parent]) == empty_parent:
+                            is_subdir_of_empty_parent = True
+                    if not is_subdir_of_empty_parent:
+                        page_ref += 1
+                        empty_parents.append(filename)
+
+                # Prevent referencing non-existent pages
+                page_ref = min(page_ref, num_pages - 1)
+
+                bookmarks.append({"name": bm_name, "level": state["ident_level"], "page": page_ref + 1, "parent": bm_parent})
+                state["ident_level"] += 1
+                bookmark_list.append(len(bookmarks) - 1)
+                path_list.append(k)
+
+                iterdict(v, base_path=base_path, empty_parents_in=empty_parents)
+
+                bookmark_list.pop()
+                path_list.pop()
+                state["ident_level"] -= 1
+            else:
+                if os.path.isdir(filename):
+                    # It's a totally empty directory
+                    is_subdir_of_empty_parent = False
+                    for empty_parent in empty_parents_in:
+                        if os.path.commonpath([filename, empty_parent]) == empty_parent:
+                            is_subdir_of_empty_parent = True
+                    if is_subdir_of_empty_parent:
+                        page_ref += 1
+
+                    # Prevent referencing non-existent pages
+                    page_ref = min(page_ref, num_pages - 1)
+
+                    bookmarks.append({"name": bm_name, "level": state["ident_level"], "page": page_ref + 1, "parent": bm_parent})
+                else:
+                    # It's a file
+                    state["last_page_index"] = page_list_files.index(filename)
+    iterdict(page_dict, base_path=input_dir)
+    return bookmarks
+
+# Function to not print the progress of bookdir2pdf
+def quiet(*args):
+    pass
+
+# Function to make the bookmarks of a book directory with bookdir2pdf
+def new_bookmarks(input_dir, order_number_separator=None):
+    config = bookdir2pdf.BookConfig(input_dir, order_number_separator=order_number_separator)
+    return bookdir2pdf.scan(config, log=quiet).bookmarks
+
+# Function to make a book directory from a nested dict (dicts are directories, bytes are file contents)
+def make_tree(root_dir, tree):
+    os.makedirs(root_dir, exist_ok=True)
+    for name, value in tree.items():
+        path = os.path.join(root_dir, name)
+        if isinstance(value, dict):
+            make_tree(path, value)
+        else:
+            with open(path, "wb") as f:
+                f.write(value)
+
+# A tiny real page image, so probing works
+def make_png():
+    import io
+    from PIL import Image
+
+    png_bytes = io.BytesIO()
+    Image.new("L", (17, 22), 255).save(png_bytes, format="PNG")
+    return png_bytes.getvalue()
+
+PNG = make_png()
+BLANK = b""
+
+# Trees with empty, recursively empty, and nested directories in all the places the page offsets care about
+edge_trees = {
+    # Recursively empty part in the middle (points one page further), its empty directories too
+    "empty_part_middle": {
+        "01. Part A": {"1.png": PNG, "2.png": PNG},
+        "02. Empty Part": {"01. Empty A": {}, "02. Empty B": {"01. Deeper": {".ignore": BLANK}}},
+        "03. Part B": {"1.png": PNG, "2.blank": BLANK}
+        },
+    # Empty directories in the main directory (not under an empty parent)
+    "empty_dirs_in_main": {
+        "00. Empty First": {},
+        "01. Part A": {"1.png": PNG},
+        "02. Empty Between": {".ignore": BLANK},
+        "03. Part B": {"1.png": PNG},
+        "04. Empty Last": {}
+        },
+    # Empty directories next to pages inside a part
+    "empty_dirs_in_part": {
+        "01. Part": {"01. Empty": {}, "02. page.png": PNG, "03. Empty Too": {"x.db": BLANK}, "04.blank": BLANK}
+        },
+    # Recursively empty part at the end (clamped to the last page)
+    "empty_part_last": {
+        "01. Part": {"1.png": PNG, "2.png": PNG},
+        "02. Empty": {"01. Empty Inner": {"01. Innermost": {}}, "02. Empty Other": {}}
+        },
+    # Deep nesting with a rename file and a recursively empty chapter inside a part
+    "deep_nesting": {
+        "01. Part": {
+            ".name": "Renamed Part".encode("utf-8"),
+            "01. Chapter": {"01. Section": {"1.png": PNG}, "02. Section": {"1.png": PNG, "2.png": PNG}},
+            "02. Empty Chapter": {"01. Empty Section": {}},
+            "03. Chapter": {"1.blank": BLANK}
+            },
+        "02. Part": {"01. Chapter": {"01. Section": {"01. Subsection": {"1.png": PNG}}}}
+        },
+    # Pages in the main directory before and after the parts
+    "main_dir_pages": {
+        "00.png": PNG,
+        "01. Part": {"1.png": PNG},
+        "02. Empty": {},
+        "99.blank": BLANK
+        },
+    # Only empty directories (no pages at all)
+    "no_pages": {
+        "01. Empty": {"01. Inner": {}},
+        "02. Empty": {}
+        },
+    # No subdirectories (no bookmarks)
+    "no_subdirs": {
+        "1.png": PNG,
+        "2.png": PNG
+        }
+    }
+
+@pytest.mark.parametrize("order_number_separator", [None, "."])
+def test_test_dir(order_number_separator):
+    input_dir = os.path.join(REPO_PATH, "test_dir")
+    expected = old_bookmarks(input_dir, order_number_separator)
+    assert len(expected) > 0
+    assert new_bookmarks(input_dir, order_number_separator) == expected
+
+@pytest.mark.parametrize("tree_name", list(edge_trees.keys()))
+def test_edge_trees(tmp_path, tree_name):
+    input_dir = str(tmp_path / tree_name)
+    make_tree(input_dir, edge_trees[tree_name])
+    assert new_bookmarks(input_dir, ".") == old_bookmarks(input_dir, ".")
+
+@pytest.mark.parametrize("seed", range(4))
+def test_synthetic_books(tmp_path, seed):
+    sys.path.insert(0, os.path.join(REPO_PATH, "benchmarks"))
+    from make_book_tree import make_book_tree
+
+    # Lots of empty (and nested empty) directories, small pages
+    input_dir = str(tmp_path / "book")
+    make_book_tree(input_dir, pages=40, depth=3, branching=3, width=17, height=22, image_format="png",
+        blank_ratio=0.2, empty_ratio=0.5, variants=1, seed=seed)
+    expected = old_bookmarks(input_dir, ".")
+    assert len(expected) > 0
+    assert new_bookmarks(input_dir, ".") == expected